@@ -21,12 +21,14 @@ from optofit.cneuron.gpchannel import GPChannel, sigma
 
 from hips.inference.particle_mcmc import *
 from optofit.cinference.pmcmc import *
+from optofit.inference.checkpoint import save_checkpoint, load_checkpoint
 
 import kayak
 import scipy
 
 
 plot_progress = True
+resume = False
 
 args = iter(sys.argv)
 for line in args:
@@ -34,6 +36,10 @@ for line in args:
         seed = int(next(args))
     elif line == "--no_graph":
         plot_progress = False
+    elif line == "--resume":
+        # Continue from the last checkpoint. Pass the same --seed so the
+        # ground truth data is regenerated identically.
+        resume = True
 
 # Set the random seed for reproducibility
 np.random.seed(seed)
@@ -257,7 +263,8 @@ def sample_z_given_x(t, x, inpt,
                      initialize='constant',
                      N_particles=1000,
                      N_samples=100,
-                     axs=None, gp1_ax=None, gp2_ax=None):
+                     axs=None, gp1_ax=None, gp2_ax=None,
+                     checkpoint=None, resume=False):
     dt = np.diff(t)
     T,O = x.shape
 
@@ -359,8 +366,25 @@ def sample_z_given_x(t, x, inpt,
     # eta_sqs = resample_observation_noise(z_smpls[0,:,:], x)
     # lkhd.set_etasq(eta_sqs)
 
-
-    for s in range(1,N_samples):
+    # The samples so far are written to a results file every iteration
+    def results_file(s):
+        return 'squid' + str(seed) + '_results' + str(s) + '.pkl'
+
+    # Everything that carries state from one iteration to the next. The
+    # checkpoint only holds the latest sample, and the sample history is
+    # restored from the results file of the same iteration.
+    checkpoint_objects = {'gp1': gp1, 'gp2': gp2, 'prop': prop, 'lkhd': lkhd}
+    start = 1
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        last, arrays = load_checkpoint(checkpoint, objects=checkpoint_objects)
+        with open(results_file(last)) as f:
+            z_prev, gp1_smpls, gp2_smpls = cPickle.load(f)
+        z_smpls[:last] = z_prev[:last]
+        z_smpls[last] = arrays['z']
+        start = last + 1
+        print "Resuming from iteration %d" % start
+
+    for s in range(start,N_samples):
         print "Iteration %d" % s
         # raw_input("Press enter to continue\n")
         # Reinitialize with the previous particle
@@ -406,12 +430,17 @@ def sample_z_given_x(t, x, inpt,
             gp1_smpls.append(gp1.gps)
             gp2_smpls.append(gp2.gps)
 
-        freq = 1
-        if s % freq == 0:
-            with open('squid' + str(seed) + '_results' + str(s / freq) + '.pkl', 'w') as f:
-                cPickle.dump((z_smpls, gp1_smpls, gp2_smpls), f, protocol=-1)
-            if(s / freq > 1):
-                os.remove('squid' + str(seed) + '_results' + str((s / freq) - 1) + '.pkl')
+        # Save the results before the checkpoint, and only remove the
+        # previous results once the checkpoint no longer refers to them
+        with open(results_file(s), 'w') as f:
+            cPickle.dump((z_smpls, gp1_smpls, gp2_smpls), f, protocol=-1)
+
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, s, objects=checkpoint_objects,
+                            arrays={'z': z_smpls[s]})
+
+        if s > 1:
+            os.remove(results_file(s - 1))
     z_mean = z_smpls.mean(axis=0)
     z_std = z_smpls.std(axis=0)
     z_env = np.zeros((T*2,2))
@@ -661,7 +690,9 @@ with open('squid_' + str(seed) + '_ground.pkl', 'w') as f:
 
 # raw_input("Press enter to being sampling...\n")
 # sample_z_given_x(t, x, inpt, z0=z, axs=st_axs)
-z_smpls, gp1_smpls, gp2_smpls = sample_z_given_x(t, x, inpt, N_samples=1000, axs=st_axs, initialize='optimize')
+z_smpls, gp1_smpls, gp2_smpls = sample_z_given_x(t, x, inpt, N_samples=1000, axs=st_axs, initialize='optimize',
+                                                  checkpoint='squid_' + str(seed) + '_checkpoint.npz',
+                                                  resume=resume)
 # sample_z_given_x(t, x, inpt, axs=st_axs, z0=z, initialize='ground_truth')
 # sample_z_given_x(t, x, inpt, axs=st_axs, initialize='optimize')
 
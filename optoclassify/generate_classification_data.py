@@ -10,7 +10,7 @@ import cPickle, gzip
 
 from hips.plotting.sausage import sausage_plot
 
-from hh_dynamics import forward_euler, implicit_euler
+from hh_dynamics import forward_euler, implicit_euler, ensemble_rk4
 
 def make_mixture_distribution():
     # The two classes of neurons are distinguished
@@ -101,33 +101,17 @@ def generate_data():
     z0[0] = -77.
     z0[1:] = 0.01
 
-    # Simulate N traces of healthy cells
-    g_healthy = np.zeros((3,N))
-    v_healthy = np.zeros((T,N))
-    for n in xrange(N):
-        if n % 10 == 0:
-            print "Simulating healthy neuron ", n
-        # Sample conductances
-        g = p_healthy.rvs()
-        g_healthy[:,n] = g
-        # Simulate a trace
-        # z = forward_euler(z0, g, inpt, T, dt)
-        z = implicit_euler(z0, g, inpt, t)
-        v_healthy[:,n] = z[:,0]
-
-    # Simulate N traces of disease cells
-    g_disease = np.zeros((3,N))
-    v_disease = np.zeros((T,N))
-    for n in xrange(N):
-        if n % 10 == 0:
-            print "Simulating disease neuron ", n
-        # Sample conductances
-        g = p_disease.rvs()
-        g_disease[:,n] = g
-        # Simulate a trace
-        # z = forward_euler(z0, g, inpt, T, dt)
-        z = implicit_euler(z0, g, inpt, t)
-        v_disease[:,n] = z[:,0]
+    # Sample the conductances of N healthy and N disease cells
+    g_healthy = p_healthy.rvs(size=(N,3)).T
+    g_disease = p_disease.rvs(size=(N,3)).T
+
+    # Simulate the voltage traces of all 2N cells at once. RK4 matches the
+    # accuracy of integrating each cell with odeint (implicit_euler), as
+    # checked by rk4_test.py.
+    print "Simulating ", 2*N, " neurons"
+    v = ensemble_rk4(z0, np.hstack((g_healthy, g_disease)), inpt, t, dims=[0])
+    v_healthy = v[:,:N,0]
+    v_disease = v[:,N:,0]
 
     v_healthy, g_healthy = check_data(v_healthy, g_healthy)
     v_disease, g_disease = check_data(v_disease, g_disease)
@@ -0,0 +1,54 @@
+"""
+Check that simulating an ensemble of neurons with RK4 matches integrating
+each neuron on its own with odeint, on a pulsed input like that of
+generate_classification_data.
+
+Run with:  python rk4_test.py
+"""
+import numpy as np
+
+from hh_dynamics import ensemble_rk4, ensemble_forward_euler, implicit_euler
+
+def make_input(t, duty=50., wait=50., amp=75.):
+    # Pulses of increasing amplitude
+    inpt = np.zeros_like(t)
+    scale = 1
+    offset = 0
+    while offset < t[-1]:
+        offset += wait
+        inpt += scale*amp * (t > offset) * (t < offset + duty)
+        offset += duty
+        scale += 1
+
+    return lambda tf: np.interp(tf, t, inpt)
+
+def test_rk4_matches_odeint():
+    np.random.seed(0)
+    dt = 0.01
+    t = np.arange(int(300 / dt)) * dt
+    inpt = make_input(t)
+
+    # Leak, sodium and potassium conductances around those of the healthy
+    # and disease classes
+    g = np.array([[0.2, 120., 36.], [0.2, 90., 36.]]).T
+    g = np.hstack((g, np.repeat(g, 2, axis=1) * np.random.gamma(50., 1/50., size=(3,4))))
+
+    z0 = np.zeros(4)
+    z0[0] = -77.
+    z0[1:] = 0.01
+
+    v_rk4 = ensemble_rk4(z0, g, inpt, t, dims=[0])[:,:,0]
+    v_euler = ensemble_forward_euler(z0, g, inpt, t, dims=[0])[:,:,0]
+    for k in range(g.shape[1]):
+        v_odeint = implicit_euler(z0, g[:,k], inpt, t)[:,0]
+        err = np.abs(v_rk4[:,k] - v_odeint).max()
+        assert err < 0.1, "RK4 traces differ from odeint by %.3f mV" % err
+
+        # The check is tight enough to catch a first order integrator
+        if k == 0:
+            assert np.abs(v_euler[:,k] - v_odeint).max() > 1.0, \
+                "Forward Euler unexpectedly matches odeint"
+
+if __name__ == "__main__":
+    test_rk4_matches_odeint()
+    print("RK4 tests passed")
@@ -0,0 +1,150 @@
+"""
+Counter-based random numbers for the particle filter kernels.
+
+This implements the Philox4x32-10 generator of Salmon et al. (2011),
+"Parallel random numbers: as easy as 1, 2, 3". Rather than advancing a
+shared state, each draw is a pure function of a key (the seed) and a
+counter. We use (sweep, time, particle, dimension) as the counter so that
+noise can be drawn independently inside nogil loops, with results that do
+not depend on how the particles are split across threads or processes.
+"""
+from libc.stdint cimport uint32_t, uint64_t
+from libc.math cimport sqrt, log, log1p, exp, expm1, cos, sin, M_PI
+
+cdef inline void philox4x32(uint32_t* ctr, uint64_t seed, uint32_t* out) noexcept nogil:
+    """
+    Apply ten rounds of Philox4x32 to the 4 word counter ctr with the 64 bit
+    key seed, and write the 4 word result into out.
+    """
+    cdef uint32_t k0 = <uint32_t> seed
+    cdef uint32_t k1 = <uint32_t> (seed >> 32)
+    cdef uint32_t c0 = ctr[0], c1 = ctr[1], c2 = ctr[2], c3 = ctr[3]
+    cdef uint64_t p0, p1
+    cdef int r
+    for r in range(10):
+        # Bump the key with the Weyl sequence constants
+        if r > 0:
+            k0 += 0x9E3779B9U
+            k1 += 0xBB67AE85U
+        # Multiply by the round constants
+        p0 = <uint64_t> 0xD2511F53U * c0
+        p1 = <uint64_t> 0xCD9E8D57U * c2
+        c0 = (<uint32_t> (p1 >> 32)) ^ c1 ^ k0
+        c1 = <uint32_t> p1
+        c2 = (<uint32_t> (p0 >> 32)) ^ c3 ^ k1
+        c3 = <uint32_t> p0
+
+    out[0] = c0
+    out[1] = c1
+    out[2] = c2
+    out[3] = c3
+
+cdef inline double philox_uniform(uint32_t hi, uint32_t lo) noexcept nogil:
+    """
+    Combine two words into a double with 53 random bits in [0, 1)
+    """
+    return ((hi >> 5) * 67108864.0 + (lo >> 6)) * (1.0 / 9007199254740992.0)
+
+cdef inline void philox_normals(uint64_t seed, uint32_t sweep, uint32_t t,
+                                uint32_t n, uint32_t k, double* z0, double* z1) noexcept nogil:
+    """
+    Pair of independent standard normal random variables for the given seed
+    and counter, using the Box-Muller transform of two 53 bit uniforms.
+    """
+    cdef uint32_t ctr[4]
+    cdef uint32_t out[4]
+    cdef double r, theta
+    ctr[0] = sweep
+    ctr[1] = t
+    ctr[2] = n
+    ctr[3] = k
+    philox4x32(ctr, seed, out)
+
+    # Use 1-u so that the argument of the log is in (0, 1]
+    r = sqrt(-2.0 * log(1.0 - philox_uniform(out[0], out[1])))
+    theta = 2.0 * M_PI * philox_uniform(out[2], out[3])
+    z0[0] = r * cos(theta)
+    z1[0] = r * sin(theta)
+
+cdef inline double philox_normal(uint64_t seed, uint32_t sweep, uint32_t t,
+                                 uint32_t n, uint32_t d) noexcept nogil:
+    """
+    The d-th standard normal random variable for the given seed and counter.
+    Consecutive pairs of d share a single Philox block, so filling a vector
+    with philox_normals is twice as fast as calling this for each entry.
+    """
+    cdef double z0, z1
+    philox_normals(seed, sweep, t, n, d >> 1, &z0, &z1)
+    if d & 1:
+        return z1
+    return z0
+
+cdef inline void philox_uniforms(uint64_t seed, uint32_t sweep, uint32_t t,
+                                 uint32_t n, uint32_t k, double* u0, double* u1) noexcept nogil:
+    """
+    Pair of independent 53 bit uniform random variables in [0, 1) for the
+    given seed and counter
+    """
+    cdef uint32_t ctr[4]
+    cdef uint32_t out[4]
+    ctr[0] = sweep
+    ctr[1] = t
+    ctr[2] = n
+    ctr[3] = k
+    philox4x32(ctr, seed, out)
+    u0[0] = philox_uniform(out[0], out[1])
+    u1[0] = philox_uniform(out[2], out[3])
+
+cdef inline double philox_truncated_normal(uint64_t seed, uint32_t sweep, uint32_t t,
+                                           uint32_t n, uint32_t d, uint32_t D,
+                                           double a, double b) noexcept nogil:
+    """
+    Standard normal random variable truncated to [a, b], for dimension d of D,
+    by rejection sampling (Robert, 1995, "Simulation of truncated normal
+    variables"). The k-th attempt uses the block (k*D + d) of the counter, so
+    the draw is still a pure function of the seed and counter.
+
+    Intervals below zero are reflected above it. An interval that contains
+    zero is sampled with a uniform proposal if it is narrow and a normal
+    proposal otherwise. An interval above zero is sampled with an exponential
+    proposal, truncated at b, with the optimal rate.
+    """
+    cdef double sign = 1.0
+    cdef double tmp, x, u0, u1, lam, scale
+    cdef uint32_t k = 0
+
+    if b < 0:
+        tmp = a
+        a = -b
+        b = -tmp
+        sign = -1.0
+
+    if a <= 0:
+        if b - a < 2.5066282746310002:
+            # Uniform proposal, accepted with probability exp(-x^2/2)
+            while True:
+                philox_uniforms(seed, sweep, t, n, k*D + d, &u0, &u1)
+                k += 1
+                x = a + (b - a) * u0
+                if u1 < exp(-0.5 * x * x):
+                    return sign * x
+        else:
+            # Normal proposal, accepted if it falls in the interval
+            while True:
+                philox_normals(seed, sweep, t, n, k*D + d, &u0, &u1)
+                k += 1
+                if a <= u0 <= b:
+                    return sign * u0
+                if a <= u1 <= b:
+                    return sign * u1
+
+    # Exponential proposal truncated to [a, b], accepted with probability
+    # exp(-(x - lam)^2 / 2)
+    lam = 0.5 * (a + sqrt(a * a + 4.0))
+    scale = -expm1(-lam * (b - a))
+    while True:
+        philox_uniforms(seed, sweep, t, n, k*D + d, &u0, &u1)
+        k += 1
+        x = a - log1p(-u0 * scale) / lam
+        if u1 < exp(-0.5 * (x - lam) * (x - lam)):
+            return sign * min(x, b)
@@ -1,16 +1,68 @@
-# distutils: extra_compile_args = -O3
+# distutils: extra_compile_args = -O3 -fopenmp
+# distutils: extra_link_args = -fopenmp
 # cython: wraparound=False
 # cython: boundscheck=False
 # cython: nonecheck=False
 ## cython: cdivision=True
 # cython: overflowcheck=True
 from cython.parallel import prange
+cimport openmp
+from libc.stdint cimport uint32_t, uint64_t
 
 import numpy as np
 cimport numpy as np
 
 from hips.inference.particle_mcmc cimport InitialDistribution, Proposal, Likelihood, ParticleGibbsAncestorSampling
 from optofit.cneuron.component cimport Component
+from optofit.cinference.philox cimport philox4x32, philox_normal, philox_normals, philox_truncated_normal
+from libc.math cimport sqrt, log, log1p, exp, expm1, erfc, fabs, INFINITY
+
+def set_num_threads(int num_threads):
+    """
+    Set the number of OpenMP threads used by the particle kernels, including
+    the kinetics of the Cython neuron components.
+
+    The output does not depend on the number of threads. The transition noise
+    comes from a counter-based generator keyed by (seed, sweep, time,
+    particle), and each particle is propagated by a single thread using only
+    thread-private scratch variables, so a given seed gives the same
+    particles on any number of cores.
+    """
+    assert num_threads > 0, "Number of threads must be positive"
+    openmp.omp_set_num_threads(num_threads)
+
+def get_num_threads():
+    """
+    Get the number of OpenMP threads used by the particle kernels
+    """
+    return openmp.omp_get_max_threads()
+
+def philox_block(counter, uint64_t seed):
+    """
+    Apply the Philox4x32-10 block function to a 4 word counter with a 64 bit
+    key, e.g. to check it against the known answer tests of Random123. The
+    low word of the key is seed & 0xFFFFFFFF.
+    """
+    cdef uint32_t ctr[4]
+    cdef uint32_t out[4]
+    cdef int i
+    for i in range(4):
+        ctr[i] = counter[i]
+    philox4x32(ctr, seed, out)
+    return [out[i] for i in range(4)]
+
+def philox_normal_samples(uint64_t seed, uint32_t sweep, uint32_t t, int N, int D):
+    """
+    N x D array of the standard normals drawn for particles 0..N-1 and
+    dimensions 0..D-1 at the given sweep and time index
+    """
+    cdef double[:,::1] z = np.zeros((N,D))
+    cdef int n, d
+    for n in range(N):
+        for d in range(D):
+            z[n,d] = philox_normal(seed, sweep, t, n, d)
+    return np.asarray(z)
+
 
 class GaussianInitialDistribution(InitialDistribution):
 
@@ -56,11 +108,22 @@ cdef class HodgkinHuxleyProposal(Proposal):
     cdef double[:,::1] inpt
     # A buffer for kinetics
     cdef double[:,:,::1] dzdt
+    # Key and sweep counter of the counter-based random stream
+    cdef public uint64_t seed
+    cdef public uint32_t sweep
 
-    def __init__(self, int T, int N, int D, Component component, double[::1] sigmas, double[::1] ts, double[:,::1] inpt):
+    def __init__(self, int T, int N, int D, Component component, double[::1] sigmas, double[::1] ts, double[:,::1] inpt,
+                 seed=None):
         self.component = component
         self.sigmas = sigmas
 
+        # By default, seed the random stream from numpy so that
+        # np.random.seed still makes runs reproducible
+        if seed is None:
+            seed = np.random.randint(2**31-1)
+        self.seed = seed
+        self.sweep = 0
+
         self.ts = ts
         self.inpt = inpt
 
@@ -82,30 +145,43 @@ cdef class HodgkinHuxleyProposal(Proposal):
 
             :return         z[i_prev+1,:,:] is updated with a sample
                             from the proposal distribution.
+
+            The noise is keyed by (seed, sweep, i_prev+1, n, d). The sweep
+            counter advances each time we propagate from the first time index.
         """
         cdef int N = z.shape[1]
         cdef int D = z.shape[2]
         cdef int n, d, a
+        cdef double eps0, eps1
 
-        # Preallocate random variables
-        cdef double[:,::1] rands = np.random.randn(N,D)
+        if i_prev == 0:
+            self.sweep += 1
+        cdef uint64_t seed = self.seed
+        cdef uint32_t sweep = self.sweep
+        cdef uint32_t t_next = i_prev+1
 
         # Run the kinetics model forward
         cdef int[::1] tview = <int[:1]> &i_prev
         self.component.kinetics(self.dzdt, z, self.inpt, tview)
         cdef double dt = self.ts[i_prev+1]-self.ts[i_prev]
 
-        # # TODO: Parallelize with OMP
+        # Propagate the particles in parallel. Each particle is handled by
+        # a single thread.
         with nogil:
-            # for n in prange(N):
-            for n in range(N):
-                for d in prange(D):
+            for n in prange(N, schedule='static'):
+                # Assigning a, eps0 and eps1 makes them private to the thread
+                a = ancestors[n]
+                eps0 = eps1 = 0
+                for d in range(D):
                     # Forward Euler step
-                    # z[i_prev+1,n,d] = z[i_prev,n,d] + dt * self.dzdt[i_prev,n,d]
-                    a = ancestors[n]
                     z[i_prev+1,n,d] = z[i_prev,a,d] + dt * self.dzdt[i_prev,a,d]
-                    # Add noise
-                    z[i_prev+1,n,d] += self.sigmas[d] * rands[n,d]
+
+                # Add noise, drawing normals two dimensions at a time
+                for d in range(0, D, 2):
+                    philox_normals(seed, sweep, t_next, n, d >> 1, &eps0, &eps1)
+                    z[i_prev+1,n,d] += self.sigmas[d] * eps0
+                    if d+1 < D:
+                        z[i_prev+1,n,d+1] += self.sigmas[d+1] * eps1
 
 
     cpdef logp(self, double[:,::1] z_prev, int i_prev, double[::1] z_curr, double[::1] lp):
@@ -123,115 +199,256 @@ cdef class HodgkinHuxleyProposal(Proposal):
         cdef int N = z_prev.shape[0]
         cdef int D = z_prev.shape[1]
         cdef int n, d
-        cdef double[::1] z_mean = np.zeros((D,))
+        cdef double z_mean
         cdef double dt = self.ts[i_prev+1]-self.ts[i_prev]
 
         # NOTE! We are assuming that dzdt has already been properly populated!
         #
-        # # TODO: Parallelize with OMP
+        # The predicted mean is a thread-private scalar rather than a shared
+        # buffer, so that particles can be evaluated in parallel.
         with nogil:
-            for n in prange(N):
-                for d in prange(D):
-                    # Forward Euler step
-                    z_mean[d] = z_prev[n,d] + dt * self.dzdt[i_prev,n,d]
-
+            for n in prange(N, schedule='static'):
                 # Compute the Gaussian log probability
                 lp[n] = 0
                 for d in range(D):
-                    lp[n] += -0.5/self.sigma_sqs[d] * (z_curr[d] - z_mean[d])**2
+                    # Forward Euler step
+                    z_mean = z_prev[n,d] + dt * self.dzdt[i_prev,n,d]
+                    lp[n] += -0.5/self.sigma_sqs[d] * (z_curr[d] - z_mean)**2
 
     cpdef set_sigmasq(self, double[::1] sigma_sqs):
         self.sigma_sqs = sigma_sqs
         for d in range(self.D):
             self.sigmas[d] = np.sqrt(sigma_sqs[d])
 
-# class TruncatedHodgkinHuxleyProposal(Proposal):
-#     def __init__(self, population, t, inpt, sigma):
-#         self.population = population
-#         self.t = t
-#         self.inpt = inpt
-#
-#         self.sigma = sigma
-#         if self.sigma.ndim == 1:
-#             self.sigma = self.sigma[:,None]
-#
-#         self.lb = population.latent_lb[:,None]
-#         self.ub = population.latent_ub[:,None]
-#
-#         from distributions import TruncatedGaussianDistribution
-#         self.noiseclass = TruncatedGaussianDistribution()
-#
-#     def _hh_kinetics(self, index, Z):
-#         D,Np = Z.shape
-#         # Get the current input and latent states
-#         current_inpt = self.inpt[index]
-#         latent = as_sarray(Z, self.population.latent_dtype)
-#
-#         # Run the kinetics forward
-#         dxdt = self.population.kinetics(latent, current_inpt)
-#
-#         # TODO: Wow, this is terrible. Converting to/from numpy struct array and
-#         # regular arrays, and maintaining the correct shape, is a mega pain in the ass
-#         return dxdt.view(np.float).reshape((Np,D)).T
-#
-#     def sample_next(self, curr_index, Z_prev, next_index):
-#         # assert next_index >= curr_index
-#         D,Np = Z_prev.shape
-#
-#         # Propagate forward according to the hodgkin huxley dynamics
-#         # then add noise, guaranteeing that we stay within the limits
-#         dt = self.t[next_index] - self.t[curr_index]
-#         z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
-#
-#         z = np.clip(z, self.lb, self.ub)
-#
-#         noise_lb = self.lb - z
-#         noise_ub = self.ub - z
-#
-#         # Scale down the noise to account for time delay
-#         # sig = self.sigma * np.sqrt(dt)
-#         sig = self.sigma * dt
-#
-#         # TODO: Remove the zeros_like requirement
-#         noise = self.noiseclass.sample(mu=np.zeros_like(z), sigma=sig,
-#                                        lb=noise_lb, ub=noise_ub)
-#         logp = self.noiseclass.logp(noise, mu=0, sigma=sig,
-#                                     lb=noise_lb, ub=noise_ub)
-#
-#         # Also return extra state to help compute logp
-#         state = {'z' : z}
-#         return z + noise, logp, state
-#
-#     def logp(self, curr_index, Z_prev, next_index, Z_next, state=None):
-#         # Propagate forward according to the hodgkin huxley dynamics
-#         # then add noise, guaranteeing that we stay within the limits
-#         dt = self.t[next_index] - self.t[curr_index]
-#
-#         # Check if we have the propagated particles
-#         if state is not None and 'z' in state:
-#             z = state['z']
-#         else:
-#             # Run kinetics and clip to within range
-#             z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
-#             z = np.clip(z, self.lb, self.ub)
-#
-#         noise = Z_next-z
-#         noise_lb = self.lb - z
-#         noise_ub = self.ub - z
-#
-#         # Scale down the noise to account for time delay
-#         # import pdb; pdb.set_trace()
-#         # sig = self.sigma * np.sqrt(dt)
-#         sig = self.sigma * dt
-#         logp = self.noiseclass.logp(noise, mu=0, sigma=sig,
-#                                     lb=noise_lb, ub=noise_ub)
-#
-#         # Sum along the D axis
-#         logp1 = logp.sum(axis=0)
-#
-#         # if not np.all(np.isfinite(logp1)):
-#         #     import pdb; pdb.set_trace()
-#         return logp1
+    def get_state(self):
+        """ The random stream position and noise levels, for checkpointing
+        """
+        return {'seed' : self.seed, 'sweep' : self.sweep,
+                'sigma_sqs' : np.array(self.sigma_sqs)}
+
+    def set_state(self, state):
+        self.seed = int(state['seed'])
+        self.sweep = int(state['sweep'])
+        self.set_sigmasq(state['sigma_sqs'].copy())
+
+cdef inline double log_normal_tail(double x) noexcept nogil:
+    """
+    Log of the upper tail probability of the standard normal, log(1 - Phi(x)),
+    using its asymptotic expansion where erfc underflows
+    """
+    cdef double x2
+    if x < 25.0:
+        return log(0.5 * erfc(x / sqrt(2.0)))
+    x2 = x * x
+    return -0.5 * x2 - log(x) - 0.9189385332046727 + log1p(-1.0 / x2 + 3.0 / (x2 * x2))
+
+cdef inline double log_normal_mass(double a, double b) noexcept nogil:
+    """
+    Log of the probability mass of the standard normal in [a, b]
+    """
+    cdef double tmp, log_qa, log_qb
+    if b < 0:
+        tmp = a
+        a = -b
+        b = -tmp
+
+    if a <= 0:
+        return log(1.0 - 0.5 * erfc(-a / sqrt(2.0)) - 0.5 * erfc(b / sqrt(2.0)))
+
+    log_qa = log_normal_tail(a)
+    log_qb = log_normal_tail(b)
+    return log_qa + log1p(-exp(log_qb - log_qa))
+
+
+cdef class TruncatedHodgkinHuxleyProposal(HodgkinHuxleyProposal):
+    """
+    Hodgkin Huxley proposal that keeps each latent state variable in its
+    bounds, e.g. the gating variables in [0, 1]. The forward Euler step is
+    clipped to [lb, ub] and the Gaussian noise is truncated so that the
+    particle stays in [lb, ub].
+    """
+    # Lower and upper bounds of each latent state dimension
+    cdef double[::1] lb
+    cdef double[::1] ub
+
+    def __init__(self, int T, int N, int D, Component component, double[::1] sigmas, double[::1] ts, double[:,::1] inpt,
+                 double[::1] lb, double[::1] ub, seed=None):
+        super(TruncatedHodgkinHuxleyProposal, self).__init__(T, N, D, component, sigmas, ts, inpt, seed=seed)
+        assert lb.shape[0] == D and ub.shape[0] == D
+        self.lb = lb
+        self.ub = ub
+
+    cdef run_kinetics(self, double[:,:,::1] z, int i_prev):
+        """ Populate self.dzdt[i_prev] with the kinetics of the particles z[i_prev]
+        """
+        cdef int[::1] tview = <int[:1]> &i_prev
+        self.component.kinetics(self.dzdt, z, self.inpt, tview)
+
+    cdef double step(self, double z, int i_prev, int n, int d, double dt) noexcept nogil:
+        """ Noiseless prediction of dimension d of the n-th particle at time
+            index i_prev, whose value is z, after a time step dt
+        """
+        # Forward Euler step
+        return z + dt * self.dzdt[i_prev,n,d]
+
+    cpdef sample_next(self, double[:,:,::1] z, int i_prev, int[::1] ancestors):
+        """ Sample the next state given the previous time index
+
+            :param z:       TxNxD buffer of particle states
+            :param i_prev:  Time index into z and self.ts
+
+            :return         z[i_prev+1,:,:] is updated with a sample
+                            from the proposal distribution.
+        """
+        cdef int N = z.shape[1]
+        cdef int D = z.shape[2]
+        cdef int n, d, a
+        cdef double z_mean
+
+        if i_prev == 0:
+            self.sweep += 1
+        cdef uint64_t seed = self.seed
+        cdef uint32_t sweep = self.sweep
+        cdef uint32_t t_next = i_prev+1
+
+        # Run the kinetics model forward
+        self.run_kinetics(z, i_prev)
+        cdef double dt = self.ts[i_prev+1]-self.ts[i_prev]
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                a = ancestors[n]
+                for d in range(D):
+                    # Noiseless step, clipped to the bounds
+                    z_mean = self.step(z[i_prev,a,d], i_prev, a, d, dt)
+                    z_mean = min(max(z_mean, self.lb[d]), self.ub[d])
+
+                    # Add noise truncated to keep the particle in bounds
+                    if self.sigmas[d] > 0:
+                        z_mean = z_mean + self.sigmas[d] * philox_truncated_normal(
+                            seed, sweep, t_next, n, d, D,
+                            (self.lb[d] - z_mean) / self.sigmas[d],
+                            (self.ub[d] - z_mean) / self.sigmas[d])
+                    z[i_prev+1,n,d] = min(max(z_mean, self.lb[d]), self.ub[d])
+
+    cpdef logp(self, double[:,::1] z_prev, int i_prev, double[::1] z_curr, double[::1] lp):
+        """ Compute the log probability of transitioning from z_prev to z_curr
+            at time self.ts[i_prev] to self.ts[i_prev+1]
+
+            :param z_prev:  NxD buffer of particle states at the i_prev-th time index
+            :param i_prev:  Time index into self.ts
+            :param z_curr:  D buffer of particle states at the (i_prev+1)-th time index
+            :param lp:      NxM buffer in which to store the probability of each transition
+
+            Since the truncation depends on the predicted mean, the log
+            normalizer of the truncated Gaussian is included for each particle.
+        """
+        cdef int N = z_prev.shape[0]
+        cdef int D = z_prev.shape[1]
+        cdef int n, d
+        cdef double z_mean
+        cdef double dt = self.ts[i_prev+1]-self.ts[i_prev]
+
+        # NOTE! We are assuming that dzdt has already been properly populated!
+        with nogil:
+            for n in prange(N, schedule='static'):
+                lp[n] = 0
+                for d in range(D):
+                    if z_curr[d] < self.lb[d] or z_curr[d] > self.ub[d]:
+                        lp[n] = -INFINITY
+                        break
+
+                    # Noiseless step, clipped to the bounds
+                    z_mean = self.step(z_prev[n,d], i_prev, n, d, dt)
+                    z_mean = min(max(z_mean, self.lb[d]), self.ub[d])
+
+                    if self.sigmas[d] > 0:
+                        lp[n] += -0.5/self.sigma_sqs[d] * (z_curr[d] - z_mean)**2 \
+                                 - log_normal_mass((self.lb[d] - z_mean) / self.sigmas[d],
+                                                   (self.ub[d] - z_mean) / self.sigmas[d])
+
+
+cdef class RushLarsenHodgkinHuxleyProposal(TruncatedHodgkinHuxleyProposal):
+    """
+    Truncated Hodgkin Huxley proposal that stays stable at coarse time steps.
+    Each gating variable relaxes exactly toward its steady state x_inf(V)
+    with time constant tau(V), and the voltage takes a semi-implicit step.
+    The decay rates are the diagonal of the Jacobian of the kinetics, which
+    we estimate with finite differences, perturbing one group of dimensions
+    at a time (see optofit.cneuron.simulate.diagonal_groups).
+    """
+    # Diagonal of the Jacobian of the kinetics for each particle
+    cdef double[:,:,::1] jac
+    # Group of each dimension, where group 0 holds the voltages
+    cdef int[::1] groups
+    cdef int G
+    # Buffers for the finite differences
+    cdef double[:,::1] z0
+    cdef double[:,::1] k0
+    cdef double[:,::1] eps
+
+    def __init__(self, int T, int N, int D, Component component, double[::1] sigmas, double[::1] ts, double[:,::1] inpt,
+                 double[::1] lb, double[::1] ub, seed=None):
+        super(RushLarsenHodgkinHuxleyProposal, self).__init__(T, N, D, component, sigmas, ts, inpt,
+                                                              lb, ub, seed=seed)
+        from optofit.cneuron.simulate import diagonal_groups
+        self.groups = diagonal_groups(component, D)
+        self.G = np.max(self.groups) + 1
+
+        self.jac = np.zeros((T,N,D))
+        self.z0 = np.zeros((N,D))
+        self.k0 = np.zeros((N,D))
+        self.eps = np.zeros((N,D))
+
+    cdef run_kinetics(self, double[:,:,::1] z, int i_prev):
+        """ Populate self.dzdt[i_prev] and self.jac[i_prev] with the kinetics
+            of the particles z[i_prev] and the diagonal of their Jacobian
+        """
+        cdef int N = z.shape[1]
+        cdef int D = z.shape[2]
+        cdef int n, d, g
+        cdef int[::1] tview = <int[:1]> &i_prev
+
+        self.component.kinetics(self.dzdt, z, self.inpt, tview)
+        self.z0[:,:] = z[i_prev]
+        self.k0[:,:] = self.dzdt[i_prev]
+
+        # Evaluate the kinetics with one group perturbed at a time, using
+        # the particles' rows of z and dzdt, and restore them afterward
+        for g in range(self.G):
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        if self.groups[d] == g:
+                            self.eps[n,d] = 1e-7 * max(1.0, fabs(self.z0[n,d]))
+                            z[i_prev,n,d] = self.z0[n,d] + self.eps[n,d]
+
+            self.component.kinetics(self.dzdt, z, self.inpt, tview)
+
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        if self.groups[d] == g:
+                            # Clip the rates at zero so the steps stay stable
+                            self.jac[i_prev,n,d] = min(0.0, (self.dzdt[i_prev,n,d] - self.k0[n,d]) / self.eps[n,d])
+                            z[i_prev,n,d] = self.z0[n,d]
+
+        self.dzdt[i_prev,:,:] = self.k0
+
+    cdef double step(self, double z, int i_prev, int n, int d, double dt) noexcept nogil:
+        cdef double f = self.dzdt[i_prev,n,d]
+        cdef double a = self.jac[i_prev,n,d]
+
+        # Semi-implicit step of the voltage
+        if self.groups[d] == 0:
+            return z + dt * f / (1.0 - a * dt)
+
+        # Exponential relaxation of the gates, which reduces to forward
+        # Euler as a*dt goes to zero
+        if fabs(a * dt) < 1e-8:
+            return z + dt * f
+        return z + expm1(a * dt) / a * f
+
 
 cdef class PartialGaussianLikelihood(Likelihood):
     """
@@ -241,15 +458,23 @@ cdef class PartialGaussianLikelihood(Likelihood):
     cdef int O
     cdef double[::1] etas
     cdef double[::1] eta_sqs
+    # Key and sweep counter of the counter-based random stream
+    cdef public uint64_t seed
+    cdef public uint32_t sweep
 
     # A simple (albeit hacky) observation model.
     # We see some set of indices
-    def __init__(self, int[::1] observed_dims, double[::1] etas):
+    def __init__(self, int[::1] observed_dims, double[::1] etas, seed=None):
 
         self.observed_dims = observed_dims
         self.O = observed_dims.shape[0]
         self.etas = etas
 
+        if seed is None:
+            seed = np.random.randint(2**31-1)
+        self.seed = seed
+        self.sweep = 0
+
         cdef int o
         self.eta_sqs = np.zeros(self.O)
         for o in range(self.O):
@@ -283,14 +508,149 @@ cdef class PartialGaussianLikelihood(Likelihood):
 
             :return         z[i_prev+1,:,:] is updated with a sample
                             from the proposal distribution.
+
+            The noise is keyed by (seed, sweep, i, n, o). The sweep counter
+            advances each time we sample the first time index of particle 0.
         """
         cdef int o, d
+        if i == 0 and n == 0:
+            self.sweep += 1
+
         for o in range(self.O):
             d = self.observed_dims[o]
-            x[i,o] = z[i,n,d] + self.etas[o] * np.random.randn()
+            x[i,o] = z[i,n,d] + self.etas[o] * philox_normal(self.seed, self.sweep, i, n, o)
 
 
     cpdef set_etasq(self, double[::1] eta_sqs):
         self.eta_sqs = eta_sqs
         for o in range(self.O):
-            self.etas[o] = np.sqrt(eta_sqs[o])
\ No newline at end of file
+            self.etas[o] = np.sqrt(eta_sqs[o])
+
+    def get_state(self):
+        """ The random stream position and noise levels, for checkpointing
+        """
+        return {'seed' : self.seed, 'sweep' : self.sweep,
+                'eta_sqs' : np.array(self.eta_sqs)}
+
+    def set_state(self, state):
+        self.seed = int(state['seed'])
+        self.sweep = int(state['sweep'])
+        self.set_etasq(state['eta_sqs'].copy())
+
+cdef class GaussianObservationLikelihood(Likelihood):
+    """
+    Likelihood of observations that are Gaussian in affine functions of single
+    latent dimensions, e.g. voltages or linear fluorescence, with the latent
+    bounds checked in the same pass. See observation_likelihood to make one
+    from a model.
+    """
+    cdef int[::1] observed_cols
+    cdef int[::1] latent_dims
+    cdef int O
+    cdef double[::1] scales
+    cdef double[::1] intercepts
+    cdef double[::1] etas
+    cdef double[::1] eta_sqs
+    # Latent dimensions with a finite bound, and their bounds
+    cdef int[::1] bounded_dims
+    cdef int B
+    cdef double[::1] lb
+    cdef double[::1] ub
+    # Key and sweep counter of the counter-based random stream
+    cdef public uint64_t seed
+    cdef public uint32_t sweep
+
+    def __init__(self, int[::1] observed_cols, int[::1] latent_dims,
+                 double[::1] scales, double[::1] intercepts, double[::1] etas,
+                 double[::1] lb, double[::1] ub, seed=None):
+
+        self.observed_cols = observed_cols
+        self.latent_dims = latent_dims
+        self.O = latent_dims.shape[0]
+        self.scales = scales
+        self.intercepts = intercepts
+        self.etas = etas
+
+        if seed is None:
+            seed = np.random.randint(2**31-1)
+        self.seed = seed
+        self.sweep = 0
+
+        cdef int o
+        self.eta_sqs = np.zeros(self.O)
+        for o in range(self.O):
+            self.eta_sqs[o] = etas[o]**2
+
+        bounded = np.nonzero(np.isfinite(lb) | np.isfinite(ub))[0]
+        self.bounded_dims = bounded.astype(np.intc)
+        self.B = bounded.shape[0]
+        self.lb = np.asarray(lb)[bounded].copy()
+        self.ub = np.asarray(ub)[bounded].copy()
+
+    cpdef logp(self, double[:,:,::1] z, double[:,::1] x, int i, double[::1] ll):
+        """ Compute the log likelihood, log p(x|z), at time index i and put the
+            output in the buffer ll. Particles outside the latent bounds get
+            log likelihood -inf.
+
+            :param z:   TxNxD buffer of latent states
+            :param x:   TxO buffer of observations
+            :param i:   Time index at which to compute the log likelihood
+            :param ll:  N buffer to populate with log likelihoods
+        """
+        cdef int N = z.shape[1]
+        cdef int n, o, b, d
+        cdef double r
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                ll[n] = 0
+                for b in range(self.B):
+                    d = self.bounded_dims[b]
+                    if z[i,n,d] < self.lb[b] or z[i,n,d] > self.ub[b]:
+                        ll[n] = -INFINITY
+                        break
+
+                if ll[n] == 0:
+                    for o in range(self.O):
+                        r = x[i,self.observed_cols[o]] - \
+                            (self.scales[o] * z[i,n,self.latent_dims[o]] + self.intercepts[o])
+                        ll[n] += -0.5/self.eta_sqs[o] * r * r
+
+    cpdef sample(self, double[:,:,::1] z, double[:,::1] x, int i, int n):
+        """ Sample the observations at time index i given the n-th particle
+
+            The noise is keyed by (seed, sweep, i, n, o). The sweep counter
+            advances each time we sample the first time index of particle 0.
+        """
+        cdef int o
+        if i == 0 and n == 0:
+            self.sweep += 1
+
+        for o in range(self.O):
+            x[i,self.observed_cols[o]] = self.scales[o] * z[i,n,self.latent_dims[o]] + \
+                                         self.intercepts[o] + \
+                                         self.etas[o] * philox_normal(self.seed, self.sweep, i, n, o)
+
+    def get_state(self):
+        """ The random stream position, for checkpointing
+        """
+        return {'seed' : self.seed, 'sweep' : self.sweep}
+
+    def set_state(self, state):
+        self.seed = int(state['seed'])
+        self.sweep = int(state['sweep'])
+
+
+def observation_likelihood(model, seed=None):
+    """
+    Make a GaussianObservationLikelihood for the model's observations and
+    latent bounds. The observation parameters are read once, here.
+    """
+    from optofit.inference.particle_mcmc import gaussian_observation_terms
+    terms = gaussian_observation_terms(model)
+    assert terms is not None, "The observations are not Gaussian in single latent variables"
+    obs_cols, latent_cols, scales, intercepts, sigmas = terms
+    return GaussianObservationLikelihood(obs_cols, latent_cols, scales, intercepts, sigmas,
+                                         np.asarray(model.population.latent_lb, dtype=np.float64),
+                                         np.asarray(model.population.latent_ub, dtype=np.float64),
+                                         seed=seed)
@@ -8,6 +8,27 @@ from compartment cimport Compartment
 
 from libc.math cimport exp, log
 
+# A channel compiled down to plain C data so that compartments can evaluate
+# any mix of channels without the GIL. The current and gates functions take
+# pointers to a single particle's row of the latent state buffer.
+cdef struct ChannelSpec
+ctypedef double (*current_fn)(ChannelSpec* spec, double* x, double V) noexcept nogil
+ctypedef void (*gates_fn)(ChannelSpec* spec, double* dxdt, double* x, double V) noexcept nogil
+
+cdef struct ChannelSpec:
+    double g
+    double E
+    int x_offset
+    current_fn current          # Instantaneous current, excluding g
+    gates_fn gates              # Gate kinetics, or NULL if there are none
+
+    # Optional rate table. See optofit.neuron.rate_table.RateTable
+    double* coeffs
+    int G
+    double V_min
+    double V_max
+    double dV
+
 cdef class Channel(Component):
     """
     Abstract base class for an ion channel.
@@ -17,8 +38,13 @@ cdef class Channel(Component):
 
     cdef public Compartment parent_compartment
 
+    # Optional lookup table of the gating rates, or None
+    cdef public object rate_table
+
     cpdef double current(self, double[:,:,::1] x, double V, int t, int n)
 
+    cdef bint compile(self, ChannelSpec* spec) except -1
+
 cdef class LeakChannel(Channel):
     cdef public double D
     pass
@@ -45,4 +71,4 @@ cdef class GPChannel(Channel):
     cpdef public gp
 
 cdef inline double sigma(double z): 1./(1+exp(-z))
-cdef inline double sigma_inv(double u): log(u/(1.0-u))
\ No newline at end of file
+cdef inline double sigma_inv(double u): log(u/(1.0-u))
@@ -1,10 +1,12 @@
-# distutils: extra_compile_args = -O3
+# distutils: extra_compile_args = -O3 -fopenmp
+# distutils: extra_link_args = -fopenmp
 # cython: wraparound=False
 # cython: boundscheck=False
 # cython: nonecheck=False
 # cython: cdivision=True
 
 from cython.parallel cimport prange
+from libc.math cimport fmin, fmax
 
 from component cimport Component
 from compartment cimport Compartment
@@ -12,6 +14,24 @@ from compartment cimport Compartment
 import numpy as np
 cimport numpy as np
 
+cdef inline void table_rates(ChannelSpec* spec, double V, double* rates, int R) noexcept nogil:
+    """
+    Linearly interpolate R rates at V from the channel's rate table. Each row
+    of the table holds the rates at the left edge of an interval followed by
+    their slopes.
+    """
+    cdef int i, r
+    cdef double* c
+    V = fmin(fmax(V, spec.V_min), spec.V_max) - spec.V_min
+    i = <int>(V / spec.dV)
+    if i > spec.G-2:
+        i = spec.G-2
+    V -= i * spec.dV
+
+    c = spec.coeffs + 2*R*i
+    for r in range(R):
+        rates[r] = c[r] + V * c[R+r]
+
 cdef class Channel(Component):
     """
     Abstract base class for an ion channel.
@@ -23,9 +43,59 @@ cdef class Channel(Component):
         # All channels (at least so far!) have a conductance and a reversal
         # potential
 
+        # By default, evaluate the analytic gating rates
+        self.rate_table = None
+
+    def use_rate_table(self, V_min=-100.0, V_max=100.0, dV=0.01):
+        """
+        Opt in to interpolating the gating rates from a table precomputed on
+        a voltage grid. Channels with voltage gated rates must implement
+        alpha_beta(V). Set rate_table to None to use the analytic rates again.
+
+        returns:
+        the RateTable, whose max_abs_error and max_rel_error report the
+        interpolation error of each rate.
+        """
+        if not hasattr(self, 'alpha_beta'):
+            raise Exception("Channel %s does not have voltage gated rates" % self.name)
+
+        from optofit.neuron.rate_table import RateTable
+        self.rate_table = RateTable(self.alpha_beta, V_min=V_min, V_max=V_max, dV=dV)
+        return self.rate_table
+
     cpdef double current(self, double[:,:,::1] x, double V, int t, int n):
         pass
 
+    cdef bint compile(self, ChannelSpec* spec) except -1:
+        """
+        Fill in a ChannelSpec for this channel. Returns False if the channel
+        has no nogil implementation, in which case compartments fall back to
+        calling current and kinetics with the GIL.
+        """
+        cdef double[:,::1] coeffs
+
+        spec.g = self.g
+        spec.E = self.E
+        spec.x_offset = self.x_offset
+        spec.current = NULL
+        spec.gates = NULL
+
+        # The rate table owns the coefficients, so they remain valid for
+        # as long as the table is set on this channel
+        spec.coeffs = NULL
+        if self.rate_table is not None:
+            coeffs = self.rate_table.coeffs
+            spec.coeffs = &coeffs[0,0]
+            spec.G = self.rate_table.G
+            spec.V_min = self.rate_table.V_min
+            spec.V_max = self.rate_table.V_max
+            spec.dV = self.rate_table.dV
+
+        return False
+
+cdef double leak_current(ChannelSpec* spec, double* x, double V) noexcept nogil:
+    return V - spec.E
+
 cdef class LeakChannel(Channel):
     """
     Passive leak channel.
@@ -45,6 +115,34 @@ cdef class LeakChannel(Channel):
         """
         return V - self.E
 
+    cdef bint compile(self, ChannelSpec* spec) except -1:
+        Channel.compile(self, spec)
+        spec.current = leak_current
+        return True
+
+cdef double na_current(ChannelSpec* spec, double* x, double V) noexcept nogil:
+    cdef double m = x[spec.x_offset]
+    cdef double h = x[spec.x_offset+1]
+    return m**3 * h * (V - spec.E)
+
+cdef void na_gates(ChannelSpec* spec, double* dxdt, double* x, double V) noexcept nogil:
+    cdef double m = x[spec.x_offset]
+    cdef double h = x[spec.x_offset+1]
+    cdef double rates[4]
+
+    # Compute the alpha and beta as a function of V
+    if spec.coeffs != NULL:
+        table_rates(spec, V, rates, 4)
+    else:
+        rates[0] = 0.1*(V+35.)/(1-exp(-(V+35.)/10.))
+        rates[1] = 4.*exp(-(V+65.)/18.)
+        rates[2] = 0.07*exp(-(V+50.)/20.)
+        rates[3] = 1./(exp(-(V+35.)/10.)+1.)
+
+    # Compute the channel state updates
+    dxdt[spec.x_offset+0] = rates[0]*(1.-m) - rates[1]*m
+    dxdt[spec.x_offset+1] = rates[2]*(1.-h) - rates[3]*h
+
 cdef class NaChannel(Channel):
     """
     Sodium channel.
@@ -77,6 +175,17 @@ cdef class NaChannel(Channel):
         x0[self.x_offset+0] = am1/(am1+bm1)
         x0[self.x_offset+1] = ah1/(ah1+bh1)
 
+    def alpha_beta(self, V):
+        """
+        Compute the alpha and beta for the m and h gates for an array of V.
+        This is used to build the rate table.
+        """
+        am1 = 0.1*(V+35.)/(1-np.exp(-(V+35.)/10.))
+        bm1 = 4.*np.exp(-(V+65.)/18.)
+        ah1 = 0.07*np.exp(-(V+50.)/20.)
+        bh1 = 1./(np.exp(-(V+35.)/10.)+1.)
+        return am1, bm1, ah1, bh1
+
     cpdef double current(self, double[:,:,::1] x, double V, int t, int n):
         """
         Evaluate the instantaneous current through this channel
@@ -85,54 +194,44 @@ cdef class NaChannel(Channel):
         cdef double h = x[t,n,self.x_offset+1]
         return m**3 * h * (V - self.E)
 
+    cdef bint compile(self, ChannelSpec* spec) except -1:
+        Channel.compile(self, spec)
+        spec.current = na_current
+        spec.gates = na_gates
+        return True
+
     cpdef kinetics(self, double[:,:,::1] dxdt, double[:,:,::1] x, double[:,::1] inpt, int[::1] ts):
-        cdef int T = x.shape[0]
         cdef int N = x.shape[1]
-        cdef int D = x.shape[2]
-        cdef int M = inpt.shape[1]
         cdef int S = ts.shape[0]
         cdef int n, s, t
-        cdef double am1, ah1, bm1, bh1
-
-        # Get a pointer to the voltage of the parent compartment
-        # TODO: This approach sucks b/c it assumes the voltage
-        # is the first compartment state. It should be faster than
-        # calling back into the parent to have it extract the voltage
-        # for us though.
-        # cdef double[:,:] V = x[:,:,self.parent_compartment.x_offset]
-        # cdef double[:,:] m = x[:,:,self.x_offset+0]
-        # cdef double[:,:] h = x[:,:,self.x_offset+1]
-        cdef double V, m, h
+        cdef int V_offset = self.parent_compartment.x_offset
+        cdef ChannelSpec spec
+        self.compile(&spec)
 
         with nogil:
-            for s in prange(S):
+            for s in range(S):
                 t = ts[s]
-                for n in prange(N):
-                    # # Compute the alpha and beta as a function of V
-                    # am1 = 0.1*(V[t,n]+35.)/(1-exp(-(V[t,n]+35.)/10.))
-                    # ah1 = 0.07*exp(-(V[t,n]+50.)/20.)
-                    #
-                    # bm1 = 4.*exp(-(V[t,n]+65.)/18.)
-                    # bh1 = 1./(exp(-(V[t,n]+35.)/10.)+1.)
-                    #
-                    # # Compute the channel state updates
-                    # dxdt[t,n,self.x_offset+0] = am1*(1.-m[t,n]) - bm1*m[t,n]
-                    # dxdt[t,n,self.x_offset+1] = ah1*(1.-h[t,n]) - bh1*h[t,n]
-
-                    # Compute the alpha and beta as a function of V
-                    V = x[t,n,self.parent_compartment.x_offset]
-                    m = x[t,n,self.x_offset]
-                    h = x[t,n,self.x_offset+1]
-                    am1 = 0.1*(V+35.)/(1-exp(-(V+35.)/10.))
-                    ah1 = 0.07*exp(-(V+50.)/20.)
-
-                    bm1 = 4.*exp(-(V+65.)/18.)
-                    bh1 = 1./(exp(-(V+35.)/10.)+1.)
-
-                    # Compute the channel state updates
-                    dxdt[t,n,self.x_offset+0] = am1*(1.-m) - bm1*m
-                    dxdt[t,n,self.x_offset+1] = ah1*(1.-h) - bh1*h
+                for n in prange(N, schedule='static'):
+                    na_gates(&spec, &dxdt[t,n,0], &x[t,n,0], x[t,n,V_offset])
+
+
+cdef double kdr_current(ChannelSpec* spec, double* x, double V) noexcept nogil:
+    cdef double nn = x[spec.x_offset]
+    return nn**4 * (V - spec.E)
+
+cdef void kdr_gates(ChannelSpec* spec, double* dxdt, double* x, double V) noexcept nogil:
+    cdef double nn = x[spec.x_offset]
+    cdef double rates[2]
 
+    # Compute the alpha and beta as a function of V
+    if spec.coeffs != NULL:
+        table_rates(spec, V, rates, 2)
+    else:
+        rates[0] = 0.01*(V+55.) /(1-exp(-(V+55.)/10.))
+        rates[1] = 0.125*exp(-(V+65.)/80.)
+
+    # Compute the channel state updates
+    dxdt[spec.x_offset] = rates[0]*(1.-nn) - rates[1]*nn
 
 cdef class KdrChannel(Channel):
     """
@@ -157,6 +256,15 @@ cdef class KdrChannel(Channel):
 
         x0[self.x_offset] = an1/(an1+bn1)
 
+    def alpha_beta(self, V):
+        """
+        Compute the alpha and beta for the n gate for an array of V.
+        This is used to build the rate table.
+        """
+        an1 = 0.01*(V+55.)/(1-np.exp(-(V+55.)/10.))
+        bn1 = 0.125*np.exp(-(V+65.)/80.)
+        return an1, bn1
+
     cpdef double current(self, double[:,:,::1] x, double V, int t, int n):
         """
         Evaluate the instantaneous current through this channel
@@ -164,40 +272,24 @@ cdef class KdrChannel(Channel):
         cdef double nn = x[t,n,self.x_offset]
         return nn**4 * (V - self.E)
 
+    cdef bint compile(self, ChannelSpec* spec) except -1:
+        Channel.compile(self, spec)
+        spec.current = kdr_current
+        spec.gates = kdr_gates
+        return True
+
     cpdef kinetics(self, double[:,:,::1] dxdt, double[:,:,::1] x, double[:,::1] inpt, int[::1] ts):
-        cdef int T = x.shape[0]
         cdef int N = x.shape[1]
-        cdef int D = x.shape[2]
-        cdef int M = inpt.shape[1]
         cdef int S = ts.shape[0]
         cdef int n, s, t
-        cdef double an1, bn1
-
-        # Get a pointer to the voltage of the parent compartment
-        # TODO: This approach sucks b/c it assumes the voltage
-        # is the first compartment state. It should be faster than
-        # calling back into the parent to have it extract the voltage
-        # for us though.
-        # cdef double[:,:] V = x[:,:,self.parent_compartment.x_offset]
-        # cdef double[:,:] nn = x[:,:,self.x_offset+0]
-
-        cdef double V, nn
+        cdef int V_offset = self.parent_compartment.x_offset
+        cdef ChannelSpec spec
+        self.compile(&spec)
 
         with nogil:
-            for s in prange(S):
+            for s in range(S):
                 t = ts[s]
-                for n in prange(N):
-                    V = x[t,n,self.parent_compartment.x_offset]
-                    nn = x[t,n,self.x_offset]
-
-                    # Compute the alpha and beta as a function of V
-                    an1 = 0.01*(V+55.) /(1-exp(-(V+55.)/10.))
-                    bn1 = 0.125*exp(-(V+65.)/80.)
-
-                    # Compute the channel state updates
-                    dxdt[t,n,self.x_offset] = an1*(1.-nn) - bn1*nn
-
+                for n in prange(N, schedule='static'):
+                    kdr_gates(&spec, &dxdt[t,n,0], &x[t,n,0], x[t,n,V_offset])
 
         return dxdt
-
-
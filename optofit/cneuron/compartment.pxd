@@ -10,6 +10,15 @@ cdef class Compartment(Component):
     cdef public double C
     cdef public double V0
 
+    # Optional per-particle conductances and injected currents for
+    # simulating a batch of neurons. See set_batch.
+    cdef double[:,::1] g_batch
+    cdef double[:,::1] inpt_batch
+    cdef bint batched_g
+    cdef bint batched_inpt
+
+    cdef check_batch(self, int T, int N)
+
 cdef class SquidCompartment(Compartment):
     """
     Special case compartment wiht leak, na, and kdr channels
@@ -1,19 +1,48 @@
-# distutils: extra_compile_args = -O3
+# distutils: extra_compile_args = -O3 -fopenmp
+# distutils: extra_link_args = -fopenmp
 # cython: wraparound=False
 # cython: boundscheck=False
 # cython: nonecheck=False
 # cython: cdivision=True
 
 from cython.parallel cimport prange
+from libc.stdlib cimport malloc, free
 
 from component cimport Component
 from component import Component
 
-from channels cimport Channel
+from channels cimport Channel, ChannelSpec
 
 import numpy as np
 from hips.inference.mh import mh
 
+cdef inline void compartment_kinetics(double* dxdt, double* x, double I_in, double C,
+                                      int x_offset, ChannelSpec* specs, int n_channels,
+                                      double* g) noexcept nogil:
+    """
+    Compute dV/dt and the gate kinetics of a single particle given
+    pointers to its rows of the dxdt and latent state buffers. If g is
+    not NULL it points to the particle's own channel conductances.
+    """
+    cdef int c
+    cdef double V = x[x_offset]
+    cdef double I_ionic = 0
+
+    # To compute dV/dt we need the ionic current in this compartment
+    for c in range(n_channels):
+        if g != NULL:
+            I_ionic += g[c] * specs[c].current(&specs[c], x, V)
+        else:
+            I_ionic += specs[c].g * specs[c].current(&specs[c], x, V)
+
+    # Add in driving current
+    dxdt[x_offset] = -1.0/C * I_ionic + 1.0/C * I_in
+
+    # Compute dxdt for each channel
+    for c in range(n_channels):
+        if specs[c].gates != NULL:
+            specs[c].gates(&specs[c], dxdt, x, V)
+
 cdef class Compartment(Component):
     """
     Simple compartment model with voltage
@@ -24,6 +53,8 @@ cdef class Compartment(Component):
         self.V0 = hypers['V0']
         self.n_x = 1
         self.n_i = 1
+        self.batched_g = False
+        self.batched_inpt = False
 
     def add_child(self, child):
         assert isinstance(child, Channel), "Child must also be a component!"
@@ -43,6 +74,39 @@ cdef class Compartment(Component):
         for child in self.children:
             child.steady_state(x0)
 
+    def set_batch(self, g=None, inpt=None):
+        """
+        Treat the particles of the latent state buffer as a batch of neurons
+        that share this compartment's channels but have their own channel
+        conductances and/or injected currents.
+
+        g:      N x C array of the conductances of each of the N particles'
+                channels, in the order of self.children, or None to use the
+                channels' own conductances
+        inpt:   T x N array of the current injected into each particle, or
+                None to use the compartment's column of the input buffer
+        """
+        if g is not None:
+            g = np.ascontiguousarray(g, dtype=np.float64)
+            if g.ndim != 2 or g.shape[1] != len(self.children):
+                raise Exception("Batch conductances must be N x %d" % len(self.children))
+            self.g_batch = g
+        self.batched_g = g is not None
+
+        if inpt is not None:
+            inpt = np.ascontiguousarray(inpt, dtype=np.float64)
+            if inpt.ndim != 2:
+                raise Exception("Batch input must be T x N")
+            self.inpt_batch = inpt
+        self.batched_inpt = inpt is not None
+
+    cdef check_batch(self, int T, int N):
+        if self.batched_g and self.g_batch.shape[0] != N:
+            raise Exception("Batch conductances are given for %d particles, not %d"
+                            % (self.g_batch.shape[0], N))
+        if self.batched_inpt and (self.inpt_batch.shape[0] < T or self.inpt_batch.shape[1] != N):
+            raise Exception("Batch input must be at least %d x %d" % (T, N))
+
     cpdef kinetics(self, double[:,:,::1] dxdt, double[:,:,::1] x, double[:,::1] inpt, int[::1] ts):
         cdef int T = x.shape[0]
         cdef int N = x.shape[1]
@@ -51,22 +115,48 @@ cdef class Compartment(Component):
         cdef int S = ts.shape[0]
         cdef int n, s, t
         cdef double V, dVdt
+        self.check_batch(T, N)
+
+        # Compile the channels into a C array of specs. If every channel has
+        # a nogil implementation we can compute the kinetics without the GIL.
+        cdef int C = len(self.children)
+        cdef ChannelSpec* specs = <ChannelSpec*> malloc(max(C,1) * sizeof(ChannelSpec))
+        cdef bint compiled = True
+        cdef int c_ind
+        try:
+            for c_ind in range(C):
+                compiled &= (<Channel> self.children[c_ind]).compile(&specs[c_ind])
+
+            if compiled:
+                with nogil:
+                    for s in range(S):
+                        t = ts[s]
+                        for n in prange(N, schedule='static'):
+                            compartment_kinetics(&dxdt[t,n,0], &x[t,n,0],
+                                                 self.inpt_batch[t,n] if self.batched_inpt else inpt[t,self.i_offset],
+                                                 self.C, self.x_offset, specs, C,
+                                                 &self.g_batch[n,0] if self.batched_g else NULL)
+                return
+        finally:
+            free(specs)
 
         # Compute the change in voltage for each time and particle
         # cdef double[:,:] dVdt = dxdt[:,:,self.x_offset]
 
-        # We need the GIL because we want to iterate over the children,
-        # which, in this generic case, are just a list of Python objects
-        # as far as the compiler knows. We can improve performance with
-        # special-cased compartments with specific channels
+        # Otherwise we need the GIL because we want to iterate over the
+        # children, which are just a list of Python objects as far as the
+        # compiler knows.
         for s in range(S):
             t = ts[s]
             for n in range(N):
                 # To compute dV/dt we need the ionic current in this compartment
                 V = x[t,n,self.x_offset]
                 I_ionic = 0
-                for c in self.children:
-                    I_ionic += c.g * c.current(x, V, t, n)
+                for c_ind, c in enumerate(self.children):
+                    if self.batched_g:
+                        I_ionic += self.g_batch[n,c_ind] * c.current(x, V, t, n)
+                    else:
+                        I_ionic += c.g * c.current(x, V, t, n)
                     # pass
 
                 # dVdt[t,n] = -1.0/self.C * I_ionic
@@ -77,7 +167,10 @@ cdef class Compartment(Component):
 
                 # Add in driving current
                 # dVdt[t,n] += 1.0/self.C * inpt[t,self.i_offset]
-                dVdt += 1.0/self.C * inpt[t,self.i_offset]
+                if self.batched_inpt:
+                    dVdt += 1.0/self.C * self.inpt_batch[t,n]
+                else:
+                    dVdt += 1.0/self.C * inpt[t,self.i_offset]
 
                 dxdt[t,n,self.x_offset] = dVdt
 
@@ -170,6 +263,8 @@ cdef class SquidCompartment(Compartment):
         self.V0 = hypers['V0']
         self.n_x = 1
         self.n_i = 1
+        self.batched_g = False
+        self.batched_inpt = False
 
         # Create the channels
         from channels import LeakChannel, NaChannel, KdrChannel
@@ -205,6 +300,7 @@ cdef class SquidCompartment(Compartment):
         cdef int S = ts.shape[0]
         cdef int n, s, t
         cdef double V, dVdt
+        self.check_batch(T, N)
 
         # Compute the change in voltage for each time and particle
         # cdef double[:,:] dVdt = dxdt[:,:,self.x_offset]
@@ -219,9 +315,14 @@ cdef class SquidCompartment(Compartment):
                 # To compute dV/dt we need the ionic current in this compartment
                 V = x[t,n,self.x_offset]
 
-                I_ionic = self.leak.g * self.leak.current(x, V, t, n)
-                I_ionic += self.na.g * self.na.current(x, V, t, n)
-                I_ionic += self.kdr.g * self.kdr.current(x, V, t, n)
+                if self.batched_g:
+                    I_ionic = self.g_batch[n,0] * self.leak.current(x, V, t, n)
+                    I_ionic += self.g_batch[n,1] * self.na.current(x, V, t, n)
+                    I_ionic += self.g_batch[n,2] * self.kdr.current(x, V, t, n)
+                else:
+                    I_ionic = self.leak.g * self.leak.current(x, V, t, n)
+                    I_ionic += self.na.g * self.na.current(x, V, t, n)
+                    I_ionic += self.kdr.g * self.kdr.current(x, V, t, n)
 
 
                 # dVdt[t,n] = -1.0/self.C * I_ionic
@@ -231,7 +332,10 @@ cdef class SquidCompartment(Compartment):
                 # dxdt['V'] += 1.0/self.neuron.C*self.neuron.W(k,:)*(V-Vk)
 
                 # Add in driving current
-                dVdt += 1.0/self.C * inpt[t,self.i_offset]
+                if self.batched_inpt:
+                    dVdt += 1.0/self.C * self.inpt_batch[t,n]
+                else:
+                    dVdt += 1.0/self.C * inpt[t,self.i_offset]
 
                 # Set dVdt in the output buffer
                 dxdt[t,n,self.x_offset] = dVdt
@@ -223,6 +223,19 @@ class GPChannel(Channel):
         for d in range(self.D):
             self.sigmas[d] = sigmas[self.x_offset+d]
 
+    def get_state(self):
+        """
+        The sampled function values at the inducing points and the noise
+        levels, for checkpointing
+        """
+        return {'hs' : np.array(self.hs), 'sigmas' : self.sigmas}
+
+    def set_state(self, state):
+        self.sigmas = state['sigmas'].copy()
+        for d in range(self.D):
+            self.hs[d] = state['hs'][d].copy()
+            self.gps[d] = SparseGPWithVariance(self.Z, self.hs[d], self.kernel, self.sigmas[d], num_inducing=100)
+
     def plot(self, ax=None, im=None, l=None, cmap=plt.cm.hot, data=[]):
         # if self.D > 1:
         #     print "Can only plot 1D GP models"
@@ -1,11 +1,14 @@
-# distutils: extra_compile_args = -O3
+# distutils: extra_compile_args = -O3 -fopenmp
+# distutils: extra_link_args = -fopenmp
 # cython: wraparound=False
 # cython: boundscheck=False
 # cython: nonecheck=False
 # cython: cdivision=True
 
 from component cimport Component
+from compartment cimport Compartment
 from cython.parallel import prange
+from libc.math cimport fabs, expm1, pow, INFINITY
 import numpy as np
 def simulate(model, t, stimuli, name=None, have_noise=True, I=None):
     """
@@ -100,6 +103,104 @@ def simulate(model, t, stimuli, name=None, have_noise=True, I=None):
 
 
 
+def simulate_ensemble(Compartment compartment, double[::1] ts, inpt=None, g=None, x0=None,
+                      chunk=None, integrator='forward_euler', **kwargs):
+    """
+    Simulate an ensemble of K neurons in lockstep with one of the
+    integrators, forward Euler by default. The neurons share the
+    compartment's channels, but each can have its own channel conductances
+    and injected current. The neurons are the particle axis of the latent
+    state buffer, so every step evaluates the kinetics of all K neurons in a
+    single parallel pass.
+
+    compartment:    root compartment of the model, shared by the neurons
+    ts:             T array of times
+    inpt:           T x K array of the current injected into each neuron, a
+                    T array of the current injected into all of them, or a
+                    SparseInput of the compartment's T x M input matrix,
+                    which is only materialized one chunk at a time
+    g:              K x C array of the conductances of each neuron's channels,
+                    in the order of compartment.children. By default, all
+                    neurons use the channels' own conductances.
+    x0:             K x D or D array of initial latent states. By default,
+                    the neurons start at the compartment's steady state.
+    chunk:          number of time steps to integrate at a time. Only the
+                    derivatives of one chunk are held in memory. By default,
+                    1000 for the fixed step integrators and the entire run
+                    for adaptive_rk, so that its steps are not cut short at
+                    the chunk boundaries. adaptive_rk carries its step size
+                    from one chunk to the next.
+    integrator:     name of the integrator in integrators, or a function
+                    with the same signature as forward_euler. Extra keyword
+                    arguments are passed on to it.
+
+    returns:
+    T x K x D array of the latent state trajectories
+    """
+    cdef int T = ts.shape[0]
+    D, M = compartment.initialize_offsets()
+
+    # Infer the number of neurons from the batched arguments
+    sizes = set()
+    if g is not None:
+        g = np.atleast_2d(g)
+        sizes.add(g.shape[0])
+    from optofit.simulation.stimulus import SparseInput
+    sparse = isinstance(inpt, SparseInput)
+    if inpt is not None and not sparse and np.ndim(inpt) == 2:
+        sizes.add(np.shape(inpt)[1])
+    if x0 is not None and np.ndim(x0) == 2:
+        sizes.add(np.shape(x0)[0])
+    if len(sizes) > 1:
+        raise Exception("Inconsistent ensemble sizes: %s" % sorted(sizes))
+    cdef int K = sizes.pop() if sizes else 1
+
+    if x0 is None:
+        x0 = np.zeros(D)
+        compartment.steady_state(x0)
+
+    x = np.zeros((T,K,D))
+    x[0] = x0
+
+    # The shared input buffer is only used by the compartment's children
+    shared_inpt = inpt if sparse else np.zeros((T,M))
+    batch_inpt = None
+    if inpt is not None and not sparse:
+        if np.ndim(inpt) == 2:
+            batch_inpt = inpt
+        else:
+            shared_inpt[:,compartment.i_offset] = inpt
+
+    if not callable(integrator):
+        integrator = integrators[integrator]
+    adaptive = integrator is adaptive_rk
+    if chunk is None:
+        chunk = max(T-1, 1) if adaptive else 1000
+
+    # Integrate one chunk of time steps at a time, reusing the derivative
+    # buffer. Consecutive chunks share their boundary time step.
+    dxdt = np.zeros((min(chunk,T-1)+1,K,D))
+    cdef int start, stop
+    try:
+        for start in range(0, T-1, chunk):
+            stop = min(start+chunk, T-1) + 1
+            if batch_inpt is not None:
+                compartment.set_batch(g=g, inpt=batch_inpt[start:stop])
+            else:
+                compartment.set_batch(g=g)
+            result = integrator(dxdt[:stop-start], x[start:stop],
+                                np.ascontiguousarray(shared_inpt[start:stop]),
+                                ts[start:stop], compartment, **kwargs)
+
+            # Start the next chunk with the last step size of this one
+            if adaptive:
+                kwargs['h0'] = result[2]
+    finally:
+        compartment.set_batch()
+
+    return x
+
+
 cpdef forward_euler(double[:,:,::1] dxdt,
                     double[:,:,::1] x,
                     double[:,::1] inpt,
@@ -123,8 +224,8 @@ cpdef forward_euler(double[:,:,::1] dxdt,
         # TODO: It would be nice to just copy this, but it seems like it won't work
         # x[ti,:,:] = x[ti-1,:,:] + dt * dxdt[ti,:,:]
         with nogil:
-            for n in prange(N):
-                for d in prange(D):
+            for n in prange(N, schedule='static'):
+                for d in range(D):
                     x[ti+1,n,d] = x[ti,n,d] + dt * dxdt[ti,n,d]
 
 
@@ -144,3 +245,301 @@ cpdef forward_euler(double[:,:,::1] dxdt,
         #                                  lb=noise_lb, ub=noise_ub)
         #     # import pdb; pdb.set_trace()
         #     z[:,ti] += noise
+
+
+cdef stage_kinetics(Component component, double[:,:,::1] dxdt, double[:,:,::1] x,
+                    double[:,::1] inpt, int t, double[:,::1] z, double[:,::1] k,
+                    double[:,::1] tmp):
+    """
+    Evaluate the kinetics at the intermediate states z with the input at
+    time index t, and put them in k. Row t of x is used as scratch space
+    and restored afterward, and row t of dxdt is overwritten.
+    """
+    cdef int[::1] tview = <int[:1]> &t
+    tmp[:,:] = x[t]
+    x[t,:,:] = z
+    component.kinetics(dxdt, x, inpt, tview)
+    k[:,:] = dxdt[t]
+    x[t,:,:] = tmp
+
+
+def diagonal_groups(Component component, int D):
+    """
+    Partition the latent state dimensions into groups that can be perturbed
+    together when estimating the diagonal of the Jacobian of the kinetics.
+    The voltages of the compartments form one group, and the i-th latent
+    variable of every channel forms group i+1. Channels only depend on the
+    voltage and their own latent variables, so perturbing a group changes
+    the kinetics of each of its dimensions only through that dimension.
+    """
+    groups = np.zeros(D, dtype=np.int32)
+    def _assign(c):
+        for i in range(c.n_x):
+            groups[c.x_offset+i] = 0 if isinstance(c, Compartment) else i+1
+        for child in c.children:
+            _assign(child)
+    _assign(component)
+    return groups
+
+
+cpdef exponential_euler(double[:,:,::1] dxdt,
+                        double[:,:,::1] x,
+                        double[:,::1] inpt,
+                        double[::1] ts,
+                        Component component):
+    """
+    Exponential Euler, i.e. the Rush-Larsen scheme. Each dimension is
+    advanced with the exact solution of its kinetics linearized about the
+    current state,
+
+        x[t+1] = x[t] + (exp(a*dt) - 1) / a * dx/dt,
+
+    where a = d(dx/dt)/dx is the diagonal of the Jacobian. For Hodgkin
+    Huxley gates the kinetics are linear in the gate, so this is exact for
+    a frozen voltage and the gates stay in [0,1] for any step size. The
+    diagonal is estimated by finite differences, perturbing one group of
+    dimensions at a time (see diagonal_groups).
+    """
+    cdef int T = x.shape[0]
+    cdef int N = x.shape[1]
+    cdef int D = x.shape[2]
+    cdef int ti, n, d, g
+    cdef double dt, z
+    cdef int[::1] tview = <int[:1]> &ti
+
+    cdef int[::1] groups = diagonal_groups(component, D)
+    cdef int G = np.max(groups) + 1
+    cdef double[:,::1] x0 = np.zeros((N,D))
+    cdef double[:,::1] k0 = np.zeros((N,D))
+    cdef double[:,::1] eps = np.zeros((N,D))
+    cdef double[:,::1] a = np.zeros((N,D))
+
+    for ti in range(T-1):
+        dt = ts[ti+1]-ts[ti]
+        component.kinetics(dxdt, x, inpt, tview)
+        x0[:,:] = x[ti]
+        k0[:,:] = dxdt[ti]
+
+        # Estimate the diagonal of the Jacobian one group at a time
+        for g in range(G):
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        if groups[d] == g:
+                            eps[n,d] = 1e-7 * max(1.0, fabs(x0[n,d]))
+                            x[ti,n,d] = x0[n,d] + eps[n,d]
+                        else:
+                            x[ti,n,d] = x0[n,d]
+
+            component.kinetics(dxdt, x, inpt, tview)
+
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        if groups[d] == g:
+                            a[n,d] = (dxdt[ti,n,d] - k0[n,d]) / eps[n,d]
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                for d in range(D):
+                    z = a[n,d] * dt
+                    x[ti,n,d] = x0[n,d]
+                    dxdt[ti,n,d] = k0[n,d]
+                    if fabs(z) < 1e-8:
+                        x[ti+1,n,d] = x0[n,d] + dt * k0[n,d]
+                    else:
+                        x[ti+1,n,d] = x0[n,d] + expm1(z) / a[n,d] * k0[n,d]
+
+
+cpdef rk4(double[:,:,::1] dxdt,
+          double[:,:,::1] x,
+          double[:,::1] inpt,
+          double[::1] ts,
+          Component component):
+    """
+    Classical fourth order Runge-Kutta. The input is held constant over
+    each time step, as in forward_euler.
+    """
+    cdef int T = x.shape[0]
+    cdef int N = x.shape[1]
+    cdef int D = x.shape[2]
+    cdef int ti, n, d, s
+    cdef double dt
+    cdef int[::1] tview = <int[:1]> &ti
+
+    cdef double[:,::1] x0 = np.zeros((N,D))
+    cdef double[:,::1] k0 = np.zeros((N,D))
+    cdef double[:,::1] acc = np.zeros((N,D))
+
+    # Weights of the stages in the intermediate states and the update
+    cdef double[3] c = [0.5, 0.5, 1.0]
+    cdef double[3] w = [2.0, 2.0, 1.0]
+
+    for ti in range(T-1):
+        dt = ts[ti+1]-ts[ti]
+        component.kinetics(dxdt, x, inpt, tview)
+        x0[:,:] = x[ti]
+        k0[:,:] = dxdt[ti]
+        acc[:,:] = dxdt[ti]
+
+        # Evaluate the stages in row ti of x and dxdt
+        for s in range(3):
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        x[ti,n,d] = x0[n,d] + c[s] * dt * dxdt[ti,n,d]
+
+            component.kinetics(dxdt, x, inpt, tview)
+
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        acc[n,d] += w[s] * dxdt[ti,n,d]
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                for d in range(D):
+                    x[ti,n,d] = x0[n,d]
+                    dxdt[ti,n,d] = k0[n,d]
+                    x[ti+1,n,d] = x0[n,d] + dt / 6.0 * acc[n,d]
+
+
+cdef inline int grid_index(double[::1] ts, double t, int i):
+    # Index of the last grid time at or before t, searching forward from i
+    cdef int T = ts.shape[0]
+    while i+1 < T and ts[i+1] <= t:
+        i += 1
+    return i
+
+
+def adaptive_rk(double[:,:,::1] dxdt,
+                double[:,:,::1] x,
+                double[:,::1] inpt,
+                double[::1] ts,
+                Component component,
+                double rtol=1e-4,
+                double atol=1e-6,
+                double h_max=np.inf,
+                h0=None):
+    """
+    Adaptive Bogacki-Shampine 3(2) Runge-Kutta. The step size is chosen to
+    keep the embedded error estimate below atol + rtol*|x| in every
+    dimension of every particle, so the solver takes long steps while the
+    neurons are quiescent and short steps during spikes, regardless of the
+    spacing of ts. The solution is written to x at the times ts with cubic
+    Hermite interpolation of the steps. The input is held constant between
+    the times ts, as in forward_euler. All particles share the same steps.
+
+    The rows of dxdt are used as scratch space.
+
+    h0 is the initial step size, by default the first grid interval.
+
+    returns:
+    the number of accepted and rejected steps, and the step size to
+    continue the integration with, e.g. from the end of ts in the next call
+    """
+    cdef int T = x.shape[0]
+    cdef int N = x.shape[1]
+    cdef int D = x.shape[2]
+    cdef int n, d, i, j
+    cdef int n_accept = 0
+    cdef int n_reject = 0
+    cdef double t, h, h_next, t_end, err, sc, e, theta, h00, h10, h01, h11
+
+    cdef double[:,::1] y = np.array(x[0])
+    cdef double[:,::1] y_new = np.zeros((N,D))
+    cdef double[:,::1] z = np.zeros((N,D))
+    cdef double[:,::1] k1 = np.zeros((N,D))
+    cdef double[:,::1] k2 = np.zeros((N,D))
+    cdef double[:,::1] k3 = np.zeros((N,D))
+    cdef double[:,::1] k4 = np.zeros((N,D))
+    cdef double[:,::1] tmp = np.zeros((N,D))
+
+    if T < 2:
+        return n_accept, n_reject, h0
+
+    t = ts[0]
+    t_end = ts[T-1]
+    # h_next is the step size chosen by the error control, and h the step
+    # actually taken, which may be cut short by h_max or the end of ts
+    h_next = ts[1] - ts[0] if h0 is None else h0
+    i = 0
+    j = 0
+    stage_kinetics(component, dxdt, x, inpt, 0, y, k1, tmp)
+
+    while i < T-1:
+        h = min(h_next, h_max, t_end - t)
+        if h <= 1e-12 * max(1.0, fabs(t)):
+            raise Exception("Step size underflow at t=%f" % t)
+
+        # Evaluate the stages, holding the input of the grid interval
+        # that each stage falls in
+        with nogil:
+            for n in prange(N, schedule='static'):
+                for d in range(D):
+                    z[n,d] = y[n,d] + 0.5 * h * k1[n,d]
+        j = grid_index(ts, t + 0.5 * h, i)
+        stage_kinetics(component, dxdt, x, inpt, j, z, k2, tmp)
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                for d in range(D):
+                    z[n,d] = y[n,d] + 0.75 * h * k2[n,d]
+        j = grid_index(ts, t + 0.75 * h, j)
+        stage_kinetics(component, dxdt, x, inpt, j, z, k3, tmp)
+
+        with nogil:
+            for n in prange(N, schedule='static'):
+                for d in range(D):
+                    y_new[n,d] = y[n,d] + h * (2.0/9.0 * k1[n,d] + 1.0/3.0 * k2[n,d]
+                                               + 4.0/9.0 * k3[n,d])
+        j = grid_index(ts, t + h, j)
+        stage_kinetics(component, dxdt, x, inpt, j, y_new, k4, tmp)
+
+        # Maximum scaled error over all particles and dimensions
+        err = 0
+        for n in range(N):
+            for d in range(D):
+                e = h * (-5.0/72.0 * k1[n,d] + 1.0/12.0 * k2[n,d]
+                         + 1.0/9.0 * k3[n,d] - 1.0/8.0 * k4[n,d])
+                sc = atol + rtol * max(fabs(y[n,d]), fabs(y_new[n,d]))
+                err = max(err, fabs(e) / sc)
+
+        if not err <= 1.0:
+            n_reject += 1
+            h_next = h * (max(0.2, 0.9 * pow(err, -1.0/3.0)) if err < INFINITY else 0.2)
+            continue
+
+        # Interpolate the accepted step at the grid times it covers
+        while i < T-1 and ts[i+1] <= t + h:
+            i += 1
+            theta = (ts[i] - t) / h
+            h00 = (1 + 2*theta) * (1 - theta)**2
+            h10 = theta * (1 - theta)**2
+            h01 = theta**2 * (3 - 2*theta)
+            h11 = theta**2 * (theta - 1)
+            with nogil:
+                for n in prange(N, schedule='static'):
+                    for d in range(D):
+                        x[i,n,d] = h00 * y[n,d] + h10 * h * k1[n,d] \
+                                   + h01 * y_new[n,d] + h11 * h * k4[n,d]
+
+        # The last stage is the first stage of the next step
+        n_accept += 1
+        t += h
+        y[:,:] = y_new
+        k1[:,:] = k4
+
+        # A step cut short does not limit the next one
+        h_next = max(h_next if h < h_next else 0.0,
+                     h * (min(5.0, 0.9 * pow(err, -1.0/3.0)) if err > 0 else 5.0))
+
+    return n_accept, n_reject, h_next
+
+
+# Integrators by name. Each integrates the trajectories in x from their
+# initial states x[0] given the same buffers as forward_euler.
+integrators = {'forward_euler'      : forward_euler,
+               'exponential_euler'  : exponential_euler,
+               'rk4'                : rk4,
+               'adaptive_rk'        : adaptive_rk}
@@ -0,0 +1,115 @@
+"""
+Pruned storage of the particle genealogy.
+
+A particle filter run for T steps with Np particles only has to remember the
+lineages that still have descendants among the current particles. Following
+Jacob, Murray and Rubenthaler (2015), "Path storage in the particle filter",
+we store the particles as nodes of a tree and free the nodes of a lineage as
+soon as it dies out. The expected number of live nodes is T + O(Np log Np),
+rather than the Np x T of the full particle history.
+"""
+import numpy as np
+
+class AncestryTree(object):
+    """
+    Tree of particle lineages. Each node stores one particle's D dimensional
+    state and the index of its parent's node.
+    """
+    def __init__(self, Np, D, capacity=None):
+        self.Np = Np
+        self.D = D
+
+        if capacity is None:
+            capacity = 4 * Np
+
+        self.x = np.zeros((capacity, D))
+        self.parent = -np.ones(capacity, dtype=np.intp)
+        self.children = np.zeros(capacity, dtype=np.intp)
+
+        # Stack of unused nodes
+        self.free = np.arange(capacity, dtype=np.intp)[::-1].copy()
+        self.n_free = capacity
+
+        # Nodes of the current generation and the number of generations
+        self.leaves = None
+        self.T = 0
+
+    @property
+    def capacity(self):
+        return self.x.shape[0]
+
+    @property
+    def size(self):
+        """
+        Number of nodes currently in use
+        """
+        return self.capacity - self.n_free
+
+    def _grow(self, capacity):
+        old = self.capacity
+        self.x = np.concatenate((self.x, np.zeros((capacity - old, self.D))))
+        self.parent = np.concatenate((self.parent, -np.ones(capacity - old, dtype=np.intp)))
+        self.children = np.concatenate((self.children, np.zeros(capacity - old, dtype=np.intp)))
+
+        # Put the new nodes on the bottom of the free stack
+        free = np.empty(capacity, dtype=np.intp)
+        free[:capacity - old] = np.arange(old, capacity)[::-1]
+        free[capacity - old:capacity - old + self.n_free] = self.free[:self.n_free]
+        self.free = free
+        self.n_free += capacity - old
+
+    def _allocate(self, num):
+        if self.n_free < num:
+            self._grow(max(2 * self.capacity, self.size + num))
+        self.n_free -= num
+        return self.free[self.n_free:self.n_free + num].copy()
+
+    def _release(self, nodes):
+        self.free[self.n_free:self.n_free + nodes.size] = nodes
+        self.n_free += nodes.size
+
+    def extend(self, particles, ancestors=None):
+        """
+        Add a generation of particles to the tree.
+
+        particles:  Np x D array of the new particles
+        ancestors:  Np array of the indices of the new particles' parents
+                    in the previous generation. None for the first generation.
+        """
+        nodes = self._allocate(self.Np)
+        self.x[nodes] = particles
+        self.children[nodes] = 0
+
+        if ancestors is None:
+            assert self.leaves is None, "Only the first generation has no ancestors"
+            self.parent[nodes] = -1
+        else:
+            prev = self.leaves
+            self.parent[nodes] = prev[ancestors]
+            self.children[prev] += np.bincount(ancestors, minlength=self.Np)
+
+            # Prune the lineages of the previous particles without offspring
+            dead = prev[self.children[prev] == 0]
+            while dead.size > 0:
+                self._release(dead)
+                parents = self.parent[dead]
+                parents, counts = np.unique(parents[parents >= 0], return_counts=True)
+                self.children[parents] -= counts
+                dead = parents[self.children[parents] == 0]
+
+        self.leaves = nodes
+        self.T += 1
+
+    def trajectory(self, i):
+        """
+        Trace back the lineage of the i-th particle of the current generation.
+
+        returns:
+        T x D array of the particle's ancestors' states
+        """
+        x = np.zeros((self.T, self.D))
+        node = self.leaves[i]
+        for t in np.arange(self.T)[::-1]:
+            x[t] = self.x[node]
+            node = self.parent[node]
+        return x
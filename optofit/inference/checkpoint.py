@@ -0,0 +1,114 @@
+"""
+Checkpoints for long MCMC runs.
+
+A checkpoint holds everything needed to continue a chain exactly where it
+left off: the iteration, the model's parameters and latent states, numpy's
+random state, and the state of any object that implements the checkpoint
+protocol, i.e. has methods
+
+    get_state():        return a dict of numpy arrays
+    set_state(state):   restore the object from such a dict
+
+This includes updates with adaptation state, like the step sizes of
+HmcConductanceUpdate, and channels with their own random functions, like the
+inducing point values of GPChannel.
+"""
+import os
+import numpy as np
+
+from optofit.inference.sample_store import model_parameters
+
+def _model_objects(model):
+    # Components of the model that implement the checkpoint protocol
+    objects = {}
+    for neuron in model.population.neurons:
+        for compartment in neuron.compartments:
+            for channel in compartment.channels:
+                if hasattr(channel, 'get_state'):
+                    objects['/'.join(channel.path)] = channel
+    return objects
+
+def save_checkpoint(filename, iteration, model=None, objects=None, arrays=None):
+    """
+    Save a checkpoint. The file is written to a temporary file first and then
+    moved into place, so an interrupted save never clobbers the last checkpoint.
+
+    filename:   checkpoint file, conventionally ending in .npz
+    iteration:  the last completed iteration
+    model:      optional model whose parameters and latent states to save
+    objects:    optional dict of named objects implementing get_state
+    arrays:     optional dict of extra named arrays, e.g. the samples so far
+    """
+    data = {'iteration': np.array(iteration)}
+
+    # Save numpy's random state
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    data['rng/keys'] = keys
+    data['rng/pos'] = np.array(pos)
+    data['rng/has_gauss'] = np.array(has_gauss)
+    data['rng/cached_gaussian'] = np.array(cached_gaussian)
+
+    objects = dict(objects) if objects is not None else {}
+    if model is not None:
+        for name, param in model_parameters(model):
+            data['param/' + name] = np.asarray(param.value)
+
+        # Store the latent states and states as flat matrices
+        layout = model.population.layout
+        for k, ds in enumerate(model.data_sequences):
+            data['latent/%d' % k] = layout.flatten_latent(ds.latent)
+            data['states/%d' % k] = layout.flatten_state(ds.states)
+
+        objects.update(_model_objects(model))
+
+    for name, obj in objects.items():
+        for key, value in obj.get_state().items():
+            data['object/%s/%s' % (name, key)] = np.asarray(value)
+
+    if arrays is not None:
+        for key, value in arrays.items():
+            data['array/' + key] = np.asarray(value)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **data)
+    os.rename(tmp, filename)
+
+def load_checkpoint(filename, model=None, objects=None):
+    """
+    Restore a checkpoint saved by save_checkpoint into the given model and
+    objects, and restore numpy's random state.
+
+    returns:
+    iteration:  the last completed iteration
+    arrays:     dict of the extra arrays that were saved
+    """
+    f = np.load(filename)
+    data = dict((key, f[key]) for key in f.files)
+    f.close()
+
+    objects = dict(objects) if objects is not None else {}
+    if model is not None:
+        for name, param in model_parameters(model):
+            param._value = data['param/' + name].copy()
+
+        layout = model.population.layout
+        for k, ds in enumerate(model.data_sequences):
+            ds.latent = layout.as_latent(data['latent/%d' % k])
+            ds.states = layout.as_state(data['states/%d' % k])
+
+        objects.update(_model_objects(model))
+
+    for name, obj in objects.items():
+        prefix = 'object/%s/' % name
+        obj.set_state(dict((key[len(prefix):], value) for key, value in data.items()
+                           if key.startswith(prefix)))
+
+    arrays = dict((key[len('array/'):], value) for key, value in data.items()
+                  if key.startswith('array/'))
+
+    # Restore the random state last, in case restoring the objects used it
+    np.random.set_state(('MT19937', data['rng/keys'], int(data['rng/pos']),
+                         int(data['rng/has_gauss']), float(data['rng/cached_gaussian'])))
+
+    return int(data['iteration']), arrays
@@ -0,0 +1,75 @@
+"""
+Convergence diagnostics for multiple MCMC chains of a scalar quantity,
+following Gelman et al. (2013), Bayesian Data Analysis, 3rd ed, Sec. 11.4-11.5.
+"""
+import numpy as np
+
+def _split_chains(x):
+    """
+    Split each of the M chains in half to get 2M chains of length N/2, so that
+    R-hat also detects nonstationarity within a chain.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    n = x.shape[1] // 2
+    return np.vstack((x[:, :n], x[:, x.shape[1]-n:]))
+
+def _variances(x):
+    M, N = x.shape
+    W = x.var(axis=1, ddof=1).mean()
+    B = N * x.mean(axis=1).var(ddof=1)
+    var_plus = (N - 1.0) / N * W + B / N
+    return W, var_plus
+
+def split_rhat(x):
+    """
+    Potential scale reduction factor of the M x N array of samples x, with
+    one row per chain. Values near 1 indicate that the chains have mixed.
+    """
+    x = _split_chains(x)
+    if x.shape[1] < 2:
+        return np.inf
+
+    W, var_plus = _variances(x)
+    if W == 0:
+        return 1.0 if var_plus == 0 else np.inf
+    return np.sqrt(var_plus / W)
+
+def _autocovariance(x):
+    """
+    Autocovariance of each row of x at lags 0..N-1, computed with the FFT
+    """
+    M, N = x.shape
+    nfft = 2 ** int(np.ceil(np.log2(2 * N)))
+    xc = x - x.mean(axis=1)[:, None]
+    f = np.fft.rfft(xc, n=nfft, axis=1)
+    return np.fft.irfft(f * np.conj(f), n=nfft, axis=1)[:, :N] / N
+
+def effective_sample_size(x):
+    """
+    Effective number of independent samples in the M x N array of samples x,
+    combining the autocorrelations of the chains with Geyer's initial
+    monotone sequence estimator.
+    """
+    x = _split_chains(x)
+    M, N = x.shape
+    if N < 4:
+        return 0.0
+
+    W, var_plus = _variances(x)
+    if var_plus == 0:
+        return float(M * N)
+
+    # Combined autocorrelation estimate of the chains
+    rho = 1.0 - (W - _autocovariance(x).mean(axis=0)) / var_plus
+    rho[0] = 1.0
+
+    # Sum the autocorrelations in pairs until the pair sums become negative,
+    # forcing them to be monotonically decreasing
+    pairs = rho[:N - N % 2].reshape((-1, 2)).sum(axis=1)
+    negative = np.nonzero(pairs < 0)[0]
+    if negative.size > 0:
+        pairs = pairs[:negative[0]]
+    pairs = np.minimum.accumulate(pairs)
+
+    tau = -1.0 + 2.0 * pairs.sum()
+    return M * N / max(tau, 1.0 / np.log10(M * N))
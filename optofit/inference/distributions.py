@@ -165,7 +165,20 @@ class TruncatedGaussianDistribution(Distribution):
     """
     Truncated Gaussian proposal distribution with data-dependent
     parameters.
+
+    Sampling by inverting the CDF loses all precision when the interval is
+    far in a tail of the Gaussian, e.g. for gating variables close to 0 or 1,
+    where the CDF at both bounds rounds to the same value. Instead, we
+    reflect the interval so that it is either around the mean or in the upper
+    tail. Around the mean and in the near tail, we invert the upper tail
+    probability, which keeps its precision there. Further out, we use
+    rejection sampling with a truncated exponential proposal (Robert, 1995,
+    "Simulation of truncated normal variables"). The normalization constant
+    is computed in log space for the same reason.
     """
+    # Beyond this many standard deviations, use rejection sampling
+    tail = 3.0
+
     def __init__(self):
         """
         Initialize the Gaussian proposal with a covariance
@@ -177,38 +190,99 @@ class TruncatedGaussianDistribution(Distribution):
         z = (x-mu)/sigma
         return 0.5 * scipy.special.erfc(-z / np.sqrt(2))
 
+    @staticmethod
+    def _reflect(a, b):
+        """
+        Reflect the standardized intervals [a,b] that lie entirely below zero,
+        so that all intervals either contain zero or have a > 0. Return the
+        reflected bounds and the sign to multiply the samples by, or None if
+        no interval was reflected.
+        """
+        flip = b < 0
+        if not np.any(flip):
+            return a, b, None
+        return np.where(flip, -b, a), np.where(flip, -a, b), np.where(flip, -1.0, 1.0)
+
+    @classmethod
+    def _sample_standard(cls, a, b):
+        """
+        Sample standard normals truncated to [a,b], where the arrays a and b
+        have been reflected so that b >= 0.
+        """
+        near = a < cls.tail
+        if np.all(near):
+            # Invert the upper tail probability, which keeps its relative
+            # precision for a > 0
+            qa = scipy.special.ndtr(-a)
+            qb = scipy.special.ndtr(-b)
+            u = np.random.rand(*np.broadcast(a, b).shape)
+            z = -scipy.special.ndtri(qa - u * (qa - qb))
+            return np.clip(z, a, b)
+
+        a, b, near = np.broadcast_arrays(a, b, near)
+        z = np.empty(a.shape)
+        z[near] = cls._sample_standard(a[near], b[near])
+
+        # Rejection sampling from a truncated exponential proposal with the
+        # optimal rate
+        far = np.nonzero(~near)
+        a, b = a[far], b[far]
+        lam = 0.5 * (a + np.sqrt(a**2 + 4.0))
+        scale = -np.expm1(-lam * (b - a))
+        x = np.empty(a.shape)
+        todo = np.arange(a.size)
+        while todo.size > 0:
+            u = np.random.rand(todo.size)
+            x[todo] = a[todo] - np.log1p(-u * scale[todo]) / lam[todo]
+            reject = np.random.rand(todo.size) >= np.exp(-0.5 * (x[todo] - lam[todo])**2)
+            todo = todo[reject]
+
+        # Guard against round off at the bounds
+        z[far] = np.clip(x, a, b)
+        return z
+
     def sample(self, mu=0, sigma=1, lb=-np.Inf, ub=np.Inf):
         """ Sample a truncated normal with the specified params
         """
         if np.allclose(sigma, 0.0):
             return mu
 
-        cdflb = self.normal_cdf(lb, mu, sigma)
-        cdfub = self.normal_cdf(ub, mu, sigma)
-
-        # Sample uniformly from the CDF
-        cdfsamples = cdflb + np.random.rand(*mu.shape)*(cdfub-cdflb)
-        zs = -np.sqrt(2)*scipy.special.erfcinv(2*cdfsamples)
-        rvs = sigma * zs + mu
-
-        # Test
-        pint = cdfub - cdflb
-
-        # logp = -np.Inf * (x < lb) + -np.Inf * (x > ub)
-        # logp = norm.logpdf(x, loc=mu, scale=sigma) - np.log(pint)
-        # logp[x<lb] = -np.Inf
-        # logp[x>ub] = -np.Inf
-
-        # p(x) = \frac{1}{\sqrt{2*pi*sigma^2}}  \exp{-\frac{1}{\sqrt{2} \sigma^2} (x-mu)^2}
-        # logp = -0.5*np.log(2*np.pi) -np.log(sigma) - 0.5/sigma**2 * (rvs-mu)**2
-        # logp -= np.log(pint)
-        # logp[rvs<lb] = -np.Inf
-        # logp[rvs>ub] = -np.Inf
-
-
-        # check_bounds(rvs, lb, ub)
+        sigma = np.asarray(sigma, dtype=np.float64)
+        if np.all(sigma > 0):
+            a, b, sign = self._reflect((lb - mu) / sigma, (ub - mu) / sigma)
+            z = self._sample_standard(a, b)
+            if sign is not None:
+                z *= sign
+            return mu + sigma * z
+
+        # Zero variance dimensions stay at the (clipped) mean
+        mu, sigma, lb, ub = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64)
+                                                  for v in (mu, sigma, lb, ub)])
+        rvs = np.clip(mu, lb, ub)
+        noisy = sigma > 0
+        rvs[noisy] = self.sample(mu[noisy], sigma[noisy], lb[noisy], ub[noisy])
         return rvs
 
+    def log_normalizer(self, mu=0, sigma=1, lb=-np.Inf, ub=np.Inf):
+        """
+        Log of the probability mass of N(mu, sigma^2) in [lb, ub]. In the far
+        tail, this is computed from the log of the upper tail probabilities so
+        that it does not underflow.
+        """
+        a, b, _ = self._reflect((lb - mu) / sigma, (ub - mu) / sigma)
+        near = a < self.tail
+        with np.errstate(divide='ignore'):
+            if np.all(near):
+                return np.log(scipy.special.ndtr(-a) - scipy.special.ndtr(-b))
+
+            a, b, near = np.broadcast_arrays(a, b, near)
+            log_Z = np.empty(a.shape)
+            log_Z[near] = np.log(scipy.special.ndtr(-a[near]) - scipy.special.ndtr(-b[near]))
+            log_qa = scipy.special.log_ndtr(-a[~near])
+            log_qb = scipy.special.log_ndtr(-b[~near])
+            log_Z[~near] = log_qa + np.log1p(-np.exp(log_qb - log_qa))
+        return log_Z
+
     def logp(self, x, mu=0, sigma=1, lb=-np.Inf, ub=np.Inf):
         """ Compute the log probability of the state given the previous state
         """
@@ -218,35 +292,12 @@ class TruncatedGaussianDistribution(Distribution):
             else:
                 return -np.Inf
 
-        # Compute the probability mass in the interval
-        # from scipy.stats import norm
-        # cdflb = norm.cdf(lb, loc=mu, scale=sigma)
-        # cdfub = norm.cdf(ub, loc=mu, scale=sigma)
-        cdflb = self.normal_cdf(lb, mu, sigma)
-        cdfub = self.normal_cdf(ub, mu, sigma)
-        # print "WARNING DEBUG TRUNC NORMAL"
-        # cdflb = 0
-        # cdfub = 1
-        pint = cdfub - cdflb
-
-        # logp = -np.Inf * (x < lb) + -np.Inf * (x > ub)
-        # logp = norm.logpdf(x, loc=mu, scale=sigma) - np.log(pint)
-        # logp[x<lb] = -np.Inf
-        # logp[x>ub] = -np.Inf
-
         # p(x) = \frac{1}{\sqrt{2*pi*sigma^2}}  \exp{-\frac{1}{\sqrt{2} \sigma^2} (x-mu)^2}
         logp = -0.5*np.log(2*np.pi) -np.log(sigma) - 0.5/sigma**2 * (x-mu)**2
-        logp -= np.log(pint)
+        logp -= self.log_normalizer(mu, sigma, lb, ub)
         logp[x<lb] = -np.Inf
         logp[x>ub] = -np.Inf
 
-
-        """
-        assert np.all(np.isfinite(x)), np.sum(np.isfinite(x).astype(np.int32))
-        assert np.all(x>=lb), "ERROR: Querying below lb"
-        assert np.all(x<=ub), "ERROR: Querying above ub"
-        """
-        # check_bounds(x, lb, ub)
         return logp
 
 
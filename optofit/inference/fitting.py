@@ -1,62 +1,294 @@
 """
 Holds the overall fitting code.
 """
-import copy
 import numpy as np
 
-from mcmc_transitions import initialize_updates
+from mcmc_transitions import initialize_updates, ConductanceUpdate, SigmaTransitionUpdate
+from optofit.inference.checkpoint import save_checkpoint, load_checkpoint
+from optofit.inference.diagnostics import split_rhat, effective_sample_size
+from optofit.inference.distributions import DeltaFunction
+from optofit.inference.sample_store import SampleStore
+from optofit.inference.statistics_cache import StatisticsCache
+from optofit.models.hyperparameters import hypers
 from optofit.simulation.simulate import simulate
 from optofit.utils.utils import as_matrix
 
-def fit_mcmc(model, N_samples=1000, callback=None, print_interval=1, geweke=False):
+def fit_mcmc(model, N_samples=1000, callback=None, print_interval=1, geweke=False,
+             store=None, latent_thin=None, checkpoint=None, checkpoint_interval=100,
+             resume=False):
     """
-    Fit the parameters of hte model with MCMC
+    Fit the parameters of hte model with MCMC. The model is updated in place
+    and each sample is recorded in a SampleStore, so the cost per iteration
+    does not grow with the length of the data.
 
     :param model:
-    :param data:
-    :return:
+    :param store: SampleStore to record the samples in. By default, keep the
+                  parameters of every sample in memory.
+                  Pass a DiskSampleStore to stream long chains to disk.
+    :param latent_thin: If no store is given, also keep the latent states
+                  every latent_thin iterations. By default they are not kept.
+    :param checkpoint: File to save a checkpoint to every checkpoint_interval
+                  iterations, or None to not save checkpoints.
+    :param resume: Continue the chain from the checkpoint rather than from a
+                  sample from the prior. The store should hold the samples
+                  up to the checkpoint, e.g. a DiskSampleStore opened with
+                  append=True; any samples recorded after it are discarded.
+    :return: the sample store. Indexing it reconstructs the model at each
+             iteration, and its last item is the live model.
     """
     # Get a list of MCMC updates for the model
     updates = initialize_updates(model, geweke)
 
-    # Sample an initial state of the model from the prior
-    samples = []
+    # Updates that carry state from one iteration to the next, like adapted
+    # step sizes, are saved with the checkpoint
+    objects = dict(('update_%d' % j, update) for j, update in enumerate(updates)
+                   if hasattr(update, 'get_state'))
+
+    if store is None:
+        store = SampleStore(model, latent_thin=latent_thin)
 
-    initialize_model(model)
-    samples.append(model)
+    # Share the statistics of the latent trajectories between the updates
+    cache = StatisticsCache(model)
+
+    if resume:
+        start, _ = load_checkpoint(checkpoint, model, objects)
+        start += 1
+        store.truncate(start)
+    else:
+        # Sample an initial state of the model from the prior
+        initialize_model(model)
+        store.record()
+        start = 1
 
     # Collect samples
-    for i in range(1,N_samples):
+    for i in range(start,N_samples):
         if np.mod(i, print_interval) == 0:
             print "Iteration: %d" % i
-        curr_model = copy.deepcopy(samples[i-1])
 
         # Call the callback
         if callback is not None:
             try:
-                callback(curr_model)
+                callback(model)
             except Exception as e:
                 print "WARNING: Caught exception during callback:"
                 print e
 
         # Go through each update
         for update in updates:
-            update.update(curr_model)
-
-        # Debug:
-        # curr_states = curr_model.data_sequences[0].states
-        # prev_states = samples[-1].data_sequences[0].states
-        # d_states = (as_matrix(curr_states) - as_matrix(prev_states)).mean()
-        # print 'd_states: ', d_states
-        #
-        # curr_latent = curr_model.data_sequences[0].latent
-        # prev_latent = samples[-1].data_sequences[0].latent
-        # d_latent = (as_matrix(curr_latent) - as_matrix(prev_latent)).mean()
-        # print 'd_latent: ', d_latent
-
-        samples.append(curr_model)
-
-    return samples
+            update.update(model, cache)
+
+        store.record()
+
+        if checkpoint is not None and np.mod(i, checkpoint_interval) == 0:
+            store.flush()
+            save_checkpoint(checkpoint, i, model, objects)
+
+    store.flush()
+    return store
+
+def resume_mcmc(model, checkpoint, **kwargs):
+    """
+    Continue a chain run by fit_mcmc from its last checkpoint. The model must
+    be built the same way as the original, with the same data sequences.
+    Since the random state is part of the checkpoint, the resumed chain is
+    identical to one that was never interrupted.
+    """
+    return fit_mcmc(model, checkpoint=checkpoint, resume=True, **kwargs)
+
+def chain_updates(model):
+    """
+    Make the MCMC updates of a chain of fit_mcmc_parallel: Gibbs updates of
+    the conductances of each compartment and of the voltage noise sig_V,
+    along with the updates of initialize_updates.
+    """
+    updates = []
+    for neuron in model.population.neurons:
+        for compartment in neuron.compartments:
+            updates.append(ConductanceUpdate(compartment))
+
+    for update in updates:
+        update.preprocess()
+
+    updates.extend(initialize_updates(model))
+
+    update = SigmaTransitionUpdate()
+    update.preprocess()
+    updates.append(update)
+    return updates
+
+def traced_parameters(model, updates):
+    """
+    List the (name, parameter) pairs whose traces are monitored across chains:
+    the conductance of each channel and the voltage noise sig_V, keeping
+    only those that one of the updates resamples.
+    """
+    params = []
+    for neuron in model.population.neurons:
+        for compartment in neuron.compartments:
+            for channel in compartment.channels:
+                params.append(('/'.join(channel.path) + '/g', channel.g))
+    params.append(('sig_V', hypers['sig_V']))
+
+    resampled = set()
+    for update in updates:
+        resampled.update(id(param) for param in update.parameters(model))
+    return [(name, param) for name, param in params if id(param) in resampled]
+
+def check_traced_parameters(model, updates, names):
+    """
+    Raise an exception unless each of the named parameters is traced, i.e.
+    resampled by one of the updates. A parameter without an update would
+    keep its initial value, so its diagnostics would be meaningless.
+    """
+    if len(names) == 0:
+        raise Exception('None of the traced parameters is resampled by the updates')
+
+    traced = [name for name, _ in traced_parameters(model, updates)]
+    missing = [name for name in names if name not in traced]
+    if len(missing) > 0:
+        raise Exception('No update resamples the traced parameters: %s' % ', '.join(missing))
+
+def disperse_model(model, params):
+    """
+    Draw the given (name, parameter) pairs from their priors so that
+    multiple chains start from dispersed initial states.
+    """
+    for name, param in params:
+        if name == 'sig_V':
+            # sig_V^2 has an inverse gamma prior, see SigmaTransitionUpdate
+            param.value = np.sqrt(1.0/np.random.gamma(hypers['a_sig_V'].value,
+                                                      1.0/hypers['b_sig_V'].value))
+        elif not isinstance(param.distribution, DeltaFunction):
+            param.value = param.distribution.sample(1)
+
+def _mcmc_chain(k, model, names, updates, N_samples, seed, queue, stop):
+    """
+    Run a single chain of fit_mcmc_parallel in a worker process, putting the
+    traced parameter values of each sample on the queue.
+    """
+    error = None
+    try:
+        np.random.seed(seed)
+        updates = updates(model)
+        check_traced_parameters(model, updates, names)
+        params = dict(traced_parameters(model, updates))
+        params = [params[name] for name in names]
+
+        disperse_model(model, zip(names, params))
+        initialize_model(model)
+        cache = StatisticsCache(model)
+
+        for i in range(N_samples):
+            if stop.is_set():
+                break
+            if i > 0:
+                for update in updates:
+                    update.update(model, cache)
+            queue.put((k, i, np.array([np.asscalar(np.asarray(p.value)) for p in params])))
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        # Signal that the chain is done, passing on any error
+        queue.put((k, None, error))
+
+def mcmc_diagnostics(traces, burnin=0.5):
+    """
+    Compute the split R-hat and effective sample size of each parameter,
+    discarding the first burnin fraction of each chain.
+
+    traces: dict mapping parameter names to N_chains x N array of samples
+    returns: dict mapping parameter names to (rhat, ess)
+    """
+    diagnostics = {}
+    for name, x in traces.items():
+        x = x[:, int(burnin * x.shape[1]):]
+        diagnostics[name] = (split_rhat(x), effective_sample_size(x))
+    return diagnostics
+
+def fit_mcmc_parallel(model, N_chains=4, N_samples=1000, check_interval=50,
+                      early_stop=False, rhat_threshold=1.1, min_ess=100,
+                      burnin=0.5, print_interval=50, updates=chain_updates):
+    """
+    Fit the parameters of the model with N_chains independent MCMC chains,
+    each run in its own process from a dispersed initialization. The workers
+    are forked with a copy of the model, so it is never pickled, and stream
+    their samples of the traced parameters back as they are drawn.
+
+    Each chain runs the MCMC updates returned by updates(model), by default
+    those of chain_updates. The traced parameters are the channel
+    conductances and sig_V that these updates resample.
+
+    Every check_interval samples, compute the R-hat and effective sample size
+    of each traced parameter. With early_stop, stop all of the chains once
+    every R-hat is below rhat_threshold and every ESS is above min_ess.
+
+    returns:
+    traces:      dict mapping parameter names to N_chains x N arrays of samples
+    diagnostics: dict mapping parameter names to (rhat, ess)
+    """
+    import multiprocessing
+
+    names = [name for name, _ in traced_parameters(model, updates(model))]
+    if len(names) == 0:
+        raise Exception('None of the traced parameters is resampled by the updates')
+    samples = np.zeros((N_chains, N_samples, len(names)))
+    counts = np.zeros(N_chains, dtype=np.int)
+    done = np.zeros(N_chains, dtype=np.bool)
+
+    queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    seeds = np.random.randint(2**31-1, size=N_chains)
+    chains = [multiprocessing.Process(target=_mcmc_chain,
+                                      args=(k, model, names, updates, N_samples, seeds[k], queue, stop))
+              for k in range(N_chains)]
+    for chain in chains:
+        chain.start()
+
+    next_check = check_interval
+    next_print = print_interval
+    diagnostics = {}
+    try:
+        while not np.all(done):
+            k, i, values = queue.get()
+            if i is None:
+                if values is not None:
+                    raise Exception('Chain %d failed: %s' % (k, values))
+                done[k] = True
+                continue
+
+            samples[k, i] = values
+            counts[k] = i + 1
+
+            # Check the diagnostics once every chain has caught up
+            N = counts.min()
+            if N >= next_print:
+                print "Iteration: %d" % N
+                next_print += print_interval
+
+            if N >= next_check:
+                next_check += check_interval
+                traces = dict((name, samples[:, :N, j]) for j, name in enumerate(names))
+                diagnostics = mcmc_diagnostics(traces, burnin)
+                rhats = np.array([d[0] for d in diagnostics.values()])
+                esss = np.array([d[1] for d in diagnostics.values()])
+                print "Max R-hat: %.3f\tMin ESS: %.1f" % (rhats.max(), esss.min())
+
+                if early_stop and np.all(rhats < rhat_threshold) and np.all(esss > min_ess):
+                    print "Converged after %d iterations" % N
+                    stop.set()
+    except:
+        for chain in chains:
+            chain.terminate()
+        raise
+
+    for chain in chains:
+        chain.join()
+
+    # Keep the samples drawn by all of the chains
+    N = counts.min()
+    traces = dict((name, samples[:, :N, j].copy()) for j, name in enumerate(names))
+    diagnostics = mcmc_diagnostics(traces, burnin)
+    return traces, diagnostics
 
 def initialize_model(model):
     """
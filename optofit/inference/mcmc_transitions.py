@@ -2,10 +2,10 @@
 Each class implements a MCMC transition
 """
 import numpy as np
-from hips.inference.ars import adaptive_rejection_sample
-from hips.inference.hmc import hmc
 
 from optofit.inference.particle_mcmc import *
+from optofit.inference.resampling import sample_index
+from optofit.inference.statistics_cache import sequence_statistics
 from optofit.inference.distributions import *
 from optofit.utils.utils import get_item_at_path, as_matrix, as_sarray, sz_dtype
 from optofit.models.hyperparameters import hypers
@@ -40,17 +40,76 @@ class MetropolisHastingsUpdate(object):
         """
         pass
 
+    def parameters(self, model):
+        """ Return a list of the model's parameters that this update resamples
+        """
+        return []
+
     def update(self, model, cache=None):
         """ Take a MH step starting from the current state
         """
 
+def slice_sample(log_p, x, w, lb=-np.Inf, ub=np.Inf, max_steps=20):
+    """
+    Univariate slice sampling with stepping out and shrinkage (Neal, 2003),
+    starting from x with initial bracket width w, on the interval [lb, ub].
+    """
+    log_y = log_p(x) + np.log(np.random.rand())
+
+    # Step out to find a bracket around the slice
+    left = x - w * np.random.rand()
+    right = left + w
+    j = np.random.randint(max_steps)
+    k = max_steps - 1 - j
+    while j > 0 and left > lb and log_p(left) > log_y:
+        left -= w
+        j -= 1
+    while k > 0 and right < ub and log_p(right) > log_y:
+        right += w
+        k -= 1
+    left = max(left, lb)
+    right = min(right, ub)
+
+    # Shrink the bracket until we sample a point on the slice
+    while True:
+        x_new = left + (right - left) * np.random.rand()
+        if log_p(x_new) > log_y:
+            return x_new
+        if x_new < x:
+            left = x_new
+        else:
+            right = x_new
+
 class ConductanceUpdate(MetropolisHastingsUpdate):
     """
-    Update the conductances of a neuron
+    Update the conductances of a neuron.
+
+    Given the latent states, C*dV/dt = -I*g + I_in + noise is a linear
+    Gaussian regression of the membrane current onto the unscaled channel
+    currents I, so the likelihood only depends on the data through the
+    sufficient statistics J = I'I / sig_V^2 and h = I'dV / sig_V^2. We
+    accumulate these once per update, in O(T*C^2), after which sampling only
+    touches the C x C system.
+
+    The conductances are sampled jointly with an independence Metropolis-
+    Hastings step. The exponential part, exp(-b g), of their gamma priors is
+    folded into h, and we draw from the resulting Gaussian N(J^-1 h, J^-1)
+    through the Cholesky factor of J, rejecting draws outside of [lb, ub].
+    The rest of the prior, g^(a-1), enters the acceptance ratio, so with
+    exponential priors every draw is accepted. If J is singular or no draw
+    lands in the bounds after N_tries attempts, we fall back to N_sweeps
+    single site Gibbs sweeps. Under the likelihood, the conditional of each
+    conductance is a truncated Gaussian. With an exponential prior it remains
+    one and we sample it exactly. With a gamma prior it is a gamma-Gaussian,
+    g^(a-1) exp(-b g) N(g | mu, sigma^2), which we slice sample with the
+    Gaussian's width as the step size.
     """
-    def __init__(self, compartment):
+    def __init__(self, compartment, N_sweeps=10, N_tries=100):
         self.neuron_name = compartment.parent.name
         self.compartment_name = compartment.name
+        self.N_sweeps = N_sweeps
+        self.N_tries = N_tries
+        self.noiseclass = TruncatedGaussianDistribution()
 
     def get_compartment(self, model):
         for neuron in model.population.neurons:
@@ -63,112 +122,184 @@ class ConductanceUpdate(MetropolisHastingsUpdate):
 
         raise Exception('Could not find compartment: %s' % self.compartment_name)
 
-    def update(self, model, cache=None):
+    def parameters(self, model):
+        # Only channels that carry a current enter the regression
+        c = self.get_compartment(model)
+        chs = sequence_statistics(model, model.data_sequences[0]).current_channels(c)
+        return [ch.g for ch in chs if not isinstance(ch.g.distribution, DeltaFunction)]
+
+    def sufficient_statistics(self, model, chs, cache=None):
         """
-        Sample the conductances of the neuron given its latent state variables
+        Compute J = I'I / sig_V^2 and h = I'dV / sig_V^2 for the channels chs,
+        summed over all data sequences.
         """
-        # c = self.compartment
         c = self.get_compartment(model)
-        # Get the sub-structured arrays for this comp
-        chs = c.channels
+        C = len(chs)
+        J = np.zeros((C,C))
+        h = np.zeros(C)
 
-        # Get a list of conductances for this compartment
-        gs = [ch.g for ch in chs]
-        gsc = np.array([g.value for g in gs])
-
-        dVc_dts = []
-        Iscs = []
         for data in model.data_sequences:
-            t = data.t
-            T = data.T
-            inpt = data.input
-            state = data.states
-
-            s_comp = get_item_at_path(state, c.path)
-            i_comp = get_item_at_path(inpt, c.path)
-            Vc = s_comp['V']
-            dVc_dt = c.C.value * self.gradient_V(t, Vc)
-            dt = np.concatenate((np.diff(t), np.array([t[-1]-t[-2]])))
+            stats = sequence_statistics(model, data, cache)
+            i_comp = get_item_at_path(data.input, c.path)
+            dVc_dt = c.C.value * stats.dV_dt(c)
 
             # Some of this change is due to injected current
             dVc_dt -= i_comp['I'][:-1]
 
-            dVc_dts.append(dVc_dt)
+            # Per channel currents in this compartment
+            Isc = stats.currents(c)[:-1]
 
-            # Now compute the per channel currents in this compartment
-            Isc = np.zeros((T-1,0))
-            for ch in chs:
-                if s_comp[ch.name].dtype.names is not None and \
-                   'I' in s_comp[ch.name].dtype.names:
-                    Isc = np.concatenate((Isc, -1.0*s_comp[ch.name]['I'][:-1,np.newaxis]),
-                                         axis=1)
+            J += np.dot(Isc.T, Isc)
+            h += np.dot(Isc.T, dVc_dt)
 
-            Iscs.append(Isc)
+        sig_V = np.asscalar(hypers['sig_V'].value)
+        return J / sig_V**2, h / sig_V**2
 
-        # Concatenate the dVs and the currents together
-        dVc_dt = np.concatenate(dVc_dts, axis=0)
-        Isc = np.concatenate(Iscs, axis=0)
+    def update(self, model, cache=None):
+        """
+        Sample the conductances of the neuron given its latent state variables
+        """
+        c = self.get_compartment(model)
 
-        # Sample each conductance in turn given that
-        # C*dVc_dt ~ N(I_in - np.dot(gsc, Isc), sig_V^2)
-        for (i,ch) in enumerate(chs):
-            i_rem = np.concatenate((np.arange(i), np.arange(i+1,len(chs))))
-            gsc_rem = gsc[i_rem]
-            Isc_rem = Isc[:,i_rem]
+        # Only channels that carry a current enter the regression
+        chs = sequence_statistics(model, model.data_sequences[0], cache).current_channels(c)
+        C = len(chs)
+        if C == 0:
+            return
 
-            # prior = gamma(alphas[ch], scale=1.0/betas[ch])
-            prior = ch.g.distribution
+        J, h = self.sufficient_statistics(model, chs, cache)
 
-            dV_resid = dVc_dt - np.dot(Isc_rem, gsc_rem).ravel()
+        gsc = np.array([np.asscalar(ch.g.value) for ch in chs])
+        lb = np.array([ch.g.lower_bound for ch in chs], dtype=np.float64)
+        ub = np.array([ch.g.upper_bound for ch in chs], dtype=np.float64)
+        priors = [ch.g.distribution for ch in chs]
 
-            from scipy.stats import norm
-            sig_V = np.asscalar(hypers['sig_V'].value)
-            # lkhd = norm(dV_resid[:,np.newaxis], sig_V)
+        # Fixed conductances only shift the mean of the others. Channels
+        # without data are independent of the rest, so we sample them from
+        # their prior truncated to [lb, ub].
+        fixed = np.array([isinstance(prior, DeltaFunction) for prior in priors])
+        nodata = ~fixed & (np.diag(J) <= 0)
+        free = ~fixed & ~nodata
 
-            lkhd = lambda g: (-0.5/sig_V**2 * (np.dot(Isc[:,i][:,np.newaxis], g) - dV_resid[:,np.newaxis])**2).sum(axis=0)
+        for i in np.where(nodata)[0]:
+            prior = priors[i]
+            log_p = lambda g: np.asscalar(np.asarray(prior.logp(g)))
+            w = np.asscalar(np.asarray(prior.std)) if hasattr(prior, 'std') else 1.0
+            gsc[i] = np.asscalar(np.asarray(slice_sample(log_p, gsc[i], w, lb[i], ub[i])))
 
-            def _logp(g):
-                sh = g.shape
-                g2 = np.atleast_2d(g)
-                lp = prior.logp(g2)
-                # lp += lkhd.logpdf(np.dot(Isc[:,i][:, np.newaxis], g2)).sum(0)
-                lp += lkhd(g2)
-                return lp.reshape(sh)
+        if np.any(free) and not self.sample_block(J, h, gsc, lb, ub, priors, free):
+            self.gibbs_sweeps(J, h, gsc, lb, ub, priors, free)
 
-            # Evaluate at a few points around the prior mode to seed the ARS
-            xs = np.array([.0001, .001, .01, .05, .1, 1.0, 2.0, 4.0, 7.0, 10.0])
-            v_xs = _logp(xs)
-            assert np.all(np.isfinite(v_xs))
+        # Update the channel conductance parameters
+        for (i,ch) in enumerate(chs):
+            ch.g.value = np.atleast_1d(gsc[i])
 
-            # Try for a few attempts to find the right bound
-            gsc[i] = adaptive_rejection_sample(_logp, xs, v_xs, [ch.g.lower_bound, ch.g.upper_bound])
-            
-            # Update the channel conductance parameter
-            ch.g.value = gsc[i]
+    def sample_block(self, J, h, gsc, lb, ub, priors, free):
+        """
+        Jointly resample the free conductances in gsc, in place, with an
+        independence Metropolis-Hastings step. Returns False, leaving gsc
+        unchanged, if J is singular or none of N_tries draws is in bounds.
+        """
+        F = np.where(free)[0]
+        J_F = J[np.ix_(F,F)]
+        h_F = h[F] - np.dot(J[np.ix_(F,~free)], gsc[~free])
+
+        # Fold the exponential part of the gamma priors into h
+        b = np.array([np.asscalar(np.asarray(priors[i].b))
+                      if isinstance(priors[i], GammaDistribution) else 0.0
+                      for i in F])
+        h_F -= b
+
+        try:
+            L = np.linalg.cholesky(J_F)
+        except np.linalg.LinAlgError:
+            return False
+        mu = np.linalg.solve(J_F, h_F)
+
+        # Draw from N(mu, J_F^-1) until the draw is within the bounds. The
+        # truncation of this proposal cancels in the acceptance ratio.
+        for _ in range(self.N_tries):
+            g = mu + np.linalg.solve(L.T, np.random.randn(len(F)))
+            if np.all(g >= lb[F]) and np.all(g <= ub[F]):
+                break
+        else:
+            return False
+
+        # Log of the part of the prior that is not folded into the proposal
+        def log_r(g):
+            return sum(np.asscalar(np.asarray(priors[i].logp(g_i))) + b_i*g_i
+                       for i, g_i, b_i in zip(F, g, b))
+
+        if np.log(np.random.rand()) < log_r(g) - log_r(gsc[F]):
+            gsc[F] = g
+        return True
 
-    def gradient_V(self, t, V):
+    def gibbs_sweeps(self, J, h, gsc, lb, ub, priors, free):
         """
-        Compute the gradient of V
+        Resample the free conductances in gsc, in place, one at a time from
+        their conditionals given the others, sweeping N_sweeps times.
         """
-        # Compute dV/dt using first order differences
-        # T = V.size
-        # dVdt = np.zeros((T-1,))
-        dVdt = (V[1:]-V[:-1])/(t[1:]-t[:-1])
-        # dVdt[-1] = (V[-1]-V[-2])/(t[-1]-t[-2])
-        return dVdt
+        for sweep in range(self.N_sweeps):
+            for i in np.where(free)[0]:
+                prior = priors[i]
+
+                # The conditional of g_i given the other conductances is
+                # p(g) ~ prior(g) * N(g | mu, sigma^2) on [lb, ub]
+                mu = (h[i] - np.dot(J[i], gsc) + J[i,i]*gsc[i]) / J[i,i]
+                sigma = 1.0 / np.sqrt(J[i,i])
+
+                if isinstance(prior, GammaDistribution) and np.allclose(prior.a, 1.0):
+                    # An exponential prior just shifts the mean, so sample
+                    # the truncated Gaussian directly
+                    mu -= np.asscalar(np.asarray(prior.b)) * sigma**2
+                    gsc[i] = np.asscalar(self.noiseclass.sample(np.array([mu]), sigma, lb[i], ub[i]))
+                else:
+                    log_p = lambda g: np.asscalar(np.asarray(prior.logp(g))) - 0.5*(g-mu)**2/sigma**2
+                    gsc[i] = np.asscalar(np.asarray(slice_sample(log_p, gsc[i], sigma, lb[i], ub[i])))
 
 
 class HmcConductanceUpdate(MetropolisHastingsUpdate):
     """
-    Update the conductances of a neuron
+    Update the conductances of a neuron with Hamiltonian Monte Carlo on their
+    logarithms.
+
+    The log likelihood of the conductances is quadratic, so it only depends on
+    the data through the Gram matrix I'I, I'dV and dV'dV. These are computed
+    once per update, after which each leapfrog step costs O(C^2) rather than
+    O(T*C). The step sizes are tuned with the dual averaging scheme of
+    Hoffman and Gelman (2014), "The No-U-Turn Sampler", Alg. 5, for the
+    first N_adapt updates and then fixed.
     """
-    def __init__(self, compartment):
+    def __init__(self, compartment, nsteps=10, N_adapt=200, target_accept_rate=0.65,
+                 step_sz=0.01):
         self.neuron_name = compartment.parent.name
         self.compartment_name = compartment.name
+        self.nsteps = nsteps
+        self.N_adapt = N_adapt
+        self.target_accept_rate = target_accept_rate
 
+        # Dual averaging state for the step size of each channel
         C = len(compartment.channels)
-        self.avg_accept_rate = 0.9*np.ones(C)
-        self.step_sz = 0.01*np.ones(C)
+        self.step_sz = step_sz*np.ones(C)
+        self.log_step_sz_bar = np.zeros(C)
+        self.H_bar = np.zeros(C)
+        self.mu = np.log(10*self.step_sz)
+        self.n_adapt = 0
+
+    def get_state(self):
+        # Adaptive step sizes for checkpointing
+        return {'step_sz' : self.step_sz,
+                'log_step_sz_bar' : self.log_step_sz_bar,
+                'H_bar' : self.H_bar,
+                'mu' : self.mu,
+                'n_adapt' : self.n_adapt}
+
+    def set_state(self, state):
+        self.step_sz = state['step_sz'].copy()
+        self.log_step_sz_bar = state['log_step_sz_bar'].copy()
+        self.H_bar = state['H_bar'].copy()
+        self.mu = state['mu'].copy()
+        self.n_adapt = int(state['n_adapt'])
 
     def get_compartment(self, model):
         for neuron in model.population.neurons:
@@ -181,25 +312,23 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
 
         raise Exception('Could not find compartment: %s' % self.compartment_name)
 
-    def get_dV_and_currents(self, model):
+    def parameters(self, model):
+        return [ch.g for ch in self.get_compartment(model).channels]
+
+    def get_dV_and_currents(self, model, cache=None):
         c = self.get_compartment(model)
-        # Get the sub-structured arrays for this comp
-        chs = c.channels
 
         dts = []
         dVc_dts = []
         Iscs = []
         for data in model.data_sequences:
-            t = data.t
-            T = data.T
-            inpt = data.input
-            state = data.states
+            stats = sequence_statistics(model, data, cache)
+            i_comp = get_item_at_path(data.input, c.path)
 
-            s_comp = get_item_at_path(state, c.path)
-            i_comp = get_item_at_path(inpt, c.path)
-            Vc = s_comp['V']
-            dVc_dt = c.C.value * self.gradient_V(t, Vc)
-            dt = np.concatenate((np.diff(t), np.array([t[-1]-t[-2]])))
+            # Repeat the last difference to get a gradient at every time step
+            dV_dt = stats.dV_dt(c)
+            dVc_dt = c.C.value * np.concatenate((dV_dt, dV_dt[-1:]))
+            dt = np.concatenate((stats.dt, stats.dt[-1:]))
 
             # Some of this change is due to injected current
             dVc_dt -= i_comp['I']
@@ -207,15 +336,8 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
             dts.append(dt)
             dVc_dts.append(dVc_dt)
 
-            # Now compute the per channel currents in this compartment
-            Isc = np.zeros((T,0))
-            for ch in chs:
-                if s_comp[ch.name].dtype.names is not None and \
-                   'I' in s_comp[ch.name].dtype.names:
-                    Isc = np.concatenate((Isc, -1.0*s_comp[ch.name]['I'][:,np.newaxis]),
-                                         axis=1)
-
-            Iscs.append(Isc)
+            # The per channel currents in this compartment
+            Iscs.append(stats.currents(c))
 
         # Concatenate the dVs and the currents together
         dt = np.concatenate(dts, axis=0)
@@ -224,74 +346,46 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
 
         return dVc_dt, Isc, dt
 
-    def _logp(self, log_gs, dV, Is, dt, prior):
+    def get_gram(self, model, cache=None):
         """
-        Compute the log prob of a set of conductances given
-        the estimated dV and I
+        Compute the sufficient statistics of the regression of dV onto the
+        currents: II = I'I, IdV = I'dV and dVdV = dV'dV
         """
-        gs = np.exp(log_gs)
-        C = gs.size
-        T = dV.size
-        dV = dV.reshape((T,1))
-        Is = Is.reshape((T,C))
-        dt = dt.reshape((T,1))
+        dVc_dt, Isc, _ = self.get_dV_and_currents(model, cache)
+        return np.dot(Isc.T, Isc), np.dot(Isc.T, dVc_dt), np.dot(dVc_dt, dVc_dt)
 
+    def _logp(self, log_gs, II, IdV, dVdV, prior):
+        """
+        Compute the log prob of a set of conductances given the sufficient
+        statistics of the estimated dV and I
+        """
+        gs = np.exp(log_gs)
         sig_V = hypers['sig_V'].value
-        pred_dV = np.dot(Is, gs)
 
-        ll = np.sum(-0.5/sig_V**2 * (dV - pred_dV)**2)
-        # ll = 0.
+        # sum((dV - I*g)**2) = dV'dV - 2 g'I'dV + g'I'I g
+        sq_err = dVdV - 2*np.dot(gs, IdV) + np.dot(gs, np.dot(II, gs))
+        ll = np.sum(-0.5/sig_V**2 * sq_err)
         lprior = prior.logp_logx(log_gs)
-        # lprior = 0
 
         lp = ll + lprior
         if np.isnan(lp):
             lp = -np.Inf
         return lp
 
-    def _grad_logp(self, log_gs, dV, Is, dt, prior):
+    def _grad_logp(self, log_gs, II, IdV, dVdV, prior):
         """
         Compute the gradient of the log prob of a set of conductances
-        given the estimated dV and I
+        given the sufficient statistics of the estimated dV and I
         """
         C = log_gs.size
-        T = dV.size
-
-        gs = np.exp(log_gs).reshape((C,1))
-        dV = dV.reshape((T,1))
-        Is = Is.reshape((T,C))
-        dt = dt.reshape((T,1))
-
+        gs = np.exp(log_gs).reshape((C,))
         sig_V = hypers['sig_V'].value
 
-        preddV = np.dot(Is, gs)
-        dpreddV_dg = Is
-        dll_dg = np.dot((1.0/sig_V**2 * (dV - preddV)).T, dpreddV_dg)
-        dll_dg = dll_dg.reshape((C,1))
-        # dll_dg = np.zeros((C,1))
-        dlprior_dg = prior.grad_logp_logx_wrt_x(gs)
-        dlprior_dg = dlprior_dg.reshape((C,1))
-        # dlprior_dg = np.zeros((C,1))
-
-        dlp_dg = dll_dg + dlprior_dg
-        dg_dlogg = gs
-
-        dlp_dlogg = dlp_dg * dg_dlogg
-
-        # print "gs: ", gs
-        # print "dlp/dlng: ", dlp_dlogg.ravel()
-        # if not np.all(np.isfinite(dlp_dlogg)):
-        #     import pdb; pdb.set_trace()
-        # import pdb; pdb.set_trace()
-        # import matplotlib.pyplot as plt
-        # plt.figure(2)
-        # plt.plot(dV, '-k')
-        # plt.plot(preddV, '-r')
-        # plt.show()
-        # # plt.pause(0.1)
-        # # # raw_input('Press any key to continue\n')
-        # import pdb; pdb.set_trace()
+        dll_dg = 1.0/sig_V**2 * (IdV - np.dot(II, gs))
+        dlprior_dg = prior.grad_logp_logx_wrt_x(gs).reshape((C,))
 
+        # Chain rule through g = exp(log g)
+        dlp_dlogg = (dll_dg + dlprior_dg) * gs
         return dlp_dlogg.reshape((C,))
 
     def check_grads(self, f, df, xs, step=1e-4):
@@ -315,7 +409,51 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
 
                 import pdb; pdb.set_trace()
 
-    def joint_update(self, model):
+    def _hmc(self, nll, grad_nll, step_sz, q_curr):
+        """
+        Take one HMC step with nsteps leapfrog steps of size step_sz from
+        q_curr. Return the new state and the acceptance probability.
+        """
+        q = q_curr.copy()
+        p_curr = np.random.randn(*q.shape)
+
+        # Leapfrog integration of the Hamiltonian dynamics. With too large a
+        # step size the trajectory can diverge, in which case it is rejected.
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            p = p_curr - 0.5 * step_sz * grad_nll(q)
+            for i in range(self.nsteps):
+                q += step_sz * p
+                if i < self.nsteps - 1:
+                    p -= step_sz * grad_nll(q)
+            p -= 0.5 * step_sz * grad_nll(q)
+
+            dH = nll(q_curr) + 0.5*np.sum(p_curr**2) - nll(q) - 0.5*np.sum(p**2)
+        accept_prob = np.exp(min(dH, 0.0)) if np.isfinite(dH) else 0.0
+        if np.random.rand() < accept_prob:
+            return q, accept_prob
+        return q_curr, accept_prob
+
+    def _adapt_step_sz(self, accept_probs):
+        """
+        Dual averaging update of the step sizes given the acceptance
+        probabilities of the last HMC steps
+        """
+        gamma, t0, kappa = 0.05, 10.0, 0.75
+        self.n_adapt += 1
+        m = float(self.n_adapt)
+
+        if m <= self.N_adapt:
+            self.H_bar = (1.0 - 1.0/(m+t0)) * self.H_bar + \
+                         1.0/(m+t0) * (self.target_accept_rate - accept_probs)
+            log_step_sz = self.mu - np.sqrt(m)/gamma * self.H_bar
+            self.log_step_sz_bar = m**(-kappa) * log_step_sz + \
+                                   (1.0 - m**(-kappa)) * self.log_step_sz_bar
+            self.step_sz = np.exp(log_step_sz)
+        else:
+            # Fix the step size at the average of the adaptation phase
+            self.step_sz = np.exp(self.log_step_sz_bar)
+
+    def joint_update(self, model, cache=None):
         """
         Sample the conductances of the neuron given its latent state variables
         """
@@ -328,23 +466,22 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
         gs = [ch.g for ch in chs]
         gs_values = np.array([g.value for g in gs]).ravel()
 
-        dVc_dt, Isc, dt = self.get_dV_and_currents(model)
+        II, IdV, dVdV = self.get_gram(model, cache)
 
         # Sample new gs with HMC
         prior = ProductDistribution([g.distribution for g in gs])
-        nll = lambda log_gs: -1.0*self._logp(log_gs,dVc_dt, Isc, dt, prior )
-        grad_nll = lambda log_gs: -1.0*self._grad_logp(log_gs,dVc_dt, Isc, dt, prior)
+        nll = lambda log_gs: -1.0*self._logp(log_gs, II, IdV, dVdV, prior)
+        grad_nll = lambda log_gs: -1.0*self._grad_logp(log_gs, II, IdV, dVdV, prior)
 
         stepsz = 0.005
-        nsteps = 10
-        log_gs = hmc(nll, grad_nll, stepsz, nsteps, np.log(gs_values))
+        log_gs, _ = self._hmc(nll, grad_nll, stepsz, np.log(gs_values))
         gs = np.exp(log_gs)
 
         # Update the channel conductance parameter
         for g,ch in zip(gs,chs):
             ch.g.value = g
 
-    def serial_update(self, model):
+    def serial_update(self, model, cache=None):
         # Sample each conductance in turn given that
         # C*dVc_dt ~ N(I_in - np.dot(gsc, Isc), sig_V^2)
 
@@ -354,57 +491,61 @@ class HmcConductanceUpdate(MetropolisHastingsUpdate):
         # Get a list of conductances for this compartment
         gs = [ch.g for ch in chs]
         gsc = np.array([g.value for g in gs]).ravel()
-        # import pdb; pdb.set_trace()
 
-        dVc_dt, Isc, dt = self.get_dV_and_currents(model)
+        II, IdV, dVdV = self.get_gram(model, cache)
 
+        accept_probs = np.zeros(len(chs))
         for (i,(g,ch)) in enumerate(zip(gs, chs)):
+            # Sufficient statistics of the residual dV_resid = dV - I_rem g_rem
+            # after removing the currents of the other channels
             i_rem = np.concatenate((np.arange(i), np.arange(i+1,len(chs))))
             gsc_rem = gsc[i_rem]
-            Isc_rem = Isc[:,i_rem]
-            dV_resid = dVc_dt - np.dot(Isc_rem, gsc_rem).ravel()
+            II_i = II[i:i+1,i:i+1]
+            IdV_i = IdV[i:i+1] - np.dot(II[i,i_rem], gsc_rem)
+            dVdV_i = dVdV - 2*np.dot(gsc_rem, IdV[i_rem]) + \
+                     np.dot(gsc_rem, np.dot(II[np.ix_(i_rem,i_rem)], gsc_rem))
 
             # Sample new gs with HMC
             prior = g.distribution
-            nll = lambda log_gs: -1.0*self._logp(log_gs,dV_resid, Isc[:,i], dt, prior )
-            grad_nll = lambda log_gs: -1.0*self._grad_logp(log_gs,dV_resid, Isc[:,i], dt, prior)
+            nll = lambda log_gs: -1.0*self._logp(log_gs, II_i, IdV_i, dVdV_i, prior)
+            grad_nll = lambda log_gs: -1.0*self._grad_logp(log_gs, II_i, IdV_i, dVdV_i, prior)
 
             # DEBUG:
             # self.check_grads(nll, grad_nll, np.log(gsc[i]).reshape((1,)), step=1e-4)
 
-            nsteps = 10
             curr_log_g = np.log(gsc[i]).reshape((1,))
-            new_log_g, new_step_sz, new_accept_rate = \
-                hmc(nll, grad_nll, self.step_sz[i], nsteps, curr_log_g,
-                    adaptive_step_sz=True,
-                    avg_accept_rate=self.avg_accept_rate[i],
-                    min_step_sz=1e-4)
-
-            # Update step size and accept rate
-            self.step_sz[i] = new_step_sz
-            self.avg_accept_rate[i] = new_accept_rate
+            new_log_g, accept_probs[i] = self._hmc(nll, grad_nll, self.step_sz[i], curr_log_g)
 
             # Update the channel conductance parameter
             gsc[i] = np.exp(new_log_g)
             ch.g.value = np.exp(new_log_g)
 
-    def update(self, model):
-        return self.serial_update(model)
+        self._adapt_step_sz(accept_probs)
+
+    def update(self, model, cache=None):
+        return self.serial_update(model, cache)
 
-    def gradient_V(self, t, V):
-        """
-        Compute the gradient of V
-        """
-        # Compute dV/dt using first order differences
-        dVdt = np.zeros_like(V)
-        dVdt[:-1] = (V[1:]-V[:-1])/(t[1:]-t[:-1])
-        dVdt[-1] = (V[-1]-V[-2])/(t[-1]-t[-2])
-        return dVdt
+
+# State shared with the worker processes of NeuronLatentStateUpdate. The workers
+# are forked after this is set, so they inherit the model instead of unpickling it.
+_latent_state_worker_args = None
+
+def _latent_state_worker(k):
+    update, model, seeds, buffers = _latent_state_worker_args
+
+    # Each worker would otherwise inherit the same random state
+    np.random.seed(seeds[k])
+    data = model.data_sequences[k]
+    z = np.frombuffer(buffers[k]).reshape((-1, data.T))
+    z[...] = update._sample_latent(model, data)
+    return k
 
 
 class NeuronLatentStateUpdate(MetropolisHastingsUpdate):
     """
     Update our estimate of the latent state of the neuron with particle MCMC.
+    The data sequences are conditionally independent given the parameters, so
+    they can be updated in parallel by setting the N_workers hyperparameter.
     """
 
     def __init__(self, model, population):
@@ -417,6 +558,12 @@ class NeuronLatentStateUpdate(MetropolisHastingsUpdate):
         :return:
         """
         self.N_particles = hypers['N_particles'].value
+        self.N_workers = hypers['N_workers'].value
+
+        # The particle filter resamples at every step when given no threshold
+        ess_threshold = float(hypers['ess_threshold'].value)
+        self.ess_threshold = ess_threshold if ess_threshold < 1.0 else None
+        self.prune_ancestry = bool(hypers['prune_ancestry'].value)
 
         # Set up initial state distribution
         # Initial state is centered around the steady state
@@ -439,58 +586,133 @@ class NeuronLatentStateUpdate(MetropolisHastingsUpdate):
                 sig_trans[neuron.name][compartment.name]['V'] = hypers['sig_V'].value
         self.sig_trans = as_matrix(sig_trans)
 
-    def update(self, model, cache=None):
-        """
+    def get_state(self):
+        # The distributions set up in preprocess, for checkpointing
+        return {'mu_initial' : self.mu_initial,
+                'sig_initial' : self.sig_initial,
+                'sig_trans' : self.sig_trans}
 
-        :param current_state:
-        :return:
+    def set_state(self, state):
+        self.mu_initial = state['mu_initial'].copy()
+        self.sig_initial = state['sig_initial'].copy()
+        self.sig_trans = state['sig_trans'].copy()
+
+    def _filter_components(self, model, t, inpt):
+        """
+        Make the initial distribution, observation likelihood and proposal
+        for a particle filter over a data sequence with times t and input inpt.
         """
         population = model.population
+        D = sz_dtype(population.latent_dtype)
 
-        # Update each data sequence one at a time
-        for data in model.data_sequences:
-            t = data.t
-            T = data.T
-            latent = data.latent
-            inpt = data.input
-            state = data.states
-            obs = data.observations
-
-            # View the latent state as a matrix
-            D = sz_dtype(latent.dtype)
-            z = as_matrix(latent, D)
-            x = as_matrix(obs)
+        lb = population.latent_lb
+        ub = population.latent_ub
+        p_initial = StaticTruncatedGaussianDistribution(D, self.mu_initial, self.sig_initial, lb, ub)
 
+        # The observation model gives us a noisy version of the voltage
+        lkhd = ObservationLikelihood(model)
 
-            lb = population.latent_lb
-            ub = population.latent_ub
-            p_initial = StaticTruncatedGaussianDistribution(D, self.mu_initial, self.sig_initial, lb, ub)
+        # The transition model is a noisy Hodgkin Huxley proposal
+        # prop = TruncatedHodgkinHuxleyProposal(population, t, inpt, self.sig_trans)
+        prop = HodgkinHuxleyProposal(population, t, inpt, self.sig_trans)
 
-            # The observation model gives us a noisy version of the voltage
-            lkhd = ObservationLikelihood(model)
+        return p_initial, lkhd, prop
 
-            # The transition model is a noisy Hodgkin Huxley proposal
-            # prop = TruncatedHodgkinHuxleyProposal(population, t, inpt, self.sig_trans)
-            prop = HodgkinHuxleyProposal(population, t, inpt, self.sig_trans)
+    def online_filter(self, model, t, inpt, lag=100, ess_threshold=None):
+        """
+        Make an online particle filter for a recording with times t and input
+        inpt, using the same initial distribution, likelihood and proposal as
+        the particle Gibbs update. Its filter_stream method consumes the
+        observations chunk by chunk, e.g. as they are read from disk, and
+        only keeps lag time steps of particle history.
+        """
+        D = sz_dtype(model.population.latent_dtype)
+        p_initial, lkhd, prop = self._filter_components(model, t, inpt)
+        return OnlineParticleFilter(D, prop, lkhd, p_initial,
+                                    Np=self.N_particles,
+                                    lag=lag,
+                                    ess_threshold=ess_threshold)
+
+    def _sample_latent(self, model, data):
+        """
+        Run a particle Gibbs sweep with ancestor sampling over a single data
+        sequence and return a new D x T sample of its latent state.
+        """
+        t = data.t
+        T = data.T
+        latent = data.latent
+        inpt = data.input
+        obs = data.observations
+
+        # View the latent state as a matrix
+        D = sz_dtype(latent.dtype)
+        z = as_matrix(latent, D)
+        x = as_matrix(obs)
+
+        p_initial, lkhd, prop = self._filter_components(model, t, inpt)
+
+        # Run the particle Gibbs step with ancestor sampling
+        # Create a conditional particle filter with ancestor sampling
+        pf = ParticleGibbsAncestorSampling(D, T, 0, x[:,0],
+                                           prop, lkhd, p_initial, z,
+                                           Np=self.N_particles,
+                                           ess_threshold=self.ess_threshold,
+                                           prune_ancestry=self.prune_ancestry)
+
+        for ind in np.arange(1,T):
+            x_curr = x[:,ind]
+            pf.filter(ind, x_curr)
+
+        # Sample a particular weight trace given the particle weights at time T
+        i = sample_index(pf.trajectory_weights)
+        # z_inf = pf.trajectories[:,i,:].reshape((D,T))
+        return pf.get_trajectory(i).reshape((D,T))
+
+    def _sample_latents_parallel(self, model):
+        """
+        Sample the latent states of all the data sequences in a pool of
+        worker processes. The workers write their samples into shared
+        memory buffers, so only the sequence indices are pickled.
+        """
+        global _latent_state_worker_args
+        import multiprocessing
+        from multiprocessing.sharedctypes import RawArray
+
+        D = sz_dtype(model.population.latent_dtype)
+        K = len(model.data_sequences)
+        buffers = [RawArray('d', D * data.T) for data in model.data_sequences]
+        seeds = np.random.randint(2**31-1, size=K)
+
+        _latent_state_worker_args = (self, model, seeds, buffers)
+        pool = multiprocessing.Pool(min(int(self.N_workers), K))
+        try:
+            pool.map(_latent_state_worker, range(K))
+        finally:
+            pool.close()
+            pool.join()
+            _latent_state_worker_args = None
+
+        return [np.frombuffer(b).reshape((D, data.T))
+                for b, data in zip(buffers, model.data_sequences)]
 
-            # Run the particle Gibbs step with ancestor sampling
-            # Create a conditional particle filter with ancestor sampling
-            pf = ParticleGibbsAncestorSampling(D, T, 0, x[:,0],
-                                               prop, lkhd, p_initial, z,
-                                               Np=self.N_particles)
+    def update(self, model, cache=None):
+        """
 
-            for ind in np.arange(1,T):
-                x_curr = x[:,ind]
-                pf.filter(ind, x_curr)
+        :param current_state:
+        :return:
+        """
+        population = model.population
 
-            # Sample a particular weight trace given the particle weights at time T
-            i = np.random.choice(np.arange(pf.Np), p=pf.trajectory_weights)
-            # z_inf = pf.trajectories[:,i,:].reshape((D,T))
-            z_inf = pf.get_trajectory(i).reshape((D,T))
+        if self.N_workers > 1 and len(model.data_sequences) > 1:
+            z_infs = self._sample_latents_parallel(model)
+        else:
+            # Update each data sequence one at a time
+            z_infs = [self._sample_latent(model, data) for data in model.data_sequences]
 
+        for data, z_inf in zip(model.data_sequences, z_infs):
             # Update the data sequence's latent and state
             data.latent = as_sarray(z_inf, population.latent_dtype)
-            data.states = population.evaluate_state(data.latent, inpt)
+            data.states = population.evaluate_state(data.latent, data.input)
 
 
 class DirectCompartmentVoltageUpdate(MetropolisHastingsUpdate):
@@ -501,7 +723,7 @@ class DirectCompartmentVoltageUpdate(MetropolisHastingsUpdate):
     def __init__(self, model):
         raise NotImplementedError()
 
-    def update(self, model):
+    def update(self, model, cache=None):
         raise NotImplementedError()
 
 class LinearFluorescenceUpdate(MetropolisHastingsUpdate):
@@ -512,7 +734,7 @@ class LinearFluorescenceUpdate(MetropolisHastingsUpdate):
     def __init__(self, model):
         self.model = model
 
-    def update(self, model):
+    def update(self, model, cache=None):
         for data in self.model.data_sequences:
             for obs in self.model.observation.observations:
                 obs.update(data.latent, data.observations)
@@ -531,36 +753,14 @@ class SigmaTransitionUpdate(MetropolisHastingsUpdate):
         beta_V_hat = 0
         # beta_ch_hat = 0
 
-        # Get the latent voltages
         for ds in model.data_sequences:
-            latent = as_matrix(ds.latent)
-            # The transition model is a noisy Hodgkin Huxley proposal
-            prop = TruncatedHodgkinHuxleyProposal(model.population, ds.t, ds.input,
-                                                  as_matrix(np.zeros(1, dtype=model.population.latent_dtype)))
-            dt = ds.t[1:] - ds.t[:-1]
-            # import pdb; pdb.set_trace()
-            pred = np.zeros((latent.shape[0], ds.T-1))
-            for t in np.arange(ds.T-1):
-                pt,_,_ = prop.sample_next(t, latent[:,t,np.newaxis], t+1)
-                pred[:,t] = pt.ravel()
-
-            # pred2,_ = prop.sample_next(np.arange(ds.T-1),
-            #                           latent[:,:-1],
-            #                           np.arange(1,ds.T))
-
-            # if not np.allclose(pred, pred2):
-            #     import pdb; pdb.set_trace()
+            sq_residuals = sequence_statistics(model, ds, cache).sq_residuals()
+
             for neuron in model.population.neurons:
                 for compartment in neuron.compartments:
-                    V = get_item_at_path(as_sarray(latent, model.population.latent_dtype),
-                                         compartment.path)['V']
-                    Vpred = get_item_at_path(as_sarray(pred, model.population.latent_dtype),
-                                             compartment.path)['V']
-                    dV = (Vpred - V[1:])/dt
-
-                    # Update sufficient stats
-                    N += len(dV)
-                    beta_V_hat += (dV**2).sum()
+                    # Update sufficient stats of the voltage residuals
+                    N += ds.T - 1
+                    beta_V_hat += sq_residuals[compartment.x_offset]
 
         # Sample a new beta_V
         sig2_V = 1.0/np.random.gamma(hypers['a_sig_V'].value + N/2.,
@@ -568,11 +768,14 @@ class SigmaTransitionUpdate(MetropolisHastingsUpdate):
 
         hypers['sig_V'].value = np.sqrt(sig2_V)
 
+    def parameters(self, model):
+        return [hypers['sig_V']]
+
 class GewekeUpdate(MetropolisHastingsUpdate):
     """
     Simple Geweke update
     """
-    def update(self, model):
+    def update(self, model, cache=None):
         # import pdb; pdb.set_trace()
         self.t = model.data_sequences[0].t
         self.stim = model.data_sequences[0].stimuli
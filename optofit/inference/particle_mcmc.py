@@ -1,7 +1,12 @@
 import numpy as np
 from scipy.misc import logsumexp
 
-from optofit.utils.utils import ibincount, as_matrix, as_sarray
+from optofit.utils.utils import as_matrix, as_sarray
+from optofit.inference.resampling import resample, effective_sample_size, sample_index, \
+    multinomial_resample, systematic_resample
+from optofit.inference.ancestry import AncestryTree
+from optofit.simulation.stimulus import SparseInput
+from optofit.models.layout import Layout
 
 # TODO: Move the proposals, likelihoods, etc to a separate Python package
 # since it is shared among multiple projects now
@@ -19,6 +24,15 @@ class Proposal(object):
     def logp(self, t_prev, Z_prev, t_next, Z_next):
         return -np.Inf
 
+    def propagate(self, t_prev, Z, t_next):
+        """ Sample the next state in place, overwriting the D x Np
+        particles Z, which are the previous state on entry. Override this to
+        avoid allocating a new array for the next state.
+        """
+        Z_next, logp, state = self.sample_next(t_prev, Z, t_next)
+        Z[...] = Z_next
+        return logp, state
+
 class DynamicalSystemProposal(Proposal):
     def __init__(self, dzdt, noiseclass):
         self.dzdt = dzdt
@@ -49,9 +63,7 @@ class DynamicalSystemProposal(Proposal):
 
 class HodgkinHuxleyProposal(Proposal):
     def __init__(self, population, t, inpt, sigma):
-        self.population = population
-        self.t = t
-        self.inpt = inpt
+        self._init_kinetics(population, t, inpt)
 
         self.sigma = sigma
         if self.sigma.ndim == 1:
@@ -64,19 +76,66 @@ class HodgkinHuxleyProposal(Proposal):
         # Set the noise to Gaussian
         # TODO: Decide how to set the variance
 
+    def _init_kinetics(self, population, t, inpt):
+        self.population = population
+        self.t = t
+        self.inpt = inpt
+
+        # View the inputs with the population's flat layout, i.e. as a
+        # T x M matrix, and lazily allocate the kinetics buffers. A
+        # SparseInput already acts as such a matrix.
+        self.layout = population.layout
+        if isinstance(inpt, SparseInput):
+            self.flat_inpt = inpt
+        else:
+            self.flat_inpt = self.layout.flatten_input(inpt)
+        self._dxdt = None
+        self._s = None
+        self._z = None
+
     def _hh_kinetics(self, index, Z):
         D,Np = Z.shape
 
-        # Get the current input and latent states
-        current_inpt = self.inpt[index]
-        latent = as_sarray(Z, self.population.latent_dtype)
+        # Allocate the kinetics buffers once per number of particles
+        if self._dxdt is None or self._dxdt.shape[0] != Np:
+            self._dxdt = self.layout.empty_latent(Np)
+            self._s = self.layout.empty_state(Np)
+
+        # Get the current input and latent states. Z is D x Np, so
+        # its transpose is a view with one row per particle.
+        index = int(index)
+        current_inpt = self.flat_inpt[index:index+1]
+        x = Z.T
 
         # Run the kinetics forward
-        dxdt = self.population.kinetics(latent, current_inpt)
+        self.population.evaluate_state_into(self._s, x, current_inpt)
+        self.population.kinetics_into(self._dxdt, x, current_inpt, self._s)
 
-        # Wow, this is terrible. Converting to/from numpy struct array and
-        # regular arrays, and maintaining the correct shape, is a mega pain in the ass
-        return dxdt.view(np.float).reshape((Np,D)).T
+        return self._dxdt.T
+
+    def _step_into(self, index, Z, dt, out):
+        """
+        Write the noiseless prediction of the D x Np particles Z after a time
+        step dt into out, here with forward Euler, and return it. Override
+        this to use another integrator.
+        """
+        np.multiply(self._hh_kinetics(index, Z), dt, out=out)
+        out += Z
+        return out
+
+    def _step(self, index, Z, dt):
+        """
+        Noiseless prediction of the D x Np particles Z after a time step dt
+        """
+        return self._step_into(index, Z, dt, np.empty_like(Z))
+
+    def _prediction_buffer(self, Z):
+        # Allocate the buffer for the noiseless prediction once per number
+        # of particles, with the same one row per particle layout as Z
+        D,Np = Z.shape
+        if self._z is None or self._z.shape != (D,Np):
+            self._z = np.empty((Np,D)).T
+        return self._z
 
     def sample_next(self, curr_index, Z_prev, next_index):
         # assert next_index >= curr_index
@@ -85,7 +144,7 @@ class HodgkinHuxleyProposal(Proposal):
         # Propagate forward according to the hodgkin huxley dynamics
         # then add noise, guaranteeing that we stay within the limits
         dt = self.t[next_index] - self.t[curr_index]
-        z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
+        z = self._step(curr_index, Z_prev, dt)
 
         # Scale down the noise to account for time delay
         # sig = self.sigma * np.sqrt(dt)
@@ -99,6 +158,24 @@ class HodgkinHuxleyProposal(Proposal):
         state = {'z' : z}
         return z + noise*dt, logp, state
 
+    def propagate(self, curr_index, Z, next_index):
+        """ Sample the next state of the D x Np particles Z in place. The
+        noiseless prediction is written into a buffer that is reused at every
+        step, so no arrays of particles are allocated.
+        """
+        dt = self.t[next_index] - self.t[curr_index]
+        z = self._step_into(curr_index, Z, dt, self._prediction_buffer(Z))
+
+        noise = self.noiseclass.sample()
+        logp = self.noiseclass.logp(noise)
+
+        noise *= dt
+        np.add(z, noise, out=Z)
+
+        # The prediction is only valid until the next call to propagate
+        state = {'z' : z}
+        return logp, state
+
     def logp(self, curr_index, Z_prev, next_index, Z_next, state=None):
         # Propagate forward according to the hodgkin huxley dynamics
         # then add noise, guaranteeing that we stay within the limits
@@ -109,7 +186,7 @@ class HodgkinHuxleyProposal(Proposal):
             z = state['z']
         else:
             # Run kinetics and clip to within range
-            z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
+            z = self._step(curr_index, Z_prev, dt)
 
         noise = (Z_next-z)/dt
 
@@ -124,11 +201,9 @@ class HodgkinHuxleyProposal(Proposal):
         return logp1
 
 
-class TruncatedHodgkinHuxleyProposal(Proposal):
+class TruncatedHodgkinHuxleyProposal(HodgkinHuxleyProposal):
     def __init__(self, population, t, inpt, sigma):
-        self.population = population
-        self.t = t
-        self.inpt = inpt
+        self._init_kinetics(population, t, inpt)
 
         self.sigma = sigma
         if self.sigma.ndim == 1:
@@ -140,19 +215,6 @@ class TruncatedHodgkinHuxleyProposal(Proposal):
         from distributions import TruncatedGaussianDistribution
         self.noiseclass = TruncatedGaussianDistribution()
 
-    def _hh_kinetics(self, index, Z):
-        D,Np = Z.shape
-        # Get the current input and latent states
-        current_inpt = self.inpt[index]
-        latent = as_sarray(Z, self.population.latent_dtype)
-
-        # Run the kinetics forward
-        dxdt = self.population.kinetics(latent, current_inpt)
-
-        # TODO: Wow, this is terrible. Converting to/from numpy struct array and
-        # regular arrays, and maintaining the correct shape, is a mega pain in the ass
-        return dxdt.view(np.float).reshape((Np,D)).T
-
     def sample_next(self, curr_index, Z_prev, next_index):
         # assert next_index >= curr_index
         D,Np = Z_prev.shape
@@ -160,7 +222,7 @@ class TruncatedHodgkinHuxleyProposal(Proposal):
         # Propagate forward according to the hodgkin huxley dynamics
         # then add noise, guaranteeing that we stay within the limits
         dt = self.t[next_index] - self.t[curr_index]
-        z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
+        z = self._step(curr_index, Z_prev, dt)
 
         z = np.clip(z, self.lb, self.ub)
 
@@ -181,6 +243,29 @@ class TruncatedHodgkinHuxleyProposal(Proposal):
         state = {'z' : z}
         return z + noise, logp, state
 
+    def propagate(self, curr_index, Z, next_index):
+        """ Sample the next state of the D x Np particles Z in place, clipping
+        the noiseless prediction in its reusable buffer.
+        """
+        dt = self.t[next_index] - self.t[curr_index]
+        z = self._step_into(curr_index, Z, dt, self._prediction_buffer(Z))
+        np.clip(z, self.lb, self.ub, out=z)
+
+        noise_lb = self.lb - z
+        noise_ub = self.ub - z
+
+        sig = self.sigma * dt
+        noise = self.noiseclass.sample(mu=np.zeros_like(z), sigma=sig,
+                                       lb=noise_lb, ub=noise_ub)
+        logp = self.noiseclass.logp(noise, mu=0, sigma=sig,
+                                    lb=noise_lb, ub=noise_ub)
+
+        np.add(z, noise, out=Z)
+
+        # The prediction is only valid until the next call to propagate
+        state = {'z' : z}
+        return logp, state
+
     def logp(self, curr_index, Z_prev, next_index, Z_next, state=None):
         # Propagate forward according to the hodgkin huxley dynamics
         # then add noise, guaranteeing that we stay within the limits
@@ -191,7 +276,7 @@ class TruncatedHodgkinHuxleyProposal(Proposal):
             z = state['z']
         else:
             # Run kinetics and clip to within range
-            z = Z_prev + self._hh_kinetics(curr_index, Z_prev) * dt
+            z = self._step(curr_index, Z_prev, dt)
             z = np.clip(z, self.lb, self.ub)
 
 
@@ -215,6 +300,85 @@ class TruncatedHodgkinHuxleyProposal(Proposal):
         return logp1
 
 
+class RushLarsenHodgkinHuxleyProposal(TruncatedHodgkinHuxleyProposal):
+    """
+    Truncated Hodgkin Huxley proposal that stays stable at coarse time steps.
+    Rather than taking a forward Euler step, each gating variable relaxes
+    exactly toward its steady state x_inf(V) with time constant tau(V), and
+    the compartment variables (voltage and calcium) take a semi-implicit
+    step. The gates' kinetics are linear in the gate, dx/dt = (x_inf - x) / tau,
+    so the decay rate -1/tau is the diagonal of the Jacobian of the kinetics.
+    We estimate the diagonal with finite differences, perturbing one group of
+    dimensions at a time, which works for any channel.
+    """
+    def __init__(self, population, t, inpt, sigma):
+        super(RushLarsenHodgkinHuxleyProposal, self).__init__(population, t, inpt, sigma)
+        self.groups, self.implicit = self._diagonal_groups(population)
+
+    def _diagonal_groups(self, population):
+        """
+        Partition the latent dimensions into groups that can be perturbed
+        together. The k-th variable of every compartment forms one group and
+        the k-th variable of every channel another, since a channel's
+        kinetics only depend on its compartment's variables and its own.
+
+        returns:
+        groups:     D array of the group of each dimension
+        implicit:   D boolean array, True for the compartment variables
+        """
+        D = self.layout.D
+        groups = np.zeros(D, dtype=np.int)
+        implicit = np.ones(D, dtype=np.bool)
+        n_comp = 0
+        for neuron in population.neurons:
+            for compartment in neuron.compartments:
+                channels = set(c.name for c in compartment.channels)
+                n_own = len([f for f in compartment.latent_dtype if f[0] not in channels])
+                groups[compartment.x_offset:compartment.x_offset+n_own] = np.arange(n_own)
+                n_comp = max(n_comp, n_own)
+
+        for neuron in population.neurons:
+            for compartment in neuron.compartments:
+                for c in compartment.channels:
+                    n_ch = len(c.latent_dtype) if c.latent_dtype else 0
+                    if n_ch == 0:
+                        continue
+                    groups[c.x_offset:c.x_offset+n_ch] = n_comp + np.arange(n_ch)
+                    implicit[c.x_offset:c.x_offset+n_ch] = False
+
+        return groups, implicit
+
+    def _step_into(self, index, Z, dt, out):
+        # _hh_kinetics returns a view of its buffer, so copy the kinetics
+        # before evaluating them at the perturbed states
+        dzdt = self._hh_kinetics(index, Z).copy()
+
+        # Estimate the diagonal of the Jacobian, clipped at zero so that
+        # the steps below stay stable
+        a = np.zeros_like(Z)
+        Z_eps = Z.copy()
+        for g in np.unique(self.groups):
+            inds = self.groups == g
+            eps = 1e-7 * np.maximum(1.0, abs(Z[inds]))
+            Z_eps[inds] += eps
+            a[inds] = (self._hh_kinetics(index, Z_eps)[inds] - dzdt[inds]) / eps
+            Z_eps[inds] = Z[inds]
+        a = np.minimum(a, 0)
+
+        # Exponential relaxation of the gates, which reduces to forward
+        # Euler as a*dt goes to zero
+        adt = a * dt
+        small = abs(adt) < 1e-8
+        phi = np.where(small, dt, np.expm1(adt) / np.where(small, 1.0, a))
+        np.multiply(phi, dzdt, out=out)
+        out += Z
+
+        # Semi-implicit step of the compartment variables
+        imp = self.implicit
+        out[imp] = Z[imp] + dt * dzdt[imp] / (1.0 - adt[imp])
+        return out
+
+
 class Likelihood(object):
     """
     General wrapper for a proposal distribution. It must support efficient
@@ -247,6 +411,36 @@ class NoiseLikelihood(Likelihood):
         return Z + self.noisesampler.sample(Np=Z.size)
 
 
+def gaussian_observation_terms(model):
+    """
+    Flatten the Gaussian terms of the model's observations (see
+    Observation.gaussian_terms) into the columns of the flat observation and
+    latent matrices that they read.
+
+    returns:
+    obs_cols:       O array of observed columns
+    latent_cols:    O array of latent columns
+    scales:         O array of scales
+    intercepts:     O array of intercepts
+    sigmas:         O array of noise standard deviations
+    or None if the observations have no such form.
+    """
+    terms = model.observation.gaussian_terms()
+    if terms is None:
+        return None
+
+    observed_dtype = np.dtype(model.observation.observed_dtype)
+    latent_dtype = np.dtype(model.population.latent_dtype)
+    obs_cols = np.array([Layout.offset(observed_dtype, obs_path) for (obs_path, _, _, _, _) in terms],
+                        dtype=np.intc)
+    latent_cols = np.array([Layout.offset(latent_dtype, latent_path) for (_, latent_path, _, _, _) in terms],
+                           dtype=np.intc)
+    scales = np.array([float(a) for (_, _, a, _, _) in terms], dtype=np.float64)
+    intercepts = np.array([float(b) for (_, _, _, b, _) in terms], dtype=np.float64)
+    sigmas = np.array([float(sigma) for (_, _, _, _, sigma) in terms], dtype=np.float64)
+    return obs_cols, latent_cols, scales, intercepts, sigmas
+
+
 class ObservationLikelihood(Likelihood):
     """
     Likelihood model where X is a noisy version of only a subset of Z's rows
@@ -256,7 +450,61 @@ class ObservationLikelihood(Likelihood):
         self.lb = model.population.latent_lb[:,None]
         self.ub = model.population.latent_ub[:,None]
 
+        # If the observations are Gaussian in single latent variables, read
+        # their columns straight from the particle matrix rather than viewing
+        # it as structured arrays. The parameters of the observations are
+        # fixed when the likelihood is constructed.
+        self.terms = gaussian_observation_terms(model)
+        if self.terms is not None:
+            obs_cols, latent_cols, scales, intercepts, sigmas = self.terms
+            self.obs_cols = obs_cols
+            self.latent_cols = latent_cols
+            self.scales = scales[:,None]
+            self.intercepts = intercepts[:,None]
+            self.precisions = (-0.5 / sigmas**2)[:,None]
+
+        # Only the latent variables with a finite bound need to be checked
+        lb = model.population.latent_lb
+        ub = model.population.latent_ub
+        self.bounded = np.nonzero(np.isfinite(lb) | np.isfinite(ub))[0]
+        self.bounded_lb = lb[self.bounded][:,None]
+        self.bounded_ub = ub[self.bounded][:,None]
+
+        # Buffers for the log likelihoods and bounds checks of the particles.
+        # The returned log likelihoods are overwritten by the next call.
+        self._ll = None
+
     def logp(self, X, Z):
+        if self.terms is None:
+            return self._logp_sarray(X, Z)
+
+        Np = Z.shape[1]
+        if self._ll is None or self._ll.shape[0] != Np:
+            self._ll = np.empty(Np)
+            self._resid = np.empty((self.latent_cols.size, Np))
+            self._zb = np.empty((self.bounded.size, Np))
+            self._oob = np.empty((self.bounded.size, Np), dtype=np.bool)
+
+        # Residuals of all the observations for all the particles at once
+        resid = self._resid
+        np.take(Z, self.latent_cols, axis=0, out=resid)
+        resid *= self.scales
+        resid += self.intercepts
+        np.subtract(X[self.obs_cols][:,None], resid, out=resid)
+        resid *= resid
+        resid *= self.precisions
+        ll = resid.sum(axis=0, out=self._ll)
+
+        # Check if any latent variables are out of the allowable range
+        zb = self._zb
+        np.take(Z, self.bounded, axis=0, out=zb)
+        oob = np.less(zb, self.bounded_lb, out=self._oob).any(axis=0)
+        oob |= np.greater(zb, self.bounded_ub, out=self._oob).any(axis=0)
+        ll[oob] = -np.inf
+
+        return ll
+
+    def _logp_sarray(self, X, Z):
         # View as the model's dtypes
         obs = as_sarray(X, self.model.observation.observed_dtype)
         latent = as_sarray(Z, self.model.population.latent_dtype)
@@ -336,7 +584,9 @@ class ParticleGibbsAncestorSampling(object):
                  lkhd,
                  p_initial,
                  fixed_particle,
-                 Np=1000):
+                 Np=1000,
+                 ess_threshold=None,
+                 prune_ancestry=False):
         """
         Initialize the particle filter with:
         D:           Dimensionality of latent state space
@@ -346,24 +596,35 @@ class ParticleGibbsAncestorSampling(object):
         p_initial:   Distribution over initial states
         fixed_particle: Particle representing current state of Markov chain
         Np:          The number of paricles
+        ess_threshold: If given, only resample when the effective sample size
+                     drops below ess_threshold * Np. Otherwise, resample at
+                     every step.
+        prune_ancestry: If True, keep the particle history in an ancestry tree
+                     that frees lineages as they die out, rather than storing
+                     all Np x T particles. Only the last two time steps of
+                     particles, ancestors and weights are kept in that case.
         """
         # Initialize data structures for particles and weights
         self.D = D
         self.T = T
         self.Np = Np
+        self.ess_threshold = ess_threshold
         self.proposal = proposal
         self.lkhd = lkhd
 
-        # Store the particles in a (D x Np) matrix for fast, vectorized
-        # proposals and likelihood evaluations
-        self.buffer = T
-        self.times = np.zeros(self.buffer)
+        # Store the particles time major in a (T x Np x D) array, like the
+        # Cython implementation, so that each time step is a contiguous
+        # block. Its transpose is the D x Np matrix expected by the
+        # proposals and likelihoods, without copying. When pruning the
+        # ancestry, these are circular buffers over the last two time steps.
+        self.buffer = 2 if prune_ancestry else T
 
-        # We should probably do this the other way around since
-        # T > Np > D in most cases!
-        self.particles = np.zeros((D,Np,self.buffer))
-        self.ancestors = np.zeros((Np, self.buffer), dtype=np.int)
-        self.weights = np.zeros((Np, self.buffer))
+        # Keep the type of t0, since the proposals may index with the times
+        self.times = np.zeros(self.buffer, dtype=np.asarray(t0).dtype)
+
+        self.particles = np.zeros((self.buffer, Np, D))
+        self.ancestors = np.zeros((self.buffer, Np), dtype=np.int)
+        self.weights = np.zeros((self.buffer, Np))
 
         # Keep track of the times when the filter has been called
         self.times[0] = t0
@@ -371,20 +632,30 @@ class ParticleGibbsAncestorSampling(object):
         # Store the fixed particle
         assert fixed_particle.shape == (D,T)
         self.fixed_particle = fixed_particle
+        self._fixed = np.ascontiguousarray(fixed_particle.T)
 
         # Let the first particle correspond to the fixed particle
         # Sample the initial state
-        self.particles[:,0,0] = self.fixed_particle[:,0]
-        self.particles[:,1:,0] = p_initial.sample(Np=self.Np-1)
+        self.particles[0,0] = self._fixed[0]
+        self.particles[0,1:] = p_initial.sample(Np=self.Np-1).T
 
         # Initialize weights according to observation likelihood
-        log_W = self.lkhd.logp(X0, self.particles[:,:,0])
-        self.weights[:,0] = np.exp(log_W - logsumexp(log_W))
-        self.weights[:,0] /= self.weights[:,0].sum()
+        log_W = self.lkhd.logp(X0, self.particles[0].T)
+        self.weights[0] = np.exp(log_W - logsumexp(log_W))
+        self.weights[0] /= self.weights[0].sum()
+
+        self.tree = None
+        if prune_ancestry:
+            self.tree = AncestryTree(Np, D)
+            self.tree.extend(self.particles[0])
 
         # Increment the offset to point to the next particle slot
         self.offset = 1
 
+    def _slot(self, t):
+        # Index of time t in the particle, ancestor and weight buffers
+        return t % self.buffer
+
     def filter(self,
                t_next,
                X_next,
@@ -392,114 +663,285 @@ class ParticleGibbsAncestorSampling(object):
         """
         Filter a given observation sequence to get a sequence of latent states, Z.
         """
-        # Save the current filter time
-        self.times[self.offset] = t_next
+        prev = self._slot(self.offset-1)
+        curr = self._slot(self.offset)
 
-        # First, ressample the previous parents
-        curr_ancestors = self._resample(self.weights[:, self.offset-1],
-                                        resample_method)
+        # Save the current filter time
+        self.times[curr] = t_next
+
+        # First, ressample the previous parents if the weights have degenerated.
+        # Otherwise, each particle is its own parent and carries its weight.
+        w_prev = self.weights[prev]
+        resampled = self.ess_threshold is None or \
+                    effective_sample_size(w_prev) < self.ess_threshold * self.Np
+        if resampled:
+            curr_ancestors = self._resample(w_prev, resample_method)
+        else:
+            curr_ancestors = np.arange(self.Np)
         # TODO Is permutation necessary?
         # curr_ancestors = np.random.permutation(curr_ancestors)
 
-        # Move each particle forward according to the proposal distribution
-        prev_particles = self.particles[:,curr_ancestors,self.offset-1]
-        new_particles, _, state = self.proposal.sample_next(self.times[self.offset-1],
-                                                                     prev_particles,
-                                                                     t_next)
-        self.particles[:,:, self.offset] = new_particles
+        # Copy the parents straight into the next time slot and move each
+        # particle forward, in place, according to the proposal distribution
+        prev_particles = self.particles[prev]
+        curr_particles = self.particles[curr]
+        np.take(prev_particles, curr_ancestors, axis=0,
+                out=curr_particles, mode='clip')
+        _, state = self.proposal.propagate(self.times[prev],
+                                           curr_particles.T,
+                                           t_next)
 
         # Override the first particle with the fixed particle
-        self.particles[:, 0, self.offset] = self.fixed_particle[:, self.offset]
-
-        # Resample the parent index of the fixed particle
-        logw_as = np.log(self.weights[:,self.offset-1]) + \
-                  self.proposal.logp(self.times[self.offset-1],
-                                     self.particles[:,:,self.offset-1],
-                                     t_next,
-                                     self.fixed_particle[:,self.offset].reshape(self.D,1),
-                                     state=state
-                                     )
-        w_as = np.exp(logw_as - logsumexp(logw_as))
-        w_as /= w_as.sum()
-
-        # import pdb; pdb.set_trace()
-        curr_ancestors[0] = np.random.choice(np.arange(self.Np),
-                                             p=w_as)
-                                             
-        # curr_ancestors[0] = np.sum(np.cumsum(w_as) < np.random.rand()) - 1
+        curr_particles[0] = self._fixed[self.offset]
+
+        # Resample the parent index of the fixed particle. Without a
+        # resampling step every particle keeps its own parent and weight, so
+        # the fixed particle stays attached to the previous fixed particle.
+        if resampled:
+            logw_as = np.log(w_prev) + \
+                      self.proposal.logp(self.times[prev],
+                                         prev_particles.T,
+                                         t_next,
+                                         self._fixed[self.offset].reshape(self.D,1),
+                                         state=state
+                                         )
+            w_as = np.exp(logw_as - logsumexp(logw_as))
+            w_as /= w_as.sum()
+
+            curr_ancestors[0] = sample_index(w_as)
 
         # Save the ancestors
-        self.ancestors[:, self.offset] = curr_ancestors
-
-        # Update the weights. Since we sample from the prior,
-        # the particle weights are always just a function of the likelihood
-        log_W = self.lkhd.logp(X_next, self.particles[:,:,self.offset])
+        self.ancestors[curr] = curr_ancestors
+        if self.tree is not None:
+            self.tree.extend(curr_particles, curr_ancestors)
+
+        # Update the weights. Since we sample from the prior, the particle
+        # weights are just a function of the likelihood after resampling
+        log_W = self.lkhd.logp(X_next, curr_particles.T)
+        if not resampled:
+            with np.errstate(divide='ignore'):
+                log_W = log_W + np.log(w_prev)
         w = np.exp(log_W - logsumexp(log_W))
         w /= w.sum()
-        self.weights[:, self.offset] = w
+        self.weights[curr] = w
 
         # Increment the offset
         self.offset += 1
 
     def get_trajectory(self, i):
-        # Compute the i-th trajectory from the particles and ancestors
+        # Trace back the lineage of only the i-th particle
+        if self.tree is not None:
+            return self.tree.trajectory(i).T
+
         T = self.offset
 
-        x = np.zeros((self.D, T))
-        x[:,T-1] = self.particles[:,i,T-1]
-        curr_ancestor = self.ancestors[i,T-1]
+        x = np.zeros((T, self.D))
+        x[T-1] = self.particles[T-1,i]
+        curr_ancestor = self.ancestors[T-1,i]
 
         for t in np.arange(T-1)[::-1]:
-            x[:,t] = self.particles[:,curr_ancestor,t]
-            curr_ancestor = self.ancestors[curr_ancestor, t]
-        return x
+            x[t] = self.particles[t,curr_ancestor]
+            curr_ancestor = self.ancestors[t,curr_ancestor]
+        return x.T
 
     @property
     def trajectories(self):
         # Compute trajectories from the particles and ancestors
+        if self.tree is not None:
+            return np.array([self.tree.trajectory(i) for i in range(self.Np)]).transpose((2,0,1))
+
         T = self.offset
 
-        if not np.allclose(self.particles[:,0,:T], self.fixed_particle[:,:T]):
+        if not np.allclose(self.particles[:T,0], self._fixed[:T]):
             import pdb; pdb.set_trace()
 
-        x = np.zeros((self.D, self.Np, T))
-        x[:,:,T-1] = self.particles[:,:,T-1]
-        curr_ancestors = self.ancestors[:,T-1]
+        x = np.zeros((T, self.Np, self.D))
+        x[T-1] = self.particles[T-1]
+        curr_ancestors = self.ancestors[T-1]
 
         for t in np.arange(T-1)[::-1]:
-            x[:,:,t] = self.particles[:,curr_ancestors,t]
-            curr_ancestors = self.ancestors[curr_ancestors, t]
-        return x
+            x[t] = self.particles[t,curr_ancestors]
+            curr_ancestors = self.ancestors[t,curr_ancestors]
+        return x.transpose((2,1,0))
 
     @property
     def trajectory_weights(self):
-        return self.weights[:, self.offset-1]
+        return self.weights[self._slot(self.offset-1)]
 
     def sample_trajectory(self):
         # Sample a particular weight trace given the particle weights at time T
-        # i = np.sum(np.cumsum(self.trajectory_weights) < np.random.rand()) - 1
-        i = np.random.choice(np.arange(self.Np), p=self.trajectory_weights)
-        return self.trajectories[:,i,:self.offset].reshape((self.D,self.offset))
+        i = sample_index(self.trajectory_weights)
+        return self.get_trajectory(i)
 
     def _resample(self, w, method='lowvariance'):
         # Resample all but the fixed particle
-        assert method in ['lowvariance','independent']
-        if method is 'lowvariance':
-            sources = self._lowvariance_sources(w, self.Np)
-        if method is 'independent':
-            sources = self._independent_sources(w, self.Np)
-
-        return sources
+        return resample(w, self.Np, method)
 
     def _independent_sources(self, w, num):
         # Return an ordered array of source indices from source counts
         # e.g. if the sources are 3x'0', 2x'1', 0x'2', and 1x'3', as specified
         # by the vector [3,2,0,1], then the output will be
         # [0, 0, 0, 1, 1, 3]
-        return ibincount(np.random.multinomial(num,w))
+        return multinomial_resample(w, num)
 
     def _lowvariance_sources(self, w, num):
-        r = np.random.rand()/num
-        bins = np.concatenate(((0,),np.cumsum(w)))
-        return ibincount(np.histogram(r+np.linspace(0,1,num,endpoint=False), bins)[0])
+        return systematic_resample(w, num)
+
+
+class OnlineParticleFilter(object):
+    """
+    A bootstrap particle filter that consumes the observations in chunks, e.g.
+    as they are read from disk, and only keeps a fixed-lag window of the
+    particle history. It emits filtered and fixed-lag smoothed estimates of
+    the latent state as it goes, so memory does not grow with the length of
+    the recording.
+    """
+    def __init__(self,
+                 D,
+                 proposal,
+                 lkhd,
+                 p_initial,
+                 Np=1000,
+                 lag=100,
+                 ess_threshold=None,
+                 resample_method='lowvariance'):
+        """
+        Initialize the particle filter with:
+        D:           Dimensionality of latent state space
+        proposal:    A proposal distribution for new particles given old.
+                     It is called with the global time index of each step.
+        lkhd:        An observation likelihood model for particles
+        p_initial:   Distribution over initial states
+        Np:          The number of paricles
+        lag:         The number of time steps of particle history to keep.
+                     Smoothed estimates condition on the observations up to
+                     lag steps after the estimated time.
+        ess_threshold: If given, only resample when the effective sample size
+                     drops below ess_threshold * Np.
+        resample_method: The resampling scheme to use
+        """
+        assert lag >= 1, "The lag must be at least one time step"
+        self.D = D
+        self.Np = Np
+        self.lag = lag
+        self.proposal = proposal
+        self.lkhd = lkhd
+        self.p_initial = p_initial
+        self.ess_threshold = ess_threshold
+        self.resample_method = resample_method
+
+        # Circular buffers over the last lag+1 time steps
+        self.buffer = lag + 1
+        self.particles = np.zeros((self.buffer, Np, D))
+        self.ancestors = np.zeros((self.buffer, Np), dtype=np.int)
+        self.weights = np.zeros(Np)
 
+        # Number of time steps filtered so far
+        self.offset = 0
+
+    def _slot(self, t):
+        return t % self.buffer
+
+    def _step(self, X):
+        t = self.offset
+        curr_particles = self.particles[self._slot(t)]
+
+        if t == 0:
+            curr_particles[...] = self.p_initial.sample(Np=self.Np).T
+            log_W = self.lkhd.logp(X, curr_particles.T)
+
+        else:
+            w_prev = self.weights
+            resampled = self.ess_threshold is None or \
+                        effective_sample_size(w_prev) < self.ess_threshold * self.Np
+            if resampled:
+                curr_ancestors = resample(w_prev, self.Np, self.resample_method)
+            else:
+                curr_ancestors = np.arange(self.Np)
+
+            prev_particles = self.particles[self._slot(t-1)]
+            np.take(prev_particles, curr_ancestors, axis=0,
+                    out=curr_particles, mode='clip')
+            self.proposal.propagate(t-1, curr_particles.T, t)
+            self.ancestors[self._slot(t)] = curr_ancestors
+
+            log_W = self.lkhd.logp(X, curr_particles.T)
+            if not resampled:
+                with np.errstate(divide='ignore'):
+                    log_W = log_W + np.log(w_prev)
+
+        w = np.exp(log_W - logsumexp(log_W))
+        self.weights = w / w.sum()
+        self.offset += 1
+
+    def _lineage_means(self, lags):
+        """
+        Weighted means of the current particles' ancestors at each of the
+        given increasing lags behind the most recent time step.
+        """
+        t = self.offset - 1
+        means = np.zeros((self.D, len(lags)))
+        idx = np.arange(self.Np)
+        k = 0
+        for j, lag in enumerate(lags):
+            # Trace the lineages back from lag k to the requested lag
+            while k < lag:
+                idx = self.ancestors[self._slot(t-k)][idx]
+                k += 1
+            means[:,j] = np.dot(self.weights, self.particles[self._slot(t-lag)][idx])
+        return means
+
+    def filter(self, X):
+        """
+        Filter a chunk of observations.
+
+        X:  O x n matrix of the next n observations
+
+        returns:
+        filtered:   D x n matrix of the filtered mean of each time step in the chunk
+        smoothed:   D x m matrix of the fixed-lag smoothed means of the time steps
+                    that fell lag steps behind the filter during the chunk.
+                    These are the m = n steps beginning lag steps before the
+                    chunk, except at the start of the recording.
+        """
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X[None,:]
+
+        n = X.shape[1]
+        filtered = np.zeros((self.D, n))
+        smoothed = []
+        for i in range(n):
+            self._step(X[:,i])
+            filtered[:,i] = np.dot(self.weights, self.particles[self._slot(self.offset-1)])
+            if self.offset > self.lag:
+                smoothed.append(self._lineage_means([self.lag]))
+
+        if len(smoothed) > 0:
+            smoothed = np.hstack(smoothed)
+        else:
+            smoothed = np.zeros((self.D, 0))
+        return filtered, smoothed
+
+    def flush(self):
+        """
+        Smoothed means of the final time steps that are still in the window,
+        given all of the observations.
+
+        returns:
+        D x min(lag, T) matrix of means for the last time steps, in order
+        """
+        lags = np.arange(min(self.lag, self.offset))
+        return self._lineage_means(lags)[:,::-1]
+
+    def filter_stream(self, chunks):
+        """
+        Filter an iterable of O x n observation chunks, yielding the filtered
+        and smoothed means of each chunk as they become available. The final
+        yield has no filtered estimates and flushes the remaining smoothed
+        estimates, so that concatenating the yields gives estimates for every
+        time step.
+        """
+        for X in chunks:
+            yield self.filter(X)
+        yield np.zeros((self.D, 0)), self.flush()
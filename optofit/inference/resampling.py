@@ -0,0 +1,108 @@
+"""
+Resampling schemes for the particle filters.
+
+Each scheme takes a vector of N particle weights and returns the sorted
+source (ancestor) indices of the resampled particles. Rather than histogramming
+N sorted points against the weight CDF, we count how many points fall below
+each edge of the CDF in closed form, which is a single O(N) pass, and expand
+the counts with ibincount.
+"""
+import numpy as np
+
+from optofit.utils.utils import ibincount
+
+def _normalize(w):
+    w = np.asarray(w, dtype=np.float64)
+    return w / w.sum()
+
+def _stratified_counts(w, num, r):
+    """
+    Count the points u_k = (k + r_k) / num, k=0..num-1, that fall into each
+    bin of the CDF of w. r may be a scalar (systematic) or a num array
+    (stratified) of uniform random variables in [0, 1).
+
+    Every stratum below floor(num*c) lies entirely below the CDF edge c, so the
+    number of points below c is floor(num*c) plus one if the point in
+    stratum floor(num*c) is itself below c.
+    """
+    Nc = num * np.cumsum(w)
+    m = np.minimum(np.floor(Nc).astype(np.intp), num)
+    r = np.concatenate((np.broadcast_to(r, (num,)), (1.0,)))
+    below = m + (r[m] < Nc - m)
+
+    # Make sure round off in the cumulative sum does not lose any points
+    below[-1] = num
+    return np.diff(np.concatenate(((0,), below)))
+
+def multinomial_resample(w, num=None):
+    """
+    Draw num independent sources from the categorical distribution w.
+    """
+    w = _normalize(w)
+    num = w.size if num is None else num
+    return ibincount(np.random.multinomial(num, w))
+
+def stratified_resample(w, num=None):
+    """
+    Draw one uniform point independently from each of num equally sized
+    strata of [0, 1) and invert the CDF of w at each point.
+    """
+    w = _normalize(w)
+    num = w.size if num is None else num
+    return ibincount(_stratified_counts(w, num, np.random.rand(num)))
+
+def systematic_resample(w, num=None):
+    """
+    Low variance resampling. Like stratified resampling, except a single
+    uniform offset is shared by all num strata.
+    """
+    w = _normalize(w)
+    num = w.size if num is None else num
+    return ibincount(_stratified_counts(w, num, np.random.rand()))
+
+def residual_resample(w, num=None):
+    """
+    Deterministically keep floor(num*w) copies of each particle and fill the
+    remaining slots by multinomial resampling of the residual weights.
+    """
+    w = _normalize(w)
+    num = w.size if num is None else num
+    counts = np.floor(num * w).astype(np.intp)
+    R = num - counts.sum()
+    if R > 0:
+        residual = num * w - counts
+        counts += np.random.multinomial(R, residual / residual.sum())
+    return ibincount(counts)
+
+# Map from names to resampling schemes. 'lowvariance' and 'independent' are
+# the names used by the original particle filter implementation.
+resampling_methods = {'multinomial' : multinomial_resample,
+                      'independent' : multinomial_resample,
+                      'stratified'  : stratified_resample,
+                      'systematic'  : systematic_resample,
+                      'lowvariance' : systematic_resample,
+                      'residual'    : residual_resample}
+
+def resample(w, num=None, method='systematic'):
+    """
+    Resample num sources from the weights w with the given scheme.
+    """
+    if method not in resampling_methods:
+        raise Exception("Unrecognized resampling method: %s" % method)
+    return resampling_methods[method](w, num)
+
+def effective_sample_size(w):
+    """
+    Effective sample size, 1 / sum(w**2), of the normalized weights w.
+    """
+    w = _normalize(w)
+    return 1.0 / np.dot(w, w)
+
+def sample_index(w):
+    """
+    Draw a single index from the (possibly unnormalized) weights w. Unlike
+    np.random.choice, this does not validate the weights on every call.
+    """
+    cdf = np.cumsum(w)
+    i = np.searchsorted(cdf, np.random.rand() * cdf[-1], side='right')
+    return min(i, cdf.size - 1)
@@ -0,0 +1,440 @@
+"""
+Storage for the samples collected by MCMC.
+
+Rather than deep copying the entire model, including all of its data
+sequences, at every iteration, the sampler mutates a single live model in
+place and records the samples in a store. The store only keeps the parameters
+that changed at each iteration, plus optionally thinned copies of the latent
+state trajectories.
+"""
+import copy
+import json
+import os
+import numpy as np
+
+from optofit.models.parameters import Parameter
+from optofit.models.hyperparameters import hypers
+from optofit.models.model import DataSequence
+
+def model_parameters(model, include_hypers=True):
+    """
+    List the (name, parameter) pairs of the model. Parameters are named by the
+    path of the component they belong to, e.g. 'neuron/body/na/g', and those
+    shared by several components are listed once, under their first name.
+    Hyperparameters that do not belong to any component, like sig_V, are
+    named after their key in the hypers dict.
+    """
+    params = []
+    seen = set()
+
+    def add(name, param):
+        if id(param) not in seen:
+            seen.add(id(param))
+            params.append((name, param))
+
+    def walk(component, path):
+        for attr, value in sorted(vars(component).items()):
+            if isinstance(value, Parameter):
+                add('/'.join(path + [attr.lstrip('_')]), value)
+
+        for child in component.children:
+            walk(child, path + [child.name])
+
+    for neuron in model.population.neurons:
+        walk(neuron, [neuron.name])
+
+    if model.observation is not None:
+        walk(model.observation, [model.observation.name])
+        for observation in getattr(model.observation, 'observations', []):
+            walk(observation, [observation.name])
+
+    if include_hypers:
+        for name in sorted(hypers.keys()):
+            add(name, hypers[name])
+
+    return params
+
+
+class SampleStore(object):
+    """
+    In-memory store of MCMC samples. Call record after each iteration.
+    """
+    def __init__(self, model, latent_thin=None):
+        """
+        model:       The live model that the sampler updates in place
+        latent_thin: Keep a copy of the latent state trajectories every
+                     latent_thin iterations, or never if None (the default),
+                     so that memory does not grow with the length of the data.
+        """
+        self.model = model
+        self.latent_thin = latent_thin
+        self.params = model_parameters(model)
+        self.names = [name for name, _ in self.params]
+
+        # For each parameter, the iterations at which it changed and its values
+        self.changes = dict((name, ([], [])) for name in self.names)
+
+        # Iterations at which the latent states were kept, and the latent
+        # state of each data sequence at those iterations
+        self.latent_iters = []
+        self.latents = []
+
+        self.N = 0
+
+    def record(self):
+        """
+        Record the current state of the live model as the next sample
+        """
+        i = self.N
+        for name, param in self.params:
+            iters, values = self.changes[name]
+            value = np.array(param.value, copy=True)
+            if len(values) == 0 or not np.array_equal(values[-1], value):
+                iters.append(i)
+                values.append(value)
+
+        if self.latent_thin is not None and i % self.latent_thin == 0:
+            self.latent_iters.append(i)
+            self.latents.append([data.latent.copy() for data in self.model.data_sequences])
+
+        self.N += 1
+
+    def flush(self):
+        """
+        Nothing to do for an in-memory store
+        """
+        pass
+
+    def truncate(self, N):
+        """
+        Discard the samples from iteration N on, e.g. to resume a chain from a
+        checkpoint taken at iteration N-1.
+        """
+        N = min(N, self.N)
+        for name in self.names:
+            iters, values = self.changes[name]
+            n = np.searchsorted(iters, N)
+            del iters[n:]
+            del values[n:]
+
+        n = np.searchsorted(self.latent_iters, N)
+        del self.latent_iters[n:]
+        del self.latents[n:]
+        self.N = N
+
+    def __len__(self):
+        return self.N
+
+    def _index(self, i):
+        if i < 0:
+            i += self.N
+        if i < 0 or i >= self.N:
+            raise IndexError("Sample index out of range")
+        return i
+
+    def parameter(self, name, i):
+        """
+        Value of the named parameter at iteration i
+        """
+        i = self._index(i)
+        iters, values = self.changes[name]
+        return values[np.searchsorted(iters, i, side='right') - 1]
+
+    def parameters(self, i):
+        """
+        Dict of the values of all parameters at iteration i
+        """
+        return dict((name, self.parameter(name, i)) for name in self.names)
+
+    def trace(self, name):
+        """
+        Array of the named parameter's values at every iteration
+        """
+        iters, values = self.changes[name]
+        index = np.searchsorted(iters, np.arange(self.N), side='right') - 1
+        return np.array(values)[index]
+
+    def latent(self, i):
+        """
+        List of the latent states of each data sequence at iteration i, or None
+        if they were not kept at that iteration.
+        """
+        i = self._index(i)
+        j = np.searchsorted(self.latent_iters, i)
+        if j < len(self.latent_iters) and self.latent_iters[j] == i:
+            return self.latents[j]
+        return None
+
+    def __getitem__(self, i):
+        """
+        Reconstruct the model at iteration i. The last sample is the live
+        model itself. Otherwise, this makes a copy of the model that shares
+        the data sequences' time points, inputs and observations with the
+        live model. If the latent states were not kept at iteration i, the
+        copy's latent states and states are None.
+        """
+        i = self._index(i)
+        if i == self.N - 1:
+            return self.model
+
+        # Copy everything but the data
+        data_sequences = self.model.data_sequences
+        self.model.data_sequences = []
+        try:
+            model = copy.deepcopy(self.model)
+        finally:
+            self.model.data_sequences = data_sequences
+
+        for name, param in model_parameters(model, include_hypers=False):
+            param._value = self.parameter(name, i).copy()
+
+        latents = self.latent(i)
+        for k, data in enumerate(data_sequences):
+            latent = states = None
+            if latents is not None:
+                latent = latents[k]
+                states = model.population.evaluate_state(latent, data.input)
+            model.add_data_sequence(DataSequence(data.name, data.t, data.stimuli,
+                                                 data.observations, latent,
+                                                 data.input, states))
+        return model
+
+    def __iter__(self):
+        for i in range(self.N):
+            yield self[i]
+
+
+def _descr_to_dtype(descr):
+    """
+    Rebuild a (possibly nested) structured dtype from its descr, after a round
+    trip through JSON has turned its tuples into lists.
+    """
+    fields = []
+    for field in descr:
+        fmt = field[1]
+        if isinstance(fmt, list):
+            fmt = _descr_to_dtype(fmt)
+        else:
+            fmt = str(fmt)
+        fields.append((str(field[0]), fmt) + tuple(tuple(shape) for shape in field[2:]))
+    return np.dtype(fields)
+
+
+class DiskSampleStore(object):
+    """
+    Append-only store of MCMC samples on disk. This has the same record
+    interface as SampleStore, so fit_mcmc can stream into it, but it only
+    holds a chunk of samples in memory at a time.
+
+    The store is a directory with:
+    meta.json:          names, shapes and offsets of the parameters, and
+                        the latent state dtype
+    parameters.dat:     one row of float64 parameter values per iteration
+    latent_<k>.dat:     thinned and downsampled latent states of data
+                        sequence k, one row of T/latent_downsample per
+                        kept iteration
+
+    Use SampleReader to read it back as memory mapped arrays.
+    """
+    def __init__(self, model, path, latent_thin=1, latent_downsample=1, chunk_size=100,
+                 append=False):
+        """
+        model:       The live model that the sampler updates in place
+        path:        Directory in which to store the samples
+        latent_thin: Keep the latent state trajectories every latent_thin
+                     iterations, or never if None.
+        latent_downsample: Keep every latent_downsample-th time step of the
+                     latent state trajectories
+        chunk_size:  Number of samples to buffer in memory between writes
+        append:      Continue an existing store at path rather than starting
+                     a new one, e.g. when resuming from a checkpoint
+        """
+        self.model = model
+        self.path = path
+        self.latent_thin = latent_thin
+        self.latent_downsample = latent_downsample
+        self.chunk_size = chunk_size
+        self.params = model_parameters(model)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # Lay out the parameters in a flat row
+        names, shapes, offsets = [], [], []
+        P = 0
+        for name, param in self.params:
+            shape = np.shape(param.value)
+            names.append(name)
+            shapes.append(list(shape))
+            offsets.append(P)
+            P += int(np.prod(shape))
+        self.P = P
+
+        T = [int(np.ceil(data.T / float(latent_downsample))) for data in model.data_sequences]
+        self.T = T
+        self._latent_bytes = [t * np.dtype(model.population.latent_dtype).itemsize for t in T]
+
+        self._params_buffer = []
+        self._latent_buffer = []
+
+        if append and os.path.exists(os.path.join(path, 'meta.json')):
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            if meta['names'] != names or meta['P'] != P or meta['T'] != T or \
+               meta['latent_thin'] != latent_thin or meta['latent_downsample'] != latent_downsample:
+                raise Exception("Cannot append to a sample store with a different layout")
+            self.N = os.path.getsize(os.path.join(path, 'parameters.dat')) // (8 * P)
+            self.truncate(self.N)
+            return
+
+        meta = {'names': names, 'shapes': shapes, 'offsets': offsets, 'P': P,
+                'latent_thin': latent_thin, 'latent_downsample': latent_downsample,
+                'T': T, 'latent_dtype': np.dtype(model.population.latent_dtype).descr}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        # Start with empty data files
+        open(os.path.join(path, 'parameters.dat'), 'wb').close()
+        for k in range(len(T)):
+            open(os.path.join(path, 'latent_%d.dat' % k), 'wb').close()
+        self.N = 0
+
+    def record(self):
+        """
+        Record the current state of the live model as the next sample
+        """
+        row = np.concatenate([np.asarray(param.value, dtype=np.float64).ravel()
+                              for _, param in self.params])
+        self._params_buffer.append(row)
+
+        if self.latent_thin is not None and self.N % self.latent_thin == 0:
+            self._latent_buffer.append([data.latent[::self.latent_downsample].copy()
+                                        for data in self.model.data_sequences])
+
+        self.N += 1
+        if len(self._params_buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered samples to the files on disk
+        """
+        if len(self._params_buffer) > 0:
+            with open(os.path.join(self.path, 'parameters.dat'), 'ab') as f:
+                f.write(np.array(self._params_buffer).tobytes())
+
+        for k in range(len(self.model.data_sequences)):
+            if len(self._latent_buffer) > 0:
+                with open(os.path.join(self.path, 'latent_%d.dat' % k), 'ab') as f:
+                    for latents in self._latent_buffer:
+                        f.write(latents[k].tobytes())
+
+        self._params_buffer = []
+        self._latent_buffer = []
+
+    def truncate(self, N):
+        """
+        Discard the samples from iteration N on, e.g. to resume a chain from a
+        checkpoint taken at iteration N-1. This also cuts off any partially
+        written rows left behind by an interrupted run.
+        """
+        self.flush()
+        self.N = N = min(N, self.N)
+        with open(os.path.join(self.path, 'parameters.dat'), 'r+b') as f:
+            f.truncate(N * 8 * self.P)
+
+        n_latent = 0
+        if self.latent_thin is not None:
+            n_latent = (N + self.latent_thin - 1) // self.latent_thin
+        for k, row_bytes in enumerate(self._latent_bytes):
+            with open(os.path.join(self.path, 'latent_%d.dat' % k), 'r+b') as f:
+                f.truncate(n_latent * row_bytes)
+
+    def __len__(self):
+        return self.N
+
+    def reader(self):
+        """
+        Flush the buffered samples and open the store for reading
+        """
+        self.flush()
+        return SampleReader(self.path)
+
+
+class SampleReader(object):
+    """
+    Read the samples written by a DiskSampleStore. The data files are memory
+    mapped, so slicing e.g. one conductance across iterations or one
+    iteration's voltage only reads that part from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        self.names = [str(name) for name in meta['names']]
+        self.shapes = dict((name, tuple(shape)) for name, shape in zip(self.names, meta['shapes']))
+        self.offsets = dict(zip(self.names, meta['offsets']))
+        self.P = meta['P']
+        self.latent_thin = meta['latent_thin']
+        self.latent_downsample = meta['latent_downsample']
+        self.T = meta['T']
+        self.latent_dtype = _descr_to_dtype(meta['latent_dtype'])
+
+        # Infer the number of samples from the file size, so that a store
+        # that is still being written, or was interrupted, can be read
+        row_bytes = 8 * self.P
+        self.N = os.path.getsize(os.path.join(path, 'parameters.dat')) // row_bytes
+        self._parameters = self._memmap('parameters.dat', np.float64, self.P)
+
+    def _memmap(self, filename, dtype, row_size):
+        filename = os.path.join(self.path, filename)
+        N = os.path.getsize(filename) // (np.dtype(dtype).itemsize * row_size)
+        if N == 0:
+            return np.zeros((0, row_size), dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(N, row_size))
+
+    def __len__(self):
+        return self.N
+
+    def trace(self, name):
+        """
+        N x shape array of the named parameter's values at every iteration
+        """
+        offset = self.offsets[name]
+        shape = self.shapes[name]
+        size = int(np.prod(shape))
+        return self._parameters[:self.N, offset:offset+size].reshape((-1,) + shape)
+
+    def parameters(self, i):
+        """
+        Dict of the values of all parameters at iteration i
+        """
+        row = self._parameters[i]
+        return dict((name, row[self.offsets[name]:self.offsets[name] + int(np.prod(self.shapes[name]))]
+                     .reshape(self.shapes[name]))
+                    for name in self.names)
+
+    @property
+    def latent_iterations(self):
+        """
+        Iterations at which the latent states were kept
+        """
+        if self.latent_thin is None:
+            return np.zeros(0, dtype=np.int)
+        return np.arange(0, self.N, self.latent_thin)
+
+    def latents(self, k=0):
+        """
+        Memory mapped array of the kept latent states of data sequence k, with
+        one row for each of the latent_iterations.
+        """
+        return self._memmap('latent_%d.dat' % k, self.latent_dtype, self.T[k])
+
+    def latent(self, i, k=0):
+        """
+        Latent state of data sequence k at iteration i, or None if it was not kept
+        """
+        if self.latent_thin is None or i % self.latent_thin != 0:
+            return None
+        return self.latents(k)[i // self.latent_thin]
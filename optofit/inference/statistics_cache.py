@@ -0,0 +1,138 @@
+"""
+Statistics of the latent trajectories shared by the MCMC updates.
+
+The conductance and noise updates all regress the membrane current onto the
+channel currents, so within a sweep they would each re-derive dV/dt, the
+channel current matrix and the one step predictions from the same latent
+trajectory. A StatisticsCache computes these lazily, once per data sequence,
+and keeps them until the latent trajectory changes. The sum of squared
+residuals of the one step predictions also depends on the parameters, so it
+is recomputed when any of them change.
+"""
+import numpy as np
+
+from optofit.inference.sample_store import model_parameters
+from optofit.utils.utils import get_item_at_path
+
+class SequenceStatistics(object):
+    """
+    Lazily computed statistics of a single data sequence's latent trajectory.
+    """
+    def __init__(self, model, data):
+        self.model = model
+        self.data = data
+
+        # The statistics are valid as long as the data sequence holds the
+        # same latent and state arrays. The samplers assign new arrays
+        # rather than writing into the old ones.
+        self.latent = data.latent
+        self.states = data.states
+
+        self.dt = data.t[1:] - data.t[:-1]
+
+        self._dV_dt = {}
+        self._currents = {}
+        self._sq_residuals = None
+        self._param_values = None
+
+    @property
+    def valid(self):
+        return self.data.latent is self.latent and self.data.states is self.states
+
+    def dV_dt(self, compartment):
+        """
+        T-1 array of the first order differences of the compartment's voltage
+        """
+        key = tuple(compartment.path)
+        if key not in self._dV_dt:
+            V = get_item_at_path(self.states, compartment.path)['V']
+            self._dV_dt[key] = (V[1:] - V[:-1]) / self.dt
+        return self._dV_dt[key]
+
+    def current_channels(self, compartment):
+        """
+        Channels of the compartment that carry a current, in the order of the
+        columns of the current matrix
+        """
+        s_comp = get_item_at_path(self.states, compartment.path)
+        return [ch for ch in compartment.channels
+                if s_comp[ch.name].dtype.names is not None and
+                   'I' in s_comp[ch.name].dtype.names]
+
+    def currents(self, compartment):
+        """
+        T x C matrix of the negated, unscaled currents through the channels of
+        the compartment, such that C*dV/dt = currents * g + I_in.
+        """
+        key = tuple(compartment.path)
+        if key not in self._currents:
+            s_comp = get_item_at_path(self.states, compartment.path)
+            chs = self.current_channels(compartment)
+            I = np.empty((self.data.T, len(chs)))
+            for (i,ch) in enumerate(chs):
+                I[:,i] = -1.0*s_comp[ch.name]['I']
+            self._currents[key] = I
+        return self._currents[key]
+
+    def sq_residuals(self):
+        """
+        D array of the sums over time of the squared residuals, per unit time,
+        of the noiseless one step predictions of the latent state, i.e. of
+        (x_pred[t+1] - x[t+1]) / dt.
+        """
+        param_values = [np.asarray(param.value) for _, param in
+                        model_parameters(self.model, include_hypers=False)]
+        if self._sq_residuals is None or \
+           not all(np.array_equal(v1, v2) for v1, v2 in zip(param_values, self._param_values)):
+            population = self.model.population
+            layout = population.layout
+            x = layout.flatten_latent(self.latent)
+
+            # The transition model is a noisy Hodgkin Huxley proposal. Compute
+            # the noiseless one step predictions for the entire sequence at once.
+            dxdt,_ = population.trajectory_kinetics(self.latent[:-1], self.data.input[:-1])
+            pred = np.clip(x[:-1] + layout.flatten_latent(dxdt) * self.dt[:,None],
+                           population.latent_lb, population.latent_ub)
+
+            self._sq_residuals = (((pred - x[1:]) / self.dt[:,None])**2).sum(axis=0)
+            self._param_values = param_values
+        return self._sq_residuals
+
+
+class StatisticsCache(object):
+    """
+    Cache of the SequenceStatistics of each of a model's data sequences. Pass
+    one to the updates of an MCMC sweep to share the statistics between them.
+    """
+    def __init__(self, model):
+        self.model = model
+        self._statistics = {}
+
+    def get(self, data):
+        """
+        Statistics of the data sequence, recomputed if its latent state changed
+        """
+        stats = self._statistics.get(id(data))
+        if stats is None or stats.data is not data or not stats.valid:
+            stats = SequenceStatistics(self.model, data)
+            self._statistics[id(data)] = stats
+        return stats
+
+    def invalidate(self, data=None):
+        """
+        Drop the statistics of the data sequence, or of all of them, e.g. after
+        modifying a latent state in place.
+        """
+        if data is None:
+            self._statistics = {}
+        else:
+            self._statistics.pop(id(data), None)
+
+
+def sequence_statistics(model, data, cache=None):
+    """
+    Statistics of the data sequence, from the cache if one is given
+    """
+    if cache is not None:
+        return cache.get(data)
+    return SequenceStatistics(model, data)
@@ -15,6 +15,12 @@ class Component(object):
         self._hyperparameters = []
         self._path = None
 
+        # Offsets into the flat latent, state, and input buffers.
+        # These are set by optofit.models.layout.Layout
+        self.x_offset = None
+        self.s_offset = None
+        self.i_offset = None
+
     @property
     def name(self):
         return self._name
@@ -74,6 +74,19 @@ hl.append(Parameter('sig_ch', 0.01, lb=0.0))
 hl.append(Parameter('N_particles', 1000, lb=10))
 hl.append(Parameter('sig_obs_V', 5.0, lb=0.0))
 
+### Inference Parameters ###
+# Number of worker processes used to update the latent states of
+# independent data sequences in parallel
+hl.append(Parameter('N_workers', 1, lb=1))
+
+# Resample the particles only when their effective sample size drops below
+# ess_threshold * N_particles. A threshold of 1 resamples at every step.
+hl.append(Parameter('ess_threshold', 1.0, lb=0.0, ub=1.0))
+
+# If 1, keep the particle history in an ancestry tree that frees lineages
+# as they die out, rather than storing all N_particles x T particles
+hl.append(Parameter('prune_ancestry', 0, lb=0, ub=1))
+
 
 ### Convert this to a dict
 hypers = {}
@@ -0,0 +1,102 @@
+"""
+A flat float64 layout for the latent, state and input variables of a population.
+
+The hierarchical structured arrays (population -> neuron -> compartment -> channel)
+are convenient for describing a model, but walking them with get_item_at_path and
+rebuilding nested arrays at every level is far too slow for the particle filter.
+Since each structured dtype is just a sequence of float64 fields, we can instead
+compile the hierarchy once into a set of column offsets and work directly with
+contiguous (N, D) matrices, one row per particle. This mirrors the x_offset and
+i_offset convention used by the Cython components in optofit.cneuron.
+"""
+import numpy as np
+
+from optofit.utils.utils import sz_dtype
+
+class Layout(object):
+    """
+    Layout plan mapping each compartment and channel of a population to fixed
+    column offsets in flat latent (N x D), state (N x S) and input (N x M) buffers.
+    """
+    def __init__(self, population):
+        self.population = population
+
+        self.latent_dtype = np.dtype(population.latent_dtype)
+        self.state_dtype = np.dtype(population.state_dtype)
+        self.input_dtype = np.dtype(population.input_dtype)
+
+        # Number of columns in each of the flat buffers
+        self.D = sz_dtype(self.latent_dtype)
+        self.S = sz_dtype(self.state_dtype)
+        self.M = sz_dtype(self.input_dtype)
+
+        # Set the offsets of each component. The variables of a component are
+        # laid out contiguously, in the order of the component's own dtype,
+        # starting at its offset.
+        for neuron in population.neurons:
+            for compartment in neuron.compartments:
+                self._set_offsets(compartment)
+                for channel in compartment.channels:
+                    self._set_offsets(channel)
+
+    def _set_offsets(self, component):
+        component.x_offset = self.offset(self.latent_dtype, component.path)
+        component.s_offset = self.offset(self.state_dtype, component.path)
+        component.i_offset = self.offset(self.input_dtype, component.path)
+
+    @staticmethod
+    def offset(dtype, path):
+        """
+        Column offset of the item at the given path in a hierarchical dtype,
+        or None if the path is not present in the dtype.
+        """
+        offset = 0
+        for p in path:
+            if dtype.fields is None or p not in dtype.fields:
+                return None
+            dtype, off = dtype.fields[p][:2]
+            offset += off
+        return offset // np.dtype(np.float64).itemsize
+
+    @staticmethod
+    def _flatten(sarray, width):
+        # Single records (e.g. inpt[t]) are promoted to length one arrays.
+        # Contiguous arrays are viewed in place; anything else is copied once.
+        sarray = np.ascontiguousarray(np.atleast_1d(sarray))
+        return sarray.view(np.float64).reshape((-1, width))
+
+    def flatten_latent(self, latent):
+        """
+        View an N array of latent_dtype as an (N, D) float64 matrix
+        """
+        return self._flatten(latent, self.D)
+
+    def flatten_state(self, state):
+        """
+        View an N array of state_dtype as an (N, S) float64 matrix
+        """
+        return self._flatten(state, self.S)
+
+    def flatten_input(self, inpt):
+        """
+        View an N array of input_dtype as an (N, M) float64 matrix
+        """
+        return self._flatten(inpt, self.M)
+
+    def as_latent(self, x):
+        """
+        View an (N, D) matrix as an N array of latent_dtype
+        """
+        return np.ascontiguousarray(x).view(self.latent_dtype).reshape(x.shape[0])
+
+    def as_state(self, s):
+        """
+        View an (N, S) matrix as an N array of state_dtype
+        """
+        return np.ascontiguousarray(s).view(self.state_dtype).reshape(s.shape[0])
+
+    def empty_latent(self, N):
+        return np.zeros((N, self.D))
+
+    def empty_state(self, N):
+        return np.zeros((N, self.S))
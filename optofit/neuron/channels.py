@@ -10,6 +10,8 @@ from optofit.models.component import Component
 from optofit.models.parameters import Parameter
 from optofit.models.hyperparameters import hypers
 from optofit.inference.distributions import GammaDistribution
+from optofit.neuron.rate_table import RateTable
+from optofit.models.layout import Layout
 
 from optofit.utils.utils import get_item_at_path
 #
@@ -84,6 +86,9 @@ class Channel(Component):
 
         self._moves_calcium = False
         self._calcium_dependent = False
+
+        # Optional lookup table of the gating rates. See use_rate_table.
+        self.rate_table = None
         
     @property
     def moves_calcium(self):
@@ -132,6 +137,39 @@ class Channel(Component):
     def latent_ub(self, value):
         self._latent_ub = value
 
+    @property
+    def voltage_gated(self):
+        """
+        True if the channel's gating rates are a function of V alone,
+        in which case they can be tabulated with use_rate_table.
+        """
+        return hasattr(self, 'alpha_beta')
+
+    def use_rate_table(self, V_min=-100.0, V_max=100.0, dV=0.01):
+        """
+        Opt in to interpolating the gating rates from a table precomputed on
+        a voltage grid rather than evaluating the analytic forms at each step.
+        Set rate_table to None to switch back to the analytic forms.
+
+        returns:
+        the RateTable, whose max_abs_error and max_rel_error report the
+        interpolation error of each rate.
+        """
+        if not self.voltage_gated:
+            raise Exception("Channel %s does not have voltage gated rates" % self.name)
+
+        self.rate_table = RateTable(lambda V: self.alpha_beta({'V' : V}),
+                                    V_min=V_min, V_max=V_max, dV=dV)
+        return self.rate_table
+
+    def rates(self, state):
+        """
+        Compute the gating rates, either analytically or from the rate table
+        """
+        if self.rate_table is None:
+            return self.alpha_beta(state)
+        return self.rate_table(state['V'])
+
     def steady_state(self, V):
         # Steady state value of the latent vars as a function of voltage
         return np.array([])
@@ -139,6 +177,23 @@ class Channel(Component):
     def kinetics(self, latent, inpt, state):
         pass
 
+    def evaluate_state_into(self, s, x, inpt):
+        """
+        Evaluate the state of this channel using the flat layout and write it
+        into the preallocated (N, S) state buffer s.
+
+        x:      (N, D) matrix of latent state variables
+        inpt:   (1, M) or (N, M) matrix of inputs
+        """
+        pass
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        """
+        Compute the kinetics of this channel's latent variables using the flat
+        layout and write them into the preallocated (N, D) buffer dxdt.
+        """
+        pass
+
     def IV_plot(self, start=-200, stop=100):
         comp_state_dt = np.dtype(self.compartment._state_vars)
 
@@ -233,6 +288,9 @@ class LeakChannel(Channel):
         state['I'] = x_comp['V'] - self.E.value
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        s[..., self.s_offset] = x[..., self.compartment.x_offset] - self.E.value
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -279,14 +337,21 @@ class NaChannel(Channel):
         else:
             self.E = E_na
 
-    def steady_state(self, state):
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the m and h gates as a function of V
+        """
         V = state['V']
-        # Steady state value of the latent vars
-        # Compute the alpha and beta as a function of V
         am1 = 0.1*(V+35.)/(1-exp(-(V+35.)/10.))
         ah1 = 0.07*exp(-(V+50.)/20.)
+
         bm1 = 4.*exp(-(V+65.)/18.)
-        bh1 = 1./(exp(-(V+35)/10.)+1)
+        bh1 = 1./(exp(-(V+35.)/10.)+1.)
+        return am1, bm1, ah1, bh1
+
+    def steady_state(self, state):
+        # Steady state value of the latent vars
+        am1, bm1, ah1, bh1 = self.alpha_beta(state)
 
         xss = np.zeros(2)
         xss[0] = am1/(am1+bm1)
@@ -303,6 +368,12 @@ class NaChannel(Channel):
         state['I'] = x_ch['m']**3 * x_ch['h'] * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        m = x[..., self.x_offset]
+        h = x[..., self.x_offset+1]
+        s[..., self.s_offset] = m**3 * h * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -325,16 +396,11 @@ class NaChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V']
         m = x_ch['m']
         h = x_ch['h']
 
         # Compute the alpha and beta as a function of V
-        am1 = 0.1*(V+35.)/(1-exp(-(V+35.)/10.))
-        ah1 = 0.07*exp(-(V+50.)/20.)
-
-        bm1 = 4.*exp(-(V+65.)/18.)
-        bh1 = 1./(exp(-(V+35.)/10.)+1.)
+        am1, bm1, ah1, bh1 = self.rates(x_comp)
 
         # Compute the channel state updates
         dxdt['m'] = am1*(1.-m) - bm1*m
@@ -342,6 +408,14 @@ class NaChannel(Channel):
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        m = x[..., self.x_offset]
+        h = x[..., self.x_offset+1]
+        am1, bm1, ah1, bh1 = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = am1*(1.-m) - bm1*m
+        dxdt[..., self.x_offset+1] = ah1*(1.-h) - bh1*h
+
 class Ca3NaChannel(Channel):
     """
     Sodium channel in a hippocampal CA3 neuron.
@@ -385,16 +459,22 @@ class Ca3NaChannel(Channel):
     def latent_ub(self):
         return self._latent_ub
 
-    def steady_state(self, state):
-        V = state['V']
-        # Steady state value of the latent vars
-        # Compute the alpha and beta as a function of V
-        V_ref = V + 60
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the m and h gates as a function of V
+        """
+        # Use resting potential of zero
+        V_ref = state['V'] + 60
         am1 = 0.32*(13.1-V_ref)/(exp((13.1-V_ref)/4)-1)
         ah1 = 0.128*exp((17.0-V_ref)/18.0)
 
         bm1 = 0.28*(V_ref-40.1)/(exp((V_ref-40.1)/5.0)-1.0)
         bh1 = 4.0/(1.0+exp((40.-V_ref)/5.0))
+        return am1, bm1, ah1, bh1
+
+    def steady_state(self, state):
+        # Steady state value of the latent vars
+        am1, bm1, ah1, bh1 = self.alpha_beta(state)
 
         xss = np.zeros(2)
         xss[0] = am1/(am1+bm1)
@@ -411,6 +491,12 @@ class Ca3NaChannel(Channel):
         state['I'] = x_ch['m']**2 * x_ch['h'] * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        m = x[..., self.x_offset]
+        h = x[..., self.x_offset+1]
+        s[..., self.s_offset] = m**2 * h * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -433,19 +519,11 @@ class Ca3NaChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V']
-        # Use resting potential of zero
-        V_ref = V + 60
-
         m = x_ch['m']
         h = x_ch['h']
 
         # Compute the alpha and beta as a function of V
-        am1 = 0.32*(13.1-V_ref)/(exp((13.1-V_ref)/4)-1)
-        ah1 = 0.128*exp((17.0-V_ref)/18.0)
-
-        bm1 = 0.28*(V_ref-40.1)/(exp((V_ref-40.1)/5.0)-1.0)
-        bh1 = 4.0/(1.0+exp((40.-V_ref)/5.0))
+        am1, bm1, ah1, bh1 = self.rates(x_comp)
 
         # Compute the channel state updates
         dxdt['m'] = am1*(1.-m) - bm1*m
@@ -453,6 +531,14 @@ class Ca3NaChannel(Channel):
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        m = x[..., self.x_offset]
+        h = x[..., self.x_offset+1]
+        am1, bm1, ah1, bh1 = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = am1*(1.-m) - bm1*m
+        dxdt[..., self.x_offset+1] = ah1*(1.-h) - bh1*h
+
 
 class KdrChannel(Channel):
     """
@@ -482,11 +568,18 @@ class KdrChannel(Channel):
         else:
             self.E = E_kdr
 
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the n gate as a function of V
+        """
+        V = state['V'] + 60
+        an1 = 0.01*(V+55.) /(1-exp(-(V+55.)/10.))
+        bn1 = 0.125*exp(-(V+65.)/80.)
+        return an1, bn1
+
     def steady_state(self, state):
         # Steady state activation values
-        V  = state['V'] + 60
-        an1 = 0.01*(V+55.)/(1-exp(-(V+55.)/10.))
-        bn1 = 0.125*exp(-(V+65.)/80.)
+        an1, bn1 = self.alpha_beta(state)
 
         xss = np.zeros(1)
         xss[0] = an1/(an1+bn1)
@@ -502,6 +595,11 @@ class KdrChannel(Channel):
         state['I'] = x_ch['n']**4 * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        n = x[..., self.x_offset]
+        s[..., self.s_offset] = n**4 * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -524,18 +622,22 @@ class KdrChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V'] + 60
         n = x_ch['n']
 
         # Compute the alpha and beta as a function of V
-        an1 = 0.01*(V+55.) /(1-exp(-(V+55.)/10.))
-        bn1 = 0.125*exp(-(V+65.)/80.)
+        an1, bn1 = self.rates(x_comp)
 
         # Compute the channel state updates
         dxdt['n'] = an1 * (1.0-n) - bn1*n
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        n = x[..., self.x_offset]
+        an1, bn1 = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = an1 * (1.0-n) - bn1*n
+
 class Ca3KdrChannel(Channel):
     """
     Potassium (delayed rectification) channel from Traub.
@@ -613,10 +715,15 @@ class Ca3KdrChannel(Channel):
         state['I'] = x_ch['n']**2 * (x_comp['V'] - self.E.value)
         """
 
-        # Traub 1991 
+        # Traub 1991
         state['I'] = x_ch['n']**4 * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        n = x[..., self.x_offset]
+        s[..., self.s_offset] = n**4 * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -641,13 +748,19 @@ class Ca3KdrChannel(Channel):
         n = x_ch['n']
 
         # Compute the alpha and beta as a function of V
-        alpha, beta = self.alpha_beta(x_comp)
+        alpha, beta = self.rates(x_comp)
 
         # Compute the channel state updates
         dxdt['n'] = alpha * (1.0-n) - beta*n
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        n = x[..., self.x_offset]
+        alpha, beta = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = alpha * (1.0-n) - beta*n
+
 
 class Ca3KahpChannel(Channel):
     """
@@ -703,19 +816,26 @@ class Ca3KahpChannel(Channel):
     def latent_ub(self):
         return self._latent_ub
 
-    def steady_state(self, state):
+    @property
+    def voltage_gated(self):
+        # The q gate rates depend on [Ca] rather than V
+        return False
+
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the q gate as a function of [Ca]
+        """
         c_Ca = state['[Ca]']
-        #
-        # q = X(1,:);
-        #
-        # % Offset to resting potential of 0
-        
-        #
-        # % Compute the alpha and beta as a function of V
-        aq1 = np.min((0.2e-4)*c_Ca, 0.01)
+        aq1 = np.minimum((0.2e-4)*c_Ca, 0.01)
         bq1 = 0.001
-        
-        return np.array([aq1/(aq1 + bq1)])
+        return aq1, bq1
+
+    def steady_state(self, state):
+        aq1, bq1 = self.alpha_beta(state)
+
+        xss = np.zeros(1)
+        xss[0] = aq1/(aq1 + bq1)
+        return xss
 
     def evaluate_state(self, latent, inpt):
         """
@@ -727,6 +847,11 @@ class Ca3KahpChannel(Channel):
         state['I'] = x_ch['q'] * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        q = x[..., self.x_offset]
+        s[..., self.s_offset] = q * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -749,22 +874,25 @@ class Ca3KahpChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V']
-        c_Ca = x_comp['[Ca]']
         q    = x_ch['q']
 
-        # Offset to resting potential of 0
-        V_ref = 60 + V
+        # % Compute the alpha and beta as a function of [Ca]
+        aq1, bq1 = self.rates(x_comp)
 
-        # % Compute the alpha and beta as a function of V
-        aq1 = np.min((0.2e-4)*c_Ca, 0.01)
-        bq1 = 0.001
-        
         # % Compute the channel state updates
         dxdt['q'] = aq1*(1-q) - bq1*q
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        q = x[..., self.x_offset]
+        # The calcium concentration follows the voltage in a CalciumCompartment
+        ca = self.compartment.x_offset + \
+             Layout.offset(np.dtype(self.compartment.latent_dtype), ['[Ca]'])
+        aq1, bq1 = self.rates({'[Ca]' : x[..., ca]})
+
+        dxdt[..., self.x_offset] = aq1*(1-q) - bq1*q
+
 
 
 class Ca3KaChannel(Channel):
@@ -811,22 +939,27 @@ class Ca3KaChannel(Channel):
     def latent_ub(self):
         return self._latent_ub
 
-    def steady_state(self, state):
-        V = state['V']
-        # Steady state activation values
-        # TODO
-        xss = np.zeros(2)
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the a and b gates as a function of V
+        """
         # Offset to resting potential of 0
-        V_ref = 60 + V
+        V_ref = 60 + state['V']
 
-        # Compute the alpha and beta as a function of V
+        # Activation variable a
         aa1 = 0.02*(13.1-V_ref)/(exp((13.1-V_ref)/10.)-1)
-        ba1 = 0.0175*(V_ref-40.1)/(exp((V_ref-40.1)/10.) - 1)
+        ba1 = 0.0175*(V_ref-40.1)/(exp((V_ref-40.1)/10.)-1)
 
         # Inactivation variable b
-        ab1 = 0.0016*exp((-13-V_ref)/18.0)
+        ab1 = 0.0016*exp((-13.0-V_ref)/18.0)
         bb1 = 0.05/(1+exp((10.1-V_ref)/5.0))
+        return aa1, ba1, ab1, bb1
 
+    def steady_state(self, state):
+        # Steady state activation values
+        aa1, ba1, ab1, bb1 = self.alpha_beta(state)
+
+        xss = np.zeros(2)
         xss[0] = aa1/(aa1+ba1)
         xss[1] = ab1/(ab1+bb1)
         return xss
@@ -841,6 +974,12 @@ class Ca3KaChannel(Channel):
         state['I'] = x_ch['a'] * x_ch['b'] * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        a = x[..., self.x_offset]
+        b = x[..., self.x_offset+1]
+        s[..., self.s_offset] = a * b * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -863,17 +1002,8 @@ class Ca3KaChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V']
-        # Offset to resting potential of 0
-        V_ref = 60 + V
-
         # Compute the alpha and beta as a function of V
-        aa1 = 0.02*(13.1-V_ref)/(exp((13.1-V_ref)/10.)-1)
-        ba1 = 0.0175*(V_ref-40.1)/(exp((V_ref-40.1)/10.)-1)
-
-        # Inactivation variable b
-        ab1 = 0.0016*exp((-13.0-V_ref)/18.0)
-        bb1 = 0.05/(1+exp((10.1-V_ref)/5.0))
+        aa1, ba1, ab1, bb1 = self.rates(x_comp)
 
         # Compute the channel state updates
         dxdt['a'] = aa1*(1-x_ch['a']) - ba1*x_ch['a']
@@ -881,6 +1011,14 @@ class Ca3KaChannel(Channel):
 
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        a = x[..., self.x_offset]
+        b = x[..., self.x_offset+1]
+        aa1, ba1, ab1, bb1 = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = aa1*(1-a) - ba1*a
+        dxdt[..., self.x_offset+1] = ab1*(1-b) - bb1*b
+
 class Ca3CaChannel(Channel):
     """
     High Threshold Calcium channel from Traub 1994
@@ -929,19 +1067,28 @@ class Ca3CaChannel(Channel):
     def latent_ub(self):
         return self._latent_ub
 
-    def steady_state(self, state):
-        V = state['V']
-        # Steady state activation values
-        V_ref = 60 + V
+    def alpha_beta(self, state):
+        """
+        Compute the alpha and beta for the s and r gates as a function of V
+        """
+        # Offset to resting potential of 0
+        V_ref = 60 + state['V']
+
         alpha = 1.6 / (1 + np.exp(-.072 * (V_ref - 65)))
         beta  = .02 * (V_ref - 51.1) / (np.exp((V_ref - 51.1) / 5) - 1)
-        if V_ref <= 0:
-            r_alpha = .005
-            r_beta  = 0
-        else:
-            r_alpha = np.exp(-V_ref / 20) / 200
-            r_beta = 0.005 - r_alpha
-        return np.array([(alpha / (alpha + beta))[0], r_alpha/(r_alpha + r_beta)])
+
+        r_alpha = np.where(V_ref <= 0, .005, np.exp(-V_ref / 20) / 200)
+        r_beta = 0.005 - r_alpha
+        return alpha, beta, r_alpha, r_beta
+
+    def steady_state(self, state):
+        # Steady state activation values
+        alpha, beta, r_alpha, r_beta = self.alpha_beta(state)
+
+        xss = np.zeros(2)
+        xss[0] = alpha / (alpha + beta)
+        xss[1] = r_alpha / (r_alpha + r_beta)
+        return xss
 
     def evaluate_state(self, latent, inpt):
         """
@@ -954,6 +1101,12 @@ class Ca3CaChannel(Channel):
         #print "x_ch: ", x_ch['s']
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        s_gate = x[..., self.x_offset]
+        r_gate = x[..., self.x_offset+1]
+        s[..., self.s_offset] = (s_gate ** 2) * r_gate * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -976,21 +1129,20 @@ class Ca3CaChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        V = x_comp['V']
-        # Offset to resting potential of 0
-        V_ref = 60 + V
-
-        alpha = 1.6 / (1 + np.exp(-.072 * (V_ref - 65)))
-        beta  = .02 * (V_ref - 51.1) / (np.exp((V_ref - 51.1) / 5) - 1)
-
-        r_alpha = np.exp(-V_ref / 20) / 200
-        r_alpha[V_ref <= 0] = .005
-        r_beta = 0.005 - r_alpha
+        alpha, beta, r_alpha, r_beta = self.rates(x_comp)
 
         dxdt['s'] = alpha * (1 - x_ch['s']) - beta * x_ch['s']
         dxdt['r'] = r_alpha * (1 - x_ch['r']) - r_beta * x_ch['r']
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        s_gate = x[..., self.x_offset]
+        r_gate = x[..., self.x_offset+1]
+        alpha, beta, r_alpha, r_beta = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = alpha * (1 - s_gate) - beta * s_gate
+        dxdt[..., self.x_offset+1] = r_alpha * (1 - r_gate) - r_beta * r_gate
+
 class Ca3KcChannel(Channel):
     """
     High Threshold Calcium channel from Traub 1994
@@ -1094,6 +1246,12 @@ class Ca3KcChannel(Channel):
         state['I'] = x_ch['c'] * np.minimum(1, x_comp['[Ca]'] / 250) * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        c_Ca = x[..., self.compartment.x_offset+1]
+        c = x[..., self.x_offset]
+        s[..., self.s_offset] = c * np.minimum(1, c_Ca / 250) * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -1116,10 +1274,16 @@ class Ca3KcChannel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        alpha, beta = self.alpha_beta(x_comp)
+        alpha, beta = self.rates(x_comp)
         dxdt['c'] = alpha * (1 - x_ch['c']) - beta * x_ch['c']
         return dxdt
 
+    def kinetics_into(self, dxdt, x, inpt, s):
+        c = x[..., self.x_offset]
+        alpha, beta = self.rates({'V' : x[..., self.compartment.x_offset]})
+
+        dxdt[..., self.x_offset] = alpha * (1 - c) - beta * c
+
 class ChR2Channel(Channel):
     """
     Voltage and light gated ChR2 from Williams
@@ -1193,6 +1357,16 @@ class ChR2Channel(Channel):
         state['I'] = G * (x_ch['O1'] + gam*x_ch['O2']) * (x_comp['V'] - self.E.value)
         return state
 
+    def evaluate_state_into(self, s, x, inpt):
+        V = x[..., self.compartment.x_offset]
+        O1 = x[..., self.x_offset]
+        O2 = x[..., self.x_offset+1]
+
+        G   = (10.6408 - 14.6408*np.exp(-V/42.7671)) / V
+        gam = 0.1
+
+        s[..., self.s_offset] = G * (O1 + gam*O2) * (V - self.E.value)
+
     def kinetics(self, latent, inpt, state):
         """
         Compute the state kinetics, d{latent}/dt, according to the Hodgkin-Huxley eqns,
@@ -1217,8 +1391,32 @@ class ChR2Channel(Channel):
         x_comp = get_item_at_path(latent, self.compartment.path)
         x_ch = get_item_at_path(latent, self.path)
 
-        I = i_comp['Irr']
-        V = x_comp['V']
+        for name, dx in self._dxdt(x_comp['V'], i_comp['Irr'], x_ch).iteritems():
+            dxdt[name] = dx
+
+        return dxdt
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        # Irradiance is the second input of the compartment
+        I = inpt[..., self.compartment.i_offset+1]
+        V = x[..., self.compartment.x_offset]
+        x_ch = dict((name, x[..., self.x_offset+i])
+                    for i, (name, _) in enumerate(self.latent_dtype))
+
+        dx = self._dxdt(V, I, x_ch)
+        for i, (name, _) in enumerate(self.latent_dtype):
+            dxdt[..., self.x_offset+i] = dx[name]
+
+    def _dxdt(self, V, I, x_ch):
+        """
+        Compute the rate of change of each of the ChR2 states given the
+        voltage V, the irradiance I, and the current states x_ch, which may
+        be any mapping from state name to values.
+
+        returns:
+        dict of the rate of change of each latent state variable.
+        """
+        dxdt = {}
         p = x_ch['p']
 
         # Compute the voltage-sensitive rate constants for state transitions
@@ -1257,7 +1455,7 @@ class ChR2Channel(Channel):
         e21c2 = 0.024
         e21 = e21d + e21c1*np.log(1+I/e21c2)
 
-        dxdt['O1'] = k1 * x_ch['C1'] - (Gd1 + e12) * x_ch['O1'] + e21 * x_ch['O2'] 
+        dxdt['O1'] = k1 * x_ch['C1'] - (Gd1 + e12) * x_ch['O1'] + e21 * x_ch['O2']
         dxdt['O2'] = k2 * x_ch['C2'] - (Gd2 + e21) * x_ch['O2'] + e12 * x_ch['O1']
         dxdt['C1'] = Gr * x_ch['C2'] + Gd1 * x_ch['O1'] - k1 * x_ch['C1']
         dxdt['C2'] = Gd2 * x_ch['O2'] + (k2 + Gr) * x_ch['C2']
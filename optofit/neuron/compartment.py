@@ -6,6 +6,7 @@ import numpy as np
 
 from optofit.models.component import Component
 from optofit.models.hyperparameters import hypers
+from optofit.models.layout import Layout
 
 from optofit.utils.utils import get_item_at_path
 
@@ -153,6 +154,35 @@ class Compartment(Component):
 
         return dxdt
 
+    def evaluate_state_into(self, s, x, inpt):
+        """
+        Evaluate the state of this compartment using the flat layout and write it
+        into the preallocated (N, S) state buffer s.
+
+        x:      (N, D) matrix of latent state variables
+        inpt:   (1, M) or (N, M) matrix of inputs
+        """
+        s[..., self.s_offset] = x[..., self.x_offset]
+        for c in self.channels:
+            c.evaluate_state_into(s, x, inpt)
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        """
+        Compute the state kinetics using the flat layout and write them into
+        the preallocated (N, D) buffer dxdt. The state buffer s must already
+        have been populated by evaluate_state_into.
+        """
+        # To compute dV/dt we need the ionic current in this compartment
+        I_ionic = 0
+        for c in self.channels:
+            I_ionic += c.g.value * s[..., c.s_offset]
+
+        # Add in driving current
+        dxdt[..., self.x_offset] = 1.0/self.C.value * (inpt[..., self.i_offset] - I_ionic)
+
+        for c in self.channels:
+            c.kinetics_into(dxdt, x, inpt, s)
+
 class CalciumCompartment(Compartment):
     def __init__(self, name, neuron, C = None):
         super(CalciumCompartment, self).__init__(name, neuron, C)
@@ -253,3 +283,30 @@ class CalciumCompartment(Compartment):
                 dxdt[c.name] = tmp
 
         return dxdt
+
+    def evaluate_state_into(self, s, x, inpt):
+        # Look up the [Ca] column by name in the compartment's own dtypes
+        s[..., self.s_offset] = x[..., self.x_offset]
+        s[..., self.s_offset + Layout.offset(np.dtype(self.state_dtype), ['[Ca]'])] = \
+            x[..., self.x_offset + Layout.offset(np.dtype(self.latent_dtype), ['[Ca]'])]
+        for c in self.channels:
+            c.evaluate_state_into(s, x, inpt)
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        I_ionic   = 0
+        I_calcium = 0
+        for c in self.channels:
+            I_c = c.g.value * s[..., c.s_offset]
+            I_ionic += I_c
+
+            if c.moves_calcium:
+                I_calcium += I_c
+
+        dxdt[..., self.x_offset] = 1.0/self.C.value * (inpt[..., self.i_offset] - I_ionic)
+
+        # We model [Ca] as per page 83 of Traub 1994
+        ca = self.x_offset + Layout.offset(np.dtype(self.latent_dtype), ['[Ca]'])
+        dxdt[..., ca] = -1 * I_calcium * self.Phi - x[..., ca] * self.Beta
+
+        for c in self.channels:
+            c.kinetics_into(dxdt, x, inpt, s)
@@ -162,3 +162,19 @@ class Neuron(Component):
             dxdt[c.name] = c.kinetics(latent, inpt, state)
 
         return dxdt
+
+    def evaluate_state_into(self, s, x, inpt):
+        """
+        Evaluate the state of the neuron using the flat layout and write it
+        into the preallocated (N, S) state buffer s.
+        """
+        for c in self.compartments:
+            c.evaluate_state_into(s, x, inpt)
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        """
+        Compute the state kinetics using the flat layout and write them into
+        the preallocated (N, D) buffer dxdt.
+        """
+        for c in self.compartments:
+            c.kinetics_into(dxdt, x, inpt, s)
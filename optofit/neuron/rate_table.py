@@ -0,0 +1,97 @@
+"""
+Voltage indexed lookup tables for the alpha and beta rates of gated channels.
+
+The rate functions of Hodgkin-Huxley style channels each take a handful of
+exponentials per particle per time step, which dominates the cost of the
+particle proposals. Since the rates depend only on the membrane voltage, we
+can optionally precompute them on a fine voltage grid and linearly
+interpolate at runtime instead.
+"""
+import numpy as np
+
+class RateTable(object):
+    """
+    Table of a channel's rates on an evenly spaced voltage grid.
+    """
+    def __init__(self, rates, V_min=-100.0, V_max=100.0, dV=0.01):
+        """
+        rates:  function mapping an array of voltages to a tuple of rate arrays,
+                e.g. (am1, bm1, ah1, bh1) for the sodium channel
+        V_min:  lower edge of the voltage grid. Voltages below are clamped.
+        V_max:  upper edge of the voltage grid. Voltages above are clamped.
+        dV:     grid resolution in mV
+        """
+        assert V_max > V_min, "V_max must be greater than V_min"
+        assert dV > 0, "dV must be positive"
+
+        self.G = int(np.round((V_max - V_min) / dV)) + 1
+        self.V_min = float(V_min)
+        self.dV = float(dV)
+        self.V_max = self.V_min + (self.G - 1) * self.dV
+        self.V_grid = self.V_min + self.dV * np.arange(self.G)
+
+        # Tabulate the rates as an R x G matrix
+        self.table = self._evaluate(rates, self.V_grid)
+        self.R = self.table.shape[0]
+
+        # Removable singularities of the analytic forms, like the 0/0 in the
+        # sodium am1 at V=-35, may fall exactly on a grid point. Fill these in
+        # with the average of the rates just either side.
+        bad = ~np.isfinite(self.table)
+        if np.any(bad):
+            eps = 1e-6 * self.dV
+            avg = 0.5 * (self._evaluate(rates, self.V_grid - eps) +
+                         self._evaluate(rates, self.V_grid + eps))
+            self.table[bad] = avg[bad]
+
+        # For each grid interval, store the rates at its left edge followed by
+        # their slopes so that a lookup gathers a single contiguous row.
+        self.coeffs = np.ascontiguousarray(
+            np.hstack((self.table[:, :-1].T, np.diff(self.table, axis=1).T / self.dV)))
+
+        # Report the interpolation error versus the analytic forms.
+        # Linear interpolation error is largest between grid points.
+        V_mid = self.V_grid[:-1] + 0.5 * self.dV
+        exact = self._evaluate(rates, V_mid)
+        err = np.abs(self.lookup(V_mid).T - exact)
+        ok = np.isfinite(err)
+        err[~ok] = 0
+
+        # Maximum absolute and relative error of each rate
+        self.max_abs_error = err.max(axis=1)
+        self.max_rel_error = (err / np.maximum(np.abs(exact), 1e-12)).max(axis=1)
+
+    @staticmethod
+    def _evaluate(rates, V):
+        # Broadcast constant rates (e.g. a fixed beta) up to the grid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.array([np.zeros_like(V) + r for r in rates(V)])
+
+    @property
+    def max_error(self):
+        """
+        Maximum absolute interpolation error over all of the rates
+        """
+        return self.max_abs_error.max()
+
+    def lookup(self, V):
+        """
+        Interpolate the rates at V, which may be an array of any shape.
+
+        returns:
+        V.shape x R array of rates
+        """
+        V = np.clip(V, self.V_min, self.V_max) - self.V_min
+        i = np.minimum((V / self.dV).astype(np.intp), self.G - 2)
+        dV = (V - i * self.dV)[..., None]
+
+        c = self.coeffs.take(i, axis=0)
+        return c[..., :self.R] + dV * c[..., self.R:]
+
+    def __call__(self, V):
+        """
+        Interpolate the rates at V and return them as a tuple, matching the
+        return value of the channel's alpha_beta.
+        """
+        rates = self.lookup(V)
+        return tuple(rates[..., r] for r in range(self.R))
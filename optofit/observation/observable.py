@@ -53,6 +53,21 @@ class Observation(Component):
         """
         raise NotImplementedError()
 
+    def gaussian_terms(self):
+        """
+        Describe the observation as a list of independent Gaussian terms, each
+        observing an affine function of a single latent variable, so that the
+        particle filters can evaluate it directly on flat particle matrices.
+        Each term is a tuple
+
+            (observed path, latent path, scale, intercept, sigma)
+
+        meaning that the observed item at the observed path (relative to this
+        observation) is distributed as N(scale * latent + intercept, sigma^2).
+        Returns None if the observation has no such form.
+        """
+        return None
+
 class IndependentObservations(Observation):
     """
     Class for a product of independent observations
@@ -105,6 +120,20 @@ class IndependentObservations(Observation):
 
         return logp
 
+    def gaussian_terms(self):
+        """
+        Concatenate the Gaussian terms of the observations, or return None if
+        any of them has no such form.
+        """
+        terms = []
+        for observation in self.observations:
+            obs_terms = observation.gaussian_terms()
+            if obs_terms is None:
+                return None
+            terms.extend([([observation.name] + list(obs_path), latent_path, a, b, sigma)
+                          for (obs_path, latent_path, a, b, sigma) in obs_terms])
+        return terms
+
     def sample(self, latent):
         """
         Compute the log probability of these observations
@@ -160,6 +189,9 @@ class NewDirectCompartmentVoltage(Observation):
         logp = -0.5/self.sigma.value**2 * (observed_V-latent_V)**2
         return logp
 
+    def gaussian_terms(self):
+        return [(['V'], self.compartment.path + ['V'], 1.0, 0.0, self.sigma.value)]
+
 class CompartmentObservation(Observation):
     def __init__(self, name, model, compartment):
         super(CompartmentObservation, self).__init__(name, model)
@@ -230,6 +262,9 @@ class LinearFluorescence(CompartmentObservation):
         diffs = observations['Flr'] - self._transform(latent)['Flr']
         return (-0.5/(self.sigma ** 2)) * (diffs ** 2)
 
+    def gaussian_terms(self):
+        return [(['Flr'], self.compartment.path + ['V'], self.scale, self.intercept, self.sigma)]
+
     def _transform(self, latent):
         o = np.zeros(latent['V'].shape, self.observed_dtype)
         o['Flr'] = latent['V'] * self.scale + self.intercept
@@ -346,6 +381,11 @@ class LowPassCompartmentVoltage(Observation):
     def logp(self, latent, observations):
         return self.simple_logp(latent, observations)
 
+    def gaussian_terms(self):
+        # The same approximation as simple_logp
+        sigma_eff = np.sqrt(self.filterbins) * self.sigma.value
+        return [(['V'], self.compartment.path + ['V'], 1.0, 0.0, sigma_eff)]
+
 def update_normal_gamma(normal, invgamma, x, y):
     # Uses Bayesian Linear Regression to update a normal inverse gamma distribution
     l0 = np.matrix(normal.cov)
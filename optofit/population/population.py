@@ -4,6 +4,7 @@ of neurons.
 """
 import numpy as np
 from optofit.models.component import Component
+from optofit.models.layout import Layout
 
 class Population(Component):
     """
@@ -32,6 +33,9 @@ class Population(Component):
         self._latent_lb = []
         self._latent_ub = []
 
+        # The flat layout is compiled lazily, once all neurons have been added
+        self._layout = None
+
     def add_neuron(self, neuron):
         """
         Add a compartment to the neuron with the specified electical
@@ -42,6 +46,9 @@ class Population(Component):
         """
         self.neurons.append(neuron)
 
+        # Invalidate the flat layout
+        self._layout = None
+
         # Make a description of the latent state variables
         # Each set of latent variables is accessed by the neuron name
         if neuron.latent_dtype is not None:
@@ -90,6 +97,33 @@ class Population(Component):
     def latent_ub(self):
         return self._latent_ub
 
+    @property
+    def layout(self):
+        """
+        Flat layout plan of the latent, state and input variables
+        """
+        if self._layout is None:
+            self._layout = Layout(self)
+        return self._layout
+
+    def use_rate_tables(self, V_min=-100.0, V_max=100.0, dV=0.01):
+        """
+        Opt in to precomputed rate tables for every voltage gated channel in
+        the population. See Channel.use_rate_table.
+
+        returns:
+        dict mapping each tabulated channel's path to its maximum absolute
+        interpolation error versus the analytic rates.
+        """
+        errors = {}
+        for neuron in self.neurons:
+            for compartment in neuron.compartments:
+                for channel in compartment.channels:
+                    if channel.voltage_gated:
+                        table = channel.use_rate_table(V_min=V_min, V_max=V_max, dV=dV)
+                        errors['/'.join(channel.path)] = table.max_error
+        return errors
+
     def steady_state(self):
         """
         Compute steady state of latent variables. This is used
@@ -112,15 +146,16 @@ class Population(Component):
                 if 1, use the same input for each latent state,
                 if N, match each input with each latent state
         """
-        N = len(latent)
-        N_in = len(inpt)
+        layout = self.layout
+        x = layout.flatten_latent(latent)
+        i = layout.flatten_input(inpt)
+        N = x.shape[0]
+        N_in = i.shape[0]
         assert N_in == 1 or N_in == N
 
-        state = np.zeros(latent.shape, dtype=self.state_dtype)
-        for neuron in self.neurons:
-            state[neuron.name] = neuron.evaluate_state(latent, inpt)
-
-        return state
+        s = layout.empty_state(N)
+        self.evaluate_state_into(s, x, i)
+        return layout.as_state(s)
 
     def kinetics(self, latent, inpt):
         """
@@ -136,16 +171,78 @@ class Population(Component):
         returns:
         dxdt:   Rate of change of the latent state variables.
         """
-        N = len(latent)
-        N_in = len(inpt)
+        layout = self.layout
+        x = layout.flatten_latent(latent)
+        i = layout.flatten_input(inpt)
+        N = x.shape[0]
+        N_in = i.shape[0]
         assert N_in == 1 or N_in == N
 
         # First compute auxiliary state variables like currents under x and y
-        state = self.evaluate_state(latent, inpt)
+        s = layout.empty_state(N)
+        self.evaluate_state_into(s, x, i)
 
-        dxdt = np.zeros(latent.shape, dtype=self.latent_dtype)
-        for neuron in self.neurons:
-            dxdt[neuron.name] = neuron.kinetics(latent, inpt, state)
+        dxdt = layout.empty_latent(N)
+        self.kinetics_into(dxdt, x, i, s)
+        return layout.as_latent(dxdt)
+
+    def trajectory_kinetics(self, latent, inpt):
+        """
+        Evaluate the states and kinetics along entire trajectories in a single
+        vectorized pass, rather than looping over time steps in Python.
 
-        return dxdt
+        latent:  T x N array (or T array) of latent state variables
+        inpt:    T array of inputs, shared by each of the N trajectories
 
+        returns:
+        dxdt:    Rate of change of the latent variables, shaped like latent
+        state:   Evaluated states, shaped like latent
+        """
+        layout = self.layout
+        shape = np.shape(latent)
+        T = shape[0]
+
+        # Put time on the first axis and particles on the second so that
+        # the inputs broadcast over particles
+        x = layout.flatten_latent(latent).reshape((T, -1, layout.D))
+        i = layout.flatten_input(inpt)
+        assert i.shape[0] == T, "Expected one input per time step"
+        i = i.reshape((T, 1, layout.M))
+
+        s = np.zeros(x.shape[:2] + (layout.S,))
+        self.evaluate_state_into(s, x, i)
+
+        dxdt = np.zeros_like(x)
+        self.kinetics_into(dxdt, x, i, s)
+
+        return dxdt.view(layout.latent_dtype).reshape(shape), \
+               s.view(layout.state_dtype).reshape(shape)
+
+    def evaluate_state_into(self, s, x, inpt):
+        """
+        Evaluate the state of the population using the flat layout.
+
+        s:      preallocated (N, S) buffer for the state variables
+        x:      (N, D) matrix of latent state variables
+        inpt:   (1, M) or (N, M) matrix of inputs
+
+        Any number of leading axes are supported so long as the inputs
+        broadcast against the latent states, e.g. (T, N, D) latent states
+        with (T, 1, M) inputs.
+        """
+        for neuron in self.neurons:
+            neuron.evaluate_state_into(s, x, inpt)
+
+    def kinetics_into(self, dxdt, x, inpt, s):
+        """
+        Compute the state kinetics using the flat layout. This avoids any
+        allocation, so it should be used in inner loops with buffers that
+        are allocated once.
+
+        dxdt:   preallocated (N, D) buffer for the rate of change of x
+        x:      (N, D) matrix of latent state variables
+        inpt:   (1, M) or (N, M) matrix of inputs
+        s:      (N, S) buffer of states populated by evaluate_state_into
+        """
+        for neuron in self.neurons:
+            neuron.kinetics_into(dxdt, x, inpt, s)
@@ -37,15 +37,19 @@ def simulate(model, t, stimuli, name=None, have_noise=True, I=None):
 
     # Set up the initial conditions with steady state values
     z0 = population.steady_state()
-    # Create a function to implement hodgkin huxley dynamics
+    # Create a function to implement hodgkin huxley dynamics using
+    # the population's flat layout and preallocated buffers
+    layout = population.layout
+    I_flat = layout.flatten_input(I)
+    dzdt = layout.empty_latent(1)
+    s = layout.empty_state(1)
     def _hh_dynamics(z_vec, ti):
         # Set the inputs
-        inpt = I[ti]
-        #import pdb; pdb.set_trace()
-        latent = as_sarray(z_vec, population.latent_dtype)
-        # state = as_sarray(population.evaluate_state(latent, inpt), population.state_dtype)
-        dzdt = population.kinetics(latent, inpt)
-        return dzdt.view(np.float)
+        inpt = I_flat[ti:ti+1]
+        x = z_vec.reshape((1,-1))
+        population.evaluate_state_into(s, x, inpt)
+        population.kinetics_into(dzdt, x, inpt, s)
+        return dzdt[0]
 
     # Do forward euler by hand.
     z0 = z0.view(np.float)
@@ -107,14 +111,19 @@ def recreate(model, t, I):
 
     # Set up the initial conditions with steady state values
     z0 = population.steady_state()
-    # Create a function to implement hodgkin huxley dynamics
+    # Create a function to implement hodgkin huxley dynamics using
+    # the population's flat layout and preallocated buffers
+    layout = population.layout
+    I_flat = layout.flatten_input(I)
+    dzdt = layout.empty_latent(1)
+    s = layout.empty_state(1)
     def _hh_dynamics(z_vec, ti):
         # Set the inputs
-        inpt = I[ti]
-        latent = as_sarray(z_vec, population.latent_dtype)
-        # state = as_sarray(population.evaluate_state(latent, inpt), population.state_dtype)
-        dzdt = population.kinetics(latent, inpt)
-        return dzdt.view(np.float)
+        inpt = I_flat[ti:ti+1]
+        x = z_vec.reshape((1,-1))
+        population.evaluate_state_into(s, x, inpt)
+        population.kinetics_into(dzdt, x, inpt, s)
+        return dzdt[0]
 
     # Do forward euler by hand.
     z0 = z0.view(np.float)
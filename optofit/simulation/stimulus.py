@@ -16,6 +16,39 @@ class StimulusPattern(object):
         """
         return 0
 
+    def change_times(self, t_start, t_stop):
+        """
+        Times in [t_start, t_stop] near which the intensity may change, for
+        piecewise constant patterns, or None if the pattern is not piecewise
+        constant.
+        """
+        return None
+
+    def change_points(self, t):
+        """
+        Compress the intensity on the time grid t to its change points.
+
+        returns:
+        inds:   indices into t at which the intensity changes, starting at 0
+        values: intensity from each of those indices up to the next one
+        """
+        t = np.asarray(t, dtype=np.float64)
+        T = len(t)
+        times = self.change_times(t[0], t[-1])
+        if times is None:
+            # Evaluate the pattern on the whole grid and compress it
+            cand = np.arange(T)
+        else:
+            # Evaluate the pattern only on the grid points around each change,
+            # so that the change points agree exactly with intensity
+            approx = np.searchsorted(t, times)
+            cand = np.unique(np.clip(np.concatenate(
+                [[0]] + [approx + k for k in range(-2, 3)]), 0, T-1))
+
+        v = np.atleast_1d(self.intensity(t[cand])).astype(np.float64)
+        changed = np.concatenate(([True], v[1:] != v[:-1]))
+        return cand[changed], v[changed]
+
 
 class NoStimulusPattern(StimulusPattern):
     """
@@ -24,6 +57,9 @@ class NoStimulusPattern(StimulusPattern):
     def intensity(self, t):
         return np.zeros_like(t)
 
+    def change_times(self, t_start, t_stop):
+        return np.zeros(0)
+
 class GivenStimulusPattern(StimulusPattern):
     """
     No stimulus (Just extend stimulus)
@@ -33,6 +69,10 @@ class GivenStimulusPattern(StimulusPattern):
         self.stim = stim
         self.sample_rate = sample_rate
 
+        # Indices of the samples at which the recording changes, computed
+        # lazily by change_times
+        self._stim_changes = None
+
     def intensity(self, t):
         if self.sample_rate is not None:
             ind = np.round((t-self.t_stim[0]) * float(self.sample_rate)).astype(np.int)
@@ -42,6 +82,19 @@ class GivenStimulusPattern(StimulusPattern):
             # then we need to interpolate
             return np.interp(t, self.t_stim, self.stim)
 
+    def change_times(self, t_start, t_stop):
+        # Only a recording at a fixed frequency is piecewise constant
+        if self.sample_rate is None:
+            return None
+
+        if self._stim_changes is None:
+            stim = np.asarray(self.stim)
+            self._stim_changes = np.flatnonzero(stim[1:] != stim[:-1]) + 1
+
+        # Sample c is used from halfway between samples c-1 and c
+        times = self.t_stim[0] + (self._stim_changes - 0.5) / float(self.sample_rate)
+        return times[(times >= t_start) & (times <= t_stop)]
+
 class StepStimulusPattern(StimulusPattern):
     """
     Simple step function stimulus
@@ -54,6 +107,9 @@ class StepStimulusPattern(StimulusPattern):
     def intensity(self, t):
         return (t > self.t_on) * (t < self.t_off) * self.v_on
 
+    def change_times(self, t_start, t_stop):
+        return np.array([self.t_on, self.t_off])
+
 class PeriodicStepStimulusPattern(StimulusPattern):
     """
     Simple step function stimulus
@@ -71,6 +127,14 @@ class PeriodicStepStimulusPattern(StimulusPattern):
                (np.remainder((t-self.t_on), self.on_dur + self.off_dur) < self.on_dur) * \
                self.v_on
 
+    def change_times(self, t_start, t_stop):
+        # Onsets and offsets of the pulses between t_start and t_stop
+        period = self.on_dur + self.off_dur
+        k_start = max(0, int(np.floor((t_start - self.t_on) / period)))
+        k_stop = max(0, int(np.ceil((min(t_stop, self.t_off) - self.t_on) / period)) + 1)
+        onsets = self.t_on + np.arange(k_start, k_stop) * period
+        return np.concatenate(([self.t_on, self.t_off], onsets, onsets + self.on_dur))
+
 
 class Stimulus(object):
     """
@@ -87,10 +151,23 @@ class Stimulus(object):
         # TODO: Not sure this is the best place/way to do this
         pass
 
+    def input_columns(self, layout):
+        """
+        Columns of the flat input buffer that this stimulus sets, paired with
+        the stimulus pattern that sets them
+        """
+        from optofit.models.layout import Layout
+        return [(Layout.offset(layout.input_dtype, c.path + [self.input_field]),
+                 self.stimuluspattern)
+                for c in self.compartments]
+
 class DirectCompartmentCurrentInjection(Stimulus):
     """
     Direct current injection into a single compartment
     """
+    # Input variable of the compartments that the stimulus sets
+    input_field = 'I'
+
     def __init__(self, compartments, stimuluspattern):
         """
 
@@ -116,12 +193,15 @@ class DirectCompartmentCurrentInjection(Stimulus):
         """
         for c in self.compartments:
             c_inpt = get_item_at_path(inpt, c.path)
-            c_inpt['I'] = self.stimuluspattern.intensity(t)
+            c_inpt[self.input_field] = self.stimuluspattern.intensity(t)
 
 class DirectCompartmentIrradiance(Stimulus):
     """
     Shine laser directly onto the compartment
     """
+    # Input variable of the compartments that the stimulus sets
+    input_field = 'Irr'
+
     def __init__(self, compartments, stimuluspattern):
         """
 
@@ -147,4 +227,109 @@ class DirectCompartmentIrradiance(Stimulus):
         """
         for c in self.compartments:
             c_inpt = get_item_at_path(inpt, c.path)
-            c_inpt['Irr'] = self.stimuluspattern.intensity(t)
+            c_inpt[self.input_field] = self.stimuluspattern.intensity(t)
+
+
+class SparseInput(object):
+    """
+    T x M input matrix on a time grid, stored as the change points of each
+    column rather than as a dense array. Hour long stimulation protocols are
+    mostly constant, so this takes memory proportional to the number of
+    changes. Indexing with a time index or a slice of time indices returns
+    the corresponding dense rows, so a SparseInput can stand in for the flat
+    input matrix of a population. Sequential row lookups take O(1) time.
+    """
+    def __init__(self, t, M, columns):
+        """
+        t:          T array of times
+        M:          number of input columns
+        columns:    list of (column, stimulus pattern) pairs. Later patterns
+                    override earlier ones for the same column, as with
+                    Stimulus.set_input.
+        """
+        self.t = t
+        self.T = len(t)
+        self.M = M
+
+        self.changes = {}
+        for col, pattern in columns:
+            self.changes[col] = pattern.change_points(t)
+
+        # Index of the current change point of each column
+        self._cursor = dict((col, 0) for col in self.changes)
+
+    @property
+    def shape(self):
+        return (self.T, self.M)
+
+    def __len__(self):
+        return self.T
+
+    def _segment(self, col, i):
+        # Index of the change point in effect at time index i. Checking the
+        # current and next change points first makes sequential access O(1).
+        inds = self.changes[col][0]
+        k = self._cursor[col]
+        if inds[k] <= i:
+            if k+1 == len(inds) or i < inds[k+1]:
+                return k
+            if k+2 == len(inds) or i < inds[k+2]:
+                self._cursor[col] = k+1
+                return k+1
+        k = np.searchsorted(inds, i, side='right') - 1
+        self._cursor[col] = k
+        return k
+
+    def row(self, i):
+        """
+        M array of the inputs at time index i
+        """
+        if i < 0:
+            i += self.T
+        out = np.zeros(self.M)
+        for col, (inds, values) in self.changes.items():
+            out[col] = values[self._segment(col, i)]
+        return out
+
+    def rows(self, start, stop):
+        """
+        Dense (stop-start) x M matrix of the inputs at time indices start to stop
+        """
+        out = np.zeros((max(stop-start, 0), self.M))
+        for col, (inds, values) in self.changes.items():
+            k0 = max(np.searchsorted(inds, start, side='right') - 1, 0)
+            k1 = np.searchsorted(inds, stop, side='left')
+            for k in range(k0, k1):
+                lo = max(inds[k], start)
+                hi = min(inds[k+1], stop) if k+1 < len(inds) else stop
+                out[lo-start:hi-start, col] = values[k]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.T)
+            if step != 1:
+                return self.rows(0, self.T)[key]
+            if stop == start + 1:
+                return self.row(start)[None,:]
+            return self.rows(start, stop)
+        return self.row(int(key))
+
+    def dense(self):
+        """
+        Materialize the full T x M input matrix
+        """
+        return self.rows(0, self.T)
+
+
+def sparse_input(t, stimuli, layout):
+    """
+    SparseInput of a population, given by its Layout, under a list of stimuli
+    """
+    if isinstance(stimuli, Stimulus):
+        stimuli = [stimuli]
+
+    columns = []
+    for stim in stimuli:
+        columns.extend(stim.input_columns(layout))
+    return SparseInput(t, layout.M, columns)
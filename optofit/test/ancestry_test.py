@@ -0,0 +1,74 @@
+"""
+Check that the pruned particle ancestry gives the same trajectories as the
+full particle history.
+
+Run with:  python ancestry_test.py
+"""
+import numpy as np
+
+from optofit.inference.ancestry import AncestryTree
+from optofit.inference.particle_mcmc import ParticleGibbsAncestorSampling
+from optofit.test.filter_utilities import RandomWalkProposal, GaussianLikelihood, GaussianInitial
+
+def dense_trajectory(particles, ancestors, i):
+    # Trace back the lineage of particle i in the full T x Np x D history
+    T = particles.shape[0]
+    x = np.zeros((T, particles.shape[2]))
+    for t in np.arange(T)[::-1]:
+        x[t] = particles[t,i]
+        i = ancestors[t,i]
+    return x
+
+def test_tree():
+    np.random.seed(0)
+    T, Np, D = 200, 50, 3
+    particles = np.random.randn(T, Np, D)
+    ancestors = np.zeros((T, Np), dtype=np.intp)
+
+    # Start with a small capacity to exercise the growth of the tree
+    tree = AncestryTree(Np, D, capacity=Np)
+    tree.extend(particles[0])
+    for t in range(1, T):
+        # Concentrated ancestors, as after resampling degenerate weights
+        w = np.exp(2 * np.random.randn(Np))
+        ancestors[t] = np.sort(np.random.choice(Np, Np, p=w / w.sum()))
+        tree.extend(particles[t], ancestors[t])
+
+        # Every live node has a descendant among the current particles
+        live = set()
+        for node in tree.leaves:
+            while node >= 0 and node not in live:
+                live.add(node)
+                node = tree.parent[node]
+        assert tree.size == len(live), \
+            "Tree holds %d nodes but only %d are live at t=%d" % (tree.size, len(live), t)
+
+    for i in range(Np):
+        assert np.array_equal(tree.trajectory(i), dense_trajectory(particles, ancestors, i)), \
+            "Lineage of particle %d differs from the full history" % i
+
+def test_pruned_filter():
+    # The same filter run with and without pruning gives the same trajectories
+    T, Np, D = 100, 30, 2
+    np.random.seed(1)
+    z = np.cumsum(np.random.randn(D, T), axis=1)
+    x = z + np.random.randn(D, T)
+
+    trajectories = []
+    for prune in [False, True]:
+        np.random.seed(2)
+        pf = ParticleGibbsAncestorSampling(D, T, 0, x[:,0], RandomWalkProposal(),
+                                           GaussianLikelihood(), GaussianInitial(D), z,
+                                           Np=Np, ess_threshold=0.5, prune_ancestry=prune)
+        for t in range(1, T):
+            pf.filter(t, x[:,t])
+        trajectories.append([pf.get_trajectory(i) for i in range(Np)])
+
+    for i in range(Np):
+        assert np.array_equal(trajectories[0][i], trajectories[1][i]), \
+            "Pruned trajectory of particle %d differs from the full history" % i
+
+if __name__ == "__main__":
+    test_tree()
+    test_pruned_filter()
+    print("Ancestry tests passed")
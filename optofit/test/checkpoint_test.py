@@ -0,0 +1,86 @@
+"""
+Check that a chain resumed from a checkpoint is identical to one that was
+never interrupted.
+
+Run with:  python checkpoint_test.py
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from optofit.models.model import Model
+from optofit.models.hyperparameters import hypers
+from optofit.population.population import Population
+from optofit.neuron.neuron import Neuron
+from optofit.neuron.compartment import Compartment
+from optofit.neuron.channels import LeakChannel, NaChannel, KdrChannel
+from optofit.observation.observable import NewDirectCompartmentVoltage, IndependentObservations
+from optofit.simulation.stimulus import PeriodicStepStimulusPattern, DirectCompartmentCurrentInjection
+from optofit.simulation.simulate import simulate
+from optofit.inference.fitting import fit_mcmc, resume_mcmc
+
+def make_model(seed):
+    """
+    Make a squid axon model with a short simulated data sequence
+    """
+    np.random.seed(seed)
+    model = Model()
+    population = Population('population', model)
+    neuron = Neuron('neuron', population)
+    body = Compartment('body', neuron)
+    body.add_channel(LeakChannel('leak', body))
+    body.add_channel(NaChannel('na', body))
+    body.add_channel(KdrChannel('kdr', body))
+    neuron.add_compartment(body, None)
+    population.add_neuron(neuron)
+    model.add_population(population)
+
+    observation = IndependentObservations('observations', model)
+    observation.add_observation(NewDirectCompartmentVoltage('body voltage', model, body))
+    model.add_observation(observation)
+
+    t = np.arange(0, 5, 0.05)
+    stim = DirectCompartmentCurrentInjection(body, PeriodicStepStimulusPattern(0.5, np.inf, .5, .5, 5.))
+    model.add_data_sequence(simulate(model, t, stim))
+    return model
+
+def test_resume():
+    hypers['N_particles'].value = 20
+    N_samples, N_interrupt, interval = 10, 6, 2
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # An uninterrupted chain
+        model = make_model(0)
+        full = fit_mcmc(model, N_samples, print_interval=N_samples, latent_thin=1,
+                        checkpoint=os.path.join(tmpdir, 'full.npz'),
+                        checkpoint_interval=interval)
+
+        # A chain interrupted after N_interrupt iterations, whose last
+        # checkpoint is at iteration 4, resumed in a freshly built model
+        checkpoint = os.path.join(tmpdir, 'interrupted.npz')
+        model = make_model(0)
+        fit_mcmc(model, N_interrupt, print_interval=N_samples, checkpoint=checkpoint,
+                 checkpoint_interval=interval)
+
+        model = make_model(0)
+        np.random.seed(1)
+        resumed = resume_mcmc(model, checkpoint, N_samples=N_samples,
+                              print_interval=N_samples, latent_thin=1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # The resumed chain records the samples after the checkpoint
+    start = N_samples - len(resumed)
+    assert start == 5, "Resumed from iteration %d, expected 5" % start
+    for name in full.names:
+        assert np.array_equal(full.trace(name)[start:], resumed.trace(name)), \
+            "Trace of %s differs after resuming" % name
+    for i in range(len(resumed)):
+        for z_full, z_resumed in zip(full.latent(start + i), resumed.latent(i)):
+            assert np.array_equal(z_full.view(np.float64), z_resumed.view(np.float64)), \
+                "Latent states differ at iteration %d after resuming" % (start + i)
+
+if __name__ == "__main__":
+    test_resume()
+    print("Checkpoint tests passed")
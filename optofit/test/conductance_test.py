@@ -185,7 +185,8 @@ num_files = runs / every_x + 1
 while runs > 0:
     num_runs = min(runs, every_x)
     
-    samples = fit_mcmc(inferred_model, num_runs + 1)
+    # Keep the latent states of every sample, since they are pickled below
+    samples = fit_mcmc(inferred_model, num_runs + 1, latent_thin=1)
     inferred_model = samples[-1]
     print "Writing Data"
     pickle.dump((seed, model_to_dict(true_model), [model_to_dict(s) for s in samples]), open(filename + "_" + str(num_files - (runs / every_x)) + ".pk", 'w'))
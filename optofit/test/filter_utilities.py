@@ -0,0 +1,24 @@
+"""
+A linear Gaussian random walk to run the particle filters on in the tests.
+"""
+import numpy as np
+
+from optofit.inference.particle_mcmc import Proposal
+
+class RandomWalkProposal(Proposal):
+    def sample_next(self, t_prev, Z_prev, t_next):
+        return Z_prev + np.random.randn(*Z_prev.shape), None, None
+
+    def logp(self, t_prev, Z_prev, t_next, Z_next, state=None):
+        return -0.5 * ((Z_next - Z_prev)**2).sum(axis=0)
+
+class GaussianLikelihood(object):
+    def logp(self, X, Z):
+        return -0.5 * ((Z - X[:,None])**2).sum(axis=0)
+
+class GaussianInitial(object):
+    def __init__(self, D=1):
+        self.D = D
+
+    def sample(self, Np=1):
+        return np.random.randn(self.D, Np)
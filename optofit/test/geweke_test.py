@@ -141,7 +141,8 @@ samples = fit_mcmc(true_model, N_samples=10000, callback=print_g_leak, print_int
 # Plot the results
 import scipy.stats
 def plot_channel(samples, index, name, a, b, xlim=None):
-    gs = np.array([m.population.neurons[0].compartments[0].channels[index].g.value for m in samples])
+    channel = true_model.population.neurons[0].compartments[0].channels[index]
+    gs = samples.trace('/'.join(channel.path) + '/g').ravel()
     plt.figure()
     _,bins,_ = plt.hist(gs, 50, normed=True, alpha=0.5)
 
@@ -0,0 +1,53 @@
+"""
+Check the counter-based Philox4x32-10 generator of the Cython particle
+kernels against the known answer tests of Random123 (Salmon et al., 2011),
+and check that the normals it produces are standard normal.
+
+Run with:  python philox_test.py
+"""
+import numpy as np
+from scipy.stats import kstest
+
+from optofit.cinference.pmcmc import philox_block, philox_normal_samples
+
+# (counter, key, output) from kat_vectors in Random123
+philox4x32_10_kats = [
+    ([0x00000000, 0x00000000, 0x00000000, 0x00000000],
+     [0x00000000, 0x00000000],
+     [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]),
+    ([0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff],
+     [0xffffffff, 0xffffffff],
+     [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd]),
+    ([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344],
+     [0xa4093822, 0x299f31d0],
+     [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]),
+]
+
+def test_known_answers():
+    for counter, key, expected in philox4x32_10_kats:
+        seed = key[0] | (key[1] << 32)
+        out = philox_block(counter, seed)
+        assert list(out) == expected, \
+            "Philox4x32-10(%s, %s) gave %s, expected %s" % \
+            ([hex(c) for c in counter], [hex(k) for k in key],
+             [hex(o) for o in out], [hex(e) for e in expected])
+
+def test_normals():
+    # The normals of different particles and dimensions should be
+    # independent standard normals
+    z = philox_normal_samples(1234, 1, 7, 5000, 4)
+    for d in range(z.shape[1]):
+        _, p = kstest(z[:,d], 'norm')
+        assert p > 1e-4, "Normals of dimension %d fail the KS test, p=%g" % (d, p)
+    C = np.corrcoef(z.T)
+    assert np.allclose(C, np.eye(4), atol=0.05), "Normals are correlated:\n%s" % C
+
+    # The draws are a pure function of the seed and counter
+    assert np.array_equal(z, philox_normal_samples(1234, 1, 7, 5000, 4))
+    assert not np.allclose(z, philox_normal_samples(1234, 2, 7, 5000, 4))
+    assert not np.allclose(z, philox_normal_samples(1235, 1, 7, 5000, 4))
+
+if __name__ == "__main__":
+    test_known_answers()
+    test_normals()
+    print("Philox tests passed")
@@ -0,0 +1,95 @@
+"""
+Check the invariants of the resampling schemes used by the particle filters.
+
+Run with:  python resampling_test.py
+"""
+import numpy as np
+
+from optofit.inference.resampling import resample, resampling_methods, \
+    effective_sample_size, sample_index
+from optofit.inference.particle_mcmc import ParticleGibbsAncestorSampling
+from optofit.test.filter_utilities import RandomWalkProposal, GaussianLikelihood, GaussianInitial
+
+def random_weights(N):
+    # Weights spanning several orders of magnitude, with some zeros
+    w = np.exp(3 * np.random.randn(N))
+    w[np.random.rand(N) < 0.2] = 0
+    return w / w.sum()
+
+def test_counts():
+    np.random.seed(0)
+    for method in resampling_methods:
+        for N, num in [(1, 1), (10, 10), (100, 100), (100, 37), (50, 500)]:
+            for trial in range(20):
+                w = random_weights(N) if N > 1 else np.ones(1)
+                sources = resample(w, num, method)
+
+                assert sources.shape == (num,), \
+                    "%s: returned %s sources, expected %d" % (method, sources.shape, num)
+                assert np.all(sources[1:] >= sources[:-1]), "%s: sources are not sorted" % method
+                assert sources.min() >= 0 and sources.max() < N, "%s: source out of range" % method
+                assert np.all(w[sources] > 0), "%s: resampled a particle of weight zero" % method
+
+                counts = np.bincount(sources, minlength=N)
+                if method in ('systematic', 'lowvariance'):
+                    assert np.all(np.abs(counts - num * w) < 1), \
+                        "%s: counts differ from num*w by 1 or more" % method
+                elif method == 'stratified':
+                    assert np.all(np.abs(counts - num * w) < 2), \
+                        "%s: counts differ from num*w by 2 or more" % method
+                elif method == 'residual':
+                    assert np.all(counts >= np.floor(num * w)), \
+                        "%s: counts are below floor(num*w)" % method
+
+def test_unbiased():
+    # The expected number of copies of each particle is num*w
+    np.random.seed(1)
+    N, num, trials = 20, 20, 4000
+    w = random_weights(N)
+    for method in resampling_methods:
+        mean = np.zeros(N)
+        for trial in range(trials):
+            mean += np.bincount(resample(w, num, method), minlength=N)
+        mean /= trials
+        # The counts have variance at most num*w*(1-w) under multinomial
+        # resampling, and less under the other schemes
+        se = np.sqrt(num * w * (1 - w) / trials)
+        assert np.all(np.abs(mean - num * w) <= 5 * se + 1e-12), \
+            "%s: mean counts %s differ from num*w %s" % (method, mean, num * w)
+
+def test_effective_sample_size():
+    assert np.isclose(effective_sample_size(np.ones(10)), 10)
+    assert np.isclose(effective_sample_size(np.array([0, 0, 3.0, 0])), 1)
+
+def test_sample_index():
+    np.random.seed(2)
+    w = np.array([0, 1.0, 0, 3.0, 0])
+    counts = np.bincount([sample_index(w) for _ in range(20000)], minlength=w.size)
+    assert counts[0] == counts[2] == counts[4] == 0, "Sampled an index of weight zero"
+    assert abs(counts[3] / 20000.0 - 0.75) < 0.02, "Index frequencies do not match the weights"
+
+def test_fixed_particle_ancestors():
+    # On steps that do not resample, the fixed particle must stay attached to
+    # the previous fixed particle. With a threshold of zero, no step resamples.
+    np.random.seed(3)
+    T, Np = 50, 20
+    z = np.cumsum(np.random.randn(1, T), axis=1)
+    x = z + np.random.randn(1, T)
+    for ess_threshold, resamples in [(0.0, False), (None, True)]:
+        pf = ParticleGibbsAncestorSampling(1, T, 0, x[:,0], RandomWalkProposal(),
+                                           GaussianLikelihood(), GaussianInitial(), z,
+                                           Np=Np, ess_threshold=ess_threshold)
+        for t in range(1, T):
+            pf.filter(t, x[:,t])
+        if not resamples:
+            assert np.all(pf.ancestors[1:] == np.arange(Np)), \
+                "Ancestors changed on steps without resampling"
+        assert np.allclose(pf.particles[:,0,0], z[0]), "The fixed particle was overwritten"
+
+if __name__ == "__main__":
+    test_counts()
+    test_unbiased()
+    test_effective_sample_size()
+    test_sample_index()
+    test_fixed_particle_ancestors()
+    print("Resampling tests passed")
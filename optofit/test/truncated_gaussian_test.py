@@ -0,0 +1,83 @@
+"""
+Check the truncated Gaussian sampler and log density, from intervals around
+the mean out to 40 standard deviations into the tails.
+
+Run with:  python truncated_gaussian_test.py
+"""
+import numpy as np
+import scipy.special
+import scipy.stats
+from scipy.integrate import quad
+
+from optofit.inference.distributions import TruncatedGaussianDistribution
+
+# (mu, sigma, lb, ub) around the mean, in the near tail, and in the far
+# tails on both sides, with one sided intervals
+intervals = [(0.0, 1.0, -1.0, 1.0),
+             (1.0, 2.0, -np.inf, 0.0),
+             (0.0, 1.0, 2.0, 3.0),
+             (0.0, 1.0, 5.0, 6.0),
+             (0.0, 1.0, 8.0, np.inf),
+             (0.0, 1.0, -41.0, -40.0),
+             (0.0, 1.0, 40.0, 40.01),
+             (0.5, 0.01, 0.0, 0.1)]
+
+def standard_cdf(z, a, b):
+    """
+    CDF of a standard normal truncated to [a,b], computed from the log upper
+    tail probabilities so that it is accurate far in the tails
+    """
+    if b <= 0:
+        # Reflect the lower tail to the upper tail
+        return 1.0 - standard_cdf(-z, -b, -a)
+    if a < 0:
+        return scipy.stats.truncnorm.cdf(z, a, b)
+    log_qa = scipy.special.log_ndtr(-a)
+    log_qb = scipy.special.log_ndtr(-b)
+    log_qz = scipy.special.log_ndtr(-np.clip(z, a, b))
+    return -np.expm1(log_qz - log_qa) / -np.expm1(log_qb - log_qa)
+
+def test_samples():
+    np.random.seed(0)
+    tn = TruncatedGaussianDistribution()
+    N = 5000
+    for mu, sigma, lb, ub in intervals:
+        x = tn.sample(mu * np.ones(N), sigma, lb, ub)
+        assert np.all(np.isfinite(x)), "Non-finite samples on %s" % ((mu, sigma, lb, ub),)
+        assert np.all((x >= lb) & (x <= ub)), "Samples out of bounds on %s" % ((mu, sigma, lb, ub),)
+
+        a, b = (lb - mu) / sigma, (ub - mu) / sigma
+        _, p = scipy.stats.kstest((x - mu) / sigma, lambda z: standard_cdf(z, a, b))
+        assert p > 1e-4, "Samples on %s fail the KS test, p=%g" % ((mu, sigma, lb, ub), p)
+
+def test_logp():
+    tn = TruncatedGaussianDistribution()
+    for mu, sigma, lb, ub in intervals:
+        a, b = (lb - mu) / sigma, (ub - mu) / sigma
+        lo = lb if np.isfinite(lb) else mu - 10 * sigma
+        hi = ub if np.isfinite(ub) else mu + 10 * sigma
+        x = np.linspace(lo, hi, 11)
+        lp = tn.logp(x, mu, sigma, lb, ub)
+        assert np.all(np.isfinite(lp)), "Non-finite logp on %s" % ((mu, sigma, lb, ub),)
+
+        # Compare with scipy where its normalization is accurate
+        if min(abs(a), abs(b)) < 5:
+            expected = scipy.stats.truncnorm.logpdf(x, a, b, loc=mu, scale=sigma)
+            assert np.allclose(lp, expected), \
+                "logp on %s differs from scipy:\n%s\n%s" % ((mu, sigma, lb, ub), lp, expected)
+
+        # The density integrates to one
+        f = lambda y: np.exp(tn.logp(np.array([y]), mu, sigma, lb, ub)[0])
+        Z, _ = quad(f, lo, hi, points=[x[np.argmax(lp)]] if lo < x[np.argmax(lp)] < hi else None)
+        assert abs(Z - 1) < 1e-6, "Density on %s integrates to %g" % ((mu, sigma, lb, ub), Z)
+
+        # Zero density outside the bounds
+        if np.isfinite(lb):
+            assert tn.logp(np.array([lb - sigma]), mu, sigma, lb, ub)[0] == -np.inf
+        if np.isfinite(ub):
+            assert tn.logp(np.array([ub + sigma]), mu, sigma, lb, ub)[0] == -np.inf
+
+if __name__ == "__main__":
+    test_samples()
+    test_logp()
+    print("Truncated Gaussian tests passed")